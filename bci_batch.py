@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# Copyright 2019-2020 Brad Martin.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Runs a job over many .bci log files in parallel.
+
+Jobs:
+  validate  Decode each log, reporting its length or why it failed.
+  stats     Write per-channel summary statistics for each log as json.
+  export    Export each log, as bci_to_csv.py would.
+
+Each log is handled in a separate worker process; a log that fails to decode
+is reported and the run carries on.  Logs whose outputs are newer than the
+log itself are skipped unless --force is given.
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+import traceback
+
+import numpy
+
+import bci_export
+from bci_data import BciLogData, BciLogMap
+
+JOBS = ['validate', 'stats', 'export']
+
+
+def find_logs(paths):
+    """Returns (log, relative name) pairs for files and directories of logs.
+
+    Directories are searched recursively for .bci files, and their logs are
+    named relative to the directory, so that outputs mirror its layout.
+    """
+    logs = []
+    for path in paths:
+        if not os.path.isdir(path):
+            logs.append((path, os.path.basename(path)))
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for name in sorted(filenames):
+                if name.endswith('.bci'):
+                    log = os.path.join(dirpath, name)
+                    logs.append((log, os.path.relpath(log, path)))
+    return logs
+
+
+def output_name(job, log, relname, output_dir, fmt):
+    """Returns the output file for a log, or None if the job has none."""
+    if job == 'validate':
+        return None
+    base = os.path.splitext(relname)[0] if output_dir else \
+        os.path.splitext(log)[0]
+    if output_dir:
+        base = os.path.join(output_dir, base)
+    return base + ('.json' if job == 'stats' else '.' + fmt)
+
+
+def up_to_date(log, output):
+    """Returns whether `output` exists and is newer than `log`."""
+    try:
+        return os.stat(output).st_mtime_ns >= os.stat(log).st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+def validate(log):
+    """Decodes a log, returning a short description of it."""
+    n = 0
+    t0 = t1 = 0.
+    with open(log, 'rb') as f:
+        for block in BciLogData.iter_numpy(f):
+            if not n:
+                t0 = block[0, 0]
+            n += block.shape[0]
+            t1 = block[-1, 0]
+    return '%d records, %.1f s' % (n, t1 - t0)
+
+
+def stats(log):
+    """Returns summary statistics for a log, as a json-able dict.
+
+    Channel means and standard deviations are accumulated a block at a time,
+    merging per-block moments, so logs of any length can be summarised.
+    """
+    n = 0
+    mean = numpy.zeros(16)
+    m2 = numpy.zeros(16)
+    lo = numpy.full(16, numpy.inf)
+    hi = numpy.full(16, -numpy.inf)
+    gaps = []
+    t0 = t1 = 0.
+    with open(log, 'rb') as f:
+        for block in BciLogData.iter_numpy(f):
+            t = block[:, 0] if not n else numpy.concatenate(
+                ([t1], block[:, 0]))
+            if not n:
+                t0 = t[0]
+            t1 = t[-1]
+            dt = numpy.diff(t)
+            period = numpy.median(dt)
+            idx = numpy.flatnonzero(dt > 1.5 * period)
+            gaps.extend(zip((t[idx] - t0).tolist(),
+                            (numpy.round(dt[idx] / period) - 1).tolist()))
+
+            ch = block[:, 1:]
+            m = ch.shape[0]
+            block_mean = ch.mean(axis=0)
+            delta = block_mean - mean
+            mean += delta * m / (n + m)
+            m2 += ((ch - block_mean) ** 2).sum(axis=0) + \
+                delta ** 2 * n * m / (n + m)
+            lo = numpy.minimum(lo, ch.min(axis=0))
+            hi = numpy.maximum(hi, ch.max(axis=0))
+            n += m
+
+    return {
+        'records': n,
+        'start_time': bci_export.log_start_time(
+            log, BciLogMap(log).records(0, 1)),
+        'duration_s': t1 - t0,
+        'sample_rate_hz': (n - 1) / (t1 - t0),
+        'gaps': [{'at_s': at, 'missing_samples': int(missing)}
+                 for at, missing in gaps],
+        'channels': {
+            'mean': mean.tolist(),
+            'std': numpy.sqrt(m2 / n).tolist(),
+            'min': lo.astype(int).tolist(),
+            'max': hi.astype(int).tolist(),
+        },
+    }
+
+
+def run_job(job, log, output, options):
+    """Runs one job on one log in a worker process.
+
+    Returns (ok, message).  Any exception, including a failed consistency
+    assert while decoding, is caught and described in the message so that
+    one bad log doesn't end the batch.  Outputs are written under a
+    temporary name and renamed into place, so a failure never leaves a
+    partial output that looks up to date.
+    """
+    tmp = None
+    try:
+        if job == 'validate':
+            return True, validate(log)
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        tmp = output + '.tmp'
+        if job == 'stats':
+            result = stats(log)
+            with open(tmp, 'w') as f:
+                json.dump(result, f, indent=1)
+            message = '%d records, %d gaps' % (
+                result['records'], len(result['gaps']))
+        else:
+            log_map = BciLogMap(log)
+            with open(log, 'rb') as f:
+                bci_export.export(
+                    BciLogData.iter_numpy(f), len(log_map), tmp,
+                    fmt=options['format'],
+                    start_time=bci_export.log_start_time(
+                        log, log_map.records(0, 1)),
+                    sample_rate=options['sample_rate'],
+                    gain=options['gain'])
+            message = '%d records' % len(log_map)
+        os.replace(tmp, output)
+        return True, message
+    except Exception as e:
+        if tmp is not None and os.path.exists(tmp):
+            os.unlink(tmp)
+        frame = traceback.extract_tb(e.__traceback__)[-1]
+        return False, '%s at %s:%d' % (
+            traceback.format_exception_only(type(e), e)[-1].strip(),
+            os.path.basename(frame.filename), frame.lineno)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('job', choices=JOBS, help='What to do with each log')
+    parser.add_argument('paths', nargs='+',
+                        help='.bci logs, or directories to search for them')
+    parser.add_argument('-o', '--output-dir',
+                        help='Where to write outputs (default next to each '
+                        'log)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='Worker processes')
+    parser.add_argument('--force', action='store_true',
+                        help='Process logs even if their outputs are up to '
+                        'date')
+    parser.add_argument('-f', '--format', choices=bci_export.FORMATS,
+                        default='csv', help='Format for export')
+    parser.add_argument('--sample-rate', type=float,
+                        help='Sample rate for edf/bdf export (default '
+                        'estimated from the data)')
+    parser.add_argument('--gain', type=int, default=bci_export.DEFAULT_GAIN,
+                        help='Channel gain, for scaling edf/bdf export')
+    args = parser.parse_args()
+    options = {
+        'format': args.format,
+        'sample_rate': args.sample_rate,
+        'gain': args.gain,
+    }
+
+    work = []
+    skipped = 0
+    for log, relname in find_logs(args.paths):
+        output = output_name(args.job, log, relname, args.output_dir,
+                             args.format)
+        if output and not args.force and up_to_date(log, output):
+            skipped += 1
+        else:
+            work.append((log, output))
+    print('%d logs to process, %d up to date' % (len(work), skipped))
+
+    failed = []
+    start = time.time()
+    with concurrent.futures.ProcessPoolExecutor(args.jobs) as executor:
+        futures = {
+            executor.submit(run_job, args.job, log, output, options): log
+            for log, output in work}
+        for i, future in enumerate(
+                concurrent.futures.as_completed(futures)):
+            log = futures[future]
+            try:
+                ok, message = future.result()
+            except Exception as e:
+                # The worker itself died, e.g. out of memory.
+                ok, message = False, repr(e)
+            if not ok:
+                failed.append(log)
+            print('[%d/%d %.0fs] %s: %s%s' % (
+                i + 1, len(work), time.time() - start, log,
+                '' if ok else 'FAILED: ', message))
+            sys.stdout.flush()
+
+    print('%d ok, %d failed, %d skipped' % (
+        len(work) - len(failed), len(failed), skipped))
+    for log in sorted(failed):
+        print('  failed: %s' % log)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
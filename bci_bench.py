@@ -0,0 +1,494 @@
+#!/usr/bin/env python3
+# Copyright 2019-2020 Brad Martin.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Benchmarks for bci_logger components.
+
+Suites:
+  receive  The logger's receive path, fed canned datagrams directly.
+  capture  The whole logger, capturing from a bci_sim.py simulated shield
+           in another process, at a range of sample rates.
+  decode   Loading and decoding logs with BciLogData.
+"""
+
+import argparse
+import contextlib
+import math
+import multiprocessing
+import os
+import selectors
+import tempfile
+import time
+import tracemalloc
+
+import numpy
+
+from bci_data import BciData, BciLogData, BciLogMap, BciLogV2Writer, \
+    BciTimeEstimator
+from bci_features import band_powers
+from bci_feed import SampleFeed
+from bci_logger import BoardSession, Logger, LogWriter, ThreadedLogWriter
+from bci_sim import ShieldSimulator, make_pairs
+
+
+def make_log(n, rate_hz=2000., pairs_per_datagram=20, seed=0, skew_ppm=0.):
+    """Returns a synthetic v1 log of `n` records, as bytes.
+
+    The records arrive in datagrams of `pairs_per_datagram`, each stamped
+    with a system time a random 5-50ms after its last sample, which is
+    enough like a real log for `BciLogData.to_numpy`.  The system clock runs
+    `skew_ppm` faster than the board's.
+    """
+    rng = numpy.random.default_rng(seed)
+    records = numpy.empty((n, BciLogData.RECORD_LEN), dtype='B')
+    records[:, BciLogData.TIMESTAMP_SIZE:] = make_pairs(
+        n, rate_hz=rate_hz, seed=seed)
+    last = numpy.minimum(
+        (numpy.arange(n) // pairs_per_datagram + 1) * pairs_per_datagram,
+        n) - 1
+    latency_ms = rng.uniform(5., 50., size=n // pairs_per_datagram + 1)
+    sys_ms = 1.7e12 + last * 1e3 / rate_hz * (1. + skew_ppm * 1e-6) + \
+        latency_ms[numpy.arange(n) // pairs_per_datagram]
+    records[:, :BciLogData.TIMESTAMP_SIZE] = (
+        sys_ms.astype('int64') & 0xFFFFFFFF).astype('>u4').view(
+            'B').reshape((n, BciLogData.TIMESTAMP_SIZE))
+    return records.tobytes()
+
+
+class _ReplaySocket:
+    """Stands in for a UDP socket, returning canned datagrams."""
+
+    def __init__(self, datagrams):
+        self._datagrams = datagrams
+        self._idx = 0
+
+    def recv(self, bufsize):
+        d = self._datagrams[self._idx]
+        self._idx += 1
+        return d[:bufsize]
+
+    def recv_into(self, buf):
+        d = self._datagrams[self._idx]
+        self._idx += 1
+        n = min(len(d), len(buf))
+        buf[:n] = d[:n]
+        return n
+
+    def close(self):
+        pass
+
+
+class _LegacyLogger(Logger):
+    """The original receive loop, kept for comparison."""
+
+    def __init__(self, writer):
+        super().__init__(writer)
+        self._data = bytes()
+
+    def handle_event(self, obj, now):
+        self._data += self._socket.recv(4096)
+
+        samples = 0
+        while len(self._data) >= BciData.PAIR_LEN:
+            if not BciData.validate(self._data):
+                self._discard_junk()
+                continue
+
+            if self._last_sample is not None:
+                expected_sample = (self._last_sample + 1) & 0xFF
+                if self._data[1] not in [self._last_sample, expected_sample]:
+                    lost = self._data[1] - expected_sample
+                    if lost < 0:
+                        lost += 256
+                    samples += lost
+                    f, _ = math.modf(now)
+                    print('%s.%03d: Dropped %d samples (%d -> %d)' %
+                          (time.strftime('%H:%M:%S', time.gmtime(now)),
+                           int(1e3 * f), lost,
+                           self._last_sample, self._data[1]))
+            self._last_sample = self._data[1]
+
+            self._writer.write(
+                self._time_fmt.pack(int(now * 1e3) & 0xFFFFFFFF) +
+                self._data[:BciData.PAIR_LEN], now)
+            self._data = self._data[BciData.PAIR_LEN:]
+            samples += 1
+
+    def _discard_junk(self):
+        idx = self._data[1:].find(BciData.START_BYTE)
+        if idx < 0:
+            self._data = bytes()
+        else:
+            self._data = self._data[idx + 1:]
+
+
+def bench_receive(cls, writer_cls, datagrams, n_records, feed=False,
+                  time_cache=False):
+    """Returns the records/sec `cls` sustains handling `datagrams`.
+
+    If `feed` is true, the logger also publishes to a shared memory feed.
+    If `time_cache` is true, the writer keeps a BciTimeCache, as
+    bci_logger.py's do by default.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir, \
+         open(os.devnull, 'w') as devnull, \
+         contextlib.redirect_stdout(devnull):
+        kwargs = {}
+        if feed:
+            kwargs['feed'] = SampleFeed('bci_bench_%d' % os.getpid())
+        logger = cls(writer_cls(os.path.join(tmpdir, 'bench.bci'),
+                                time_cache=time_cache), **kwargs)
+        logger._socket.close()
+        logger._socket = sock = _ReplaySocket(datagrams)
+        try:
+            start = time.perf_counter()
+            for _ in datagrams:
+                logger.handle_event(sock, time.time())
+            elapsed = time.perf_counter() - start
+        finally:
+            logger.close()
+    return n_records / elapsed
+
+
+def _serve_simulator(conn, kwargs):
+    """Runs a ShieldSimulator in a child process, controlled over `conn`.
+
+    Sends back the simulator's address, then its stats once told to stop.
+    """
+    sim = ShieldSimulator(**kwargs)
+    sim.start()
+    conn.send(sim.address)
+    conn.recv()
+    sim.stop_stream()
+    conn.send(sim.stats())
+    conn.recv()
+    sim.close()
+
+
+def bench_capture(rate_hz, seconds, pairs_per_datagram=None,
+                  latency_us=10000, writer_cls=LogWriter, burst=False,
+                  adaptive=False, loss=0., junk=0., feed=False):
+    """Captures from a simulated shield for `seconds` at `rate_hz`.
+
+    The simulator runs in its own process, so that the CPU time measured
+    is the logger's alone, and drops each datagram with probability `loss`,
+    and inserts junk into each with probability `junk`.
+    `burst` and `adaptive` are as for `BoardSession`.  If `feed` is true,
+    samples are also published to a shared memory feed.  Returns a dict of the
+    samples sent and logged, the fraction of them dropped, the logger's CPU
+    time per sample, and its final latency.
+    """
+    conn, child_conn = multiprocessing.Pipe()
+    sim = multiprocessing.Process(target=_serve_simulator, args=(
+        child_conn, {'rate_hz': rate_hz,
+                     'pairs_per_datagram': pairs_per_datagram,
+                     'loss': loss, 'junk': junk}))
+    sim.start()
+    try:
+        address = conn.recv()
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull):
+            filename = os.path.join(tmpdir, 'bench.bci')
+            make_feed = (lambda: SampleFeed('bci_bench_%d' % os.getpid())) \
+                if feed else None
+            session = BoardSession(address, lambda: writer_cls(filename),
+                                   make_feed=make_feed, burst=burst,
+                                   adaptive=adaptive)
+            sel = selectors.DefaultSelector()
+            for obj in session.logger.rlist():
+                sel.register(obj, selectors.EVENT_READ)
+            try:
+                session.start(latency_us, timeout=5.)
+                cpu_start = time.process_time()
+                end = time.monotonic() + seconds
+                while time.monotonic() < end:
+                    for key, _ in sel.select(0.1):
+                        session.logger.handle_event(key.fileobj, time.time())
+                    session.poll(time.monotonic())
+                conn.send('stop')
+                stats = conn.recv()
+                # Drain whatever is still on its way.
+                while True:
+                    events = sel.select(0.2)
+                    if not events:
+                        break
+                    for key, _ in events:
+                        session.logger.handle_event(key.fileobj, time.time())
+                cpu = time.process_time() - cpu_start
+                final_latency_us = session.latency_us
+            finally:
+                sel.close()
+                session.stop()
+            logged = len(BciLogMap(filename))
+        conn.send('close')
+    finally:
+        sim.join()
+
+    sent = stats['samples_sent']
+    return {
+        'sent': sent,
+        'logged': logged,
+        'drop_rate': 1. - logged / sent if sent else 0.,
+        'cpu_us_per_sample': 1e6 * cpu / logged if logged else math.nan,
+        'sim_behind_ms': stats['behind_ms'],
+        'latency_us': final_latency_us,
+    }
+
+
+def bench_decode(n_records):
+    """Returns records/sec for the ways of decoding an `n_records` log."""
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir, \
+            open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        filename = os.path.join(tmpdir, 'bench.bci')
+        with open(filename, 'wb') as f:
+            f.write(make_log(n_records))
+        v2_filename = os.path.join(tmpdir, 'bench_v2.bci')
+        with open(v2_filename, 'wb') as f:
+            writer = BciLogV2Writer(f)
+            writer.write(BciLogMap(filename).records())
+            writer.close()
+
+        def timed(name, fn):
+            start = time.perf_counter()
+            fn()
+            results.append((name, n_records / (time.perf_counter() - start)))
+
+        def read_to_numpy(name):
+            with open(name, 'rb') as f:
+                BciLogData.to_numpy(f.read())
+
+        def iterate(name):
+            with open(name, 'rb') as f:
+                for _ in BciLogData.iter_numpy(f):
+                    pass
+
+        timed('read + to_numpy', lambda: read_to_numpy(filename))
+        timed('load, no cache', lambda: BciLogData.load(
+            filename, use_cache=False))
+        timed('load, writing cache', lambda: BciLogData.load(filename))
+        timed('load, from cache', lambda: BciLogData.load(filename))
+        timed('iter_numpy', lambda: iterate(filename))
+        timed('v2 read + to_numpy', lambda: read_to_numpy(v2_filename))
+        timed('v2 load, no cache', lambda: BciLogData.load(
+            v2_filename, use_cache=False))
+
+        # Every ~1000th record spliced out or zeroed, as by a failing disk.
+        with open(filename, 'rb') as f:
+            damaged = bytearray(f.read())
+        rng = numpy.random.default_rng(0)
+        for pos in numpy.sort(rng.integers(
+                0, len(damaged), n_records // 1000))[::-1]:
+            count = int(rng.integers(1, 2 * BciLogData.RECORD_LEN))
+            damaged[pos:pos + count] = bytes(count) if pos % 2 else b''
+        damaged = bytes(damaged)
+        timed('resync, damaged', lambda: BciLogData.resync(damaged))
+        timed('recover, damaged', lambda: BciLogData.recover(damaged))
+
+        # With the time cache written by load above, as the logger would.
+        timed('band_powers', lambda: band_powers(filename, use_cache=False))
+    return results
+
+
+def bench_online(n_records, pairs_per_datagram=20):
+    """Measures `BciTimeEstimator` against `BciLogData.to_numpy`.
+
+    Returns the time taken per datagram, and the largest difference between
+    their timestamps in ms, both after the first `SETTLE_S` seconds (None
+    if the log is shorter than that) and in those.
+    """
+    data = make_log(n_records, pairs_per_datagram=pairs_per_datagram,
+                    skew_ppm=50.)
+    records = numpy.frombuffer(data, dtype=BciLogData.DTYPE)
+    estimator = BciTimeEstimator()
+    fixed_sys_ms = []
+    start = time.perf_counter()
+    for i in range(0, n_records, pairs_per_datagram):
+        # make_log's sample numbers always count up, as Logger checks for.
+        fixed_sys_ms.append(estimator.update(
+            records[i:i + pairs_per_datagram], consecutive=True)[1])
+    elapsed = time.perf_counter() - start
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        expected = BciLogData.to_numpy(records)[:, 0]
+    error_ms = numpy.abs(numpy.concatenate(fixed_sys_ms) - expected * 1e3)
+    settled = expected >= expected[0] + BciTimeEstimator.SETTLE_S
+    return (elapsed / len(fixed_sys_ms),
+            numpy.max(error_ms[settled]) if numpy.any(settled) else None,
+            numpy.max(error_ms[~settled]))
+
+
+def bench_layouts(n_records):
+    """Returns the cost of each `BciLogData.to_numpy` layout and validation.
+
+    The result is a list of (layout, validation, records/sec, result MB,
+    peak MB), the peak being the most memory allocated at once while
+    decoding, beyond the log's own bytes.
+    """
+    data = make_log(n_records)
+    results = []
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        for layout in BciLogData.LAYOUTS:
+            for validation in BciLogData.VALIDATION_LEVELS:
+                tracemalloc.start()
+                start = time.perf_counter()
+                result = BciLogData.to_numpy(data, layout=layout,
+                                             validation=validation)
+                elapsed = time.perf_counter() - start
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                size = sum(a.nbytes for a in (
+                    result if layout == 'split' else [result]))
+                del result
+                results.append((layout, validation, n_records / elapsed,
+                                size / 1e6, peak / 1e6))
+    return results
+
+
+def print_capture(args):
+    pairs = args.pairs_per_datagram
+    print('Capture from simulated shield, %.0f s per rate, %s%s%s%s%s%s:' % (
+        args.seconds, '%d pairs per datagram' % pairs if pairs else
+        '%d us latency' % args.latency_us,
+        ', burst' if args.burst else '',
+        ', adaptive' if args.adaptive else '',
+        ', %g%% datagram loss' % (100. * args.loss) if args.loss else '',
+        ', %g%% junk' % (100. * args.junk) if args.junk else '',
+        ', feed' if args.feed else ''))
+    for writer_cls in [LogWriter, ThreadedLogWriter]:
+        print('  %s:' % writer_cls.__name__)
+        lossless = None
+        for rate_hz in args.rates:
+            r = bench_capture(rate_hz, args.seconds, pairs_per_datagram=pairs,
+                              latency_us=args.latency_us,
+                              writer_cls=writer_cls, burst=args.burst,
+                              adaptive=args.adaptive, loss=args.loss,
+                              junk=args.junk, feed=args.feed)
+            if r['logged'] >= r['sent']:
+                lossless = rate_hz
+            print('    %6.0f Hz: logged %8d of %8d, %5.2f%% dropped, '
+                  '%5.1f us CPU/sample%s%s' % (
+                      rate_hz, r['logged'], r['sent'],
+                      100. * r['drop_rate'], r['cpu_us_per_sample'],
+                      ', latency now %d us' % r['latency_us']
+                      if r['latency_us'] != args.latency_us else '',
+                      ' (simulator %.0f ms behind)' % r['sim_behind_ms']
+                      if r['sim_behind_ms'] > 100. else ''))
+        print('    highest rate without loss: %s' % (
+            '%.0f Hz' % lossless if lossless is not None else 'none'))
+
+
+def print_receive(args):
+    pairs = make_pairs(args.records)
+    step = args.pairs_per_datagram or 20
+    datagrams = [pairs[i:i + step].tobytes()
+                 for i in range(0, args.records, step)]
+
+    print('Receive path, %d records, %d pairs per datagram:' %
+          (args.records, step))
+    legacy = bench_receive(_LegacyLogger, LogWriter, datagrams, args.records)
+    print('  legacy loop:     %10.0f records/s' % legacy)
+    current = bench_receive(Logger, LogWriter, datagrams, args.records)
+    print('  Logger:          %10.0f records/s (%.1fx)' %
+          (current, current / legacy))
+    threaded = bench_receive(
+        Logger, ThreadedLogWriter, datagrams, args.records)
+    print('  Logger, threaded: %9.0f records/s (%.1fx)' %
+          (threaded, threaded / legacy))
+    cached = bench_receive(
+        Logger, LogWriter, datagrams, args.records, time_cache=True)
+    print('  Logger, time cache: %7.0f records/s (%.1fx)' %
+          (cached, cached / legacy))
+    fed = bench_receive(
+        Logger, LogWriter, datagrams, args.records, feed=True)
+    print('  Logger, feed:    %10.0f records/s (%.1fx)' %
+          (fed, fed / legacy))
+
+
+def print_decode(args):
+    print('Decoding, %d records (%.0f MB):' % (
+        args.records, args.records * BciLogData.RECORD_LEN / 1e6))
+    for name, rate in bench_decode(args.records):
+        print('  %-20s %10.0f records/s (%.0f MB/s)' % (
+            name + ':', rate, rate * BciLogData.RECORD_LEN / 1e6))
+    print('  to_numpy layouts:')
+    for layout, validation, rate, size_mb, peak_mb in bench_layouts(
+            args.records):
+        print('    %-10s %-7s validation: %10.0f records/s, %6.1f MB result, '
+              '%6.1f MB peak' % (layout, validation, rate, size_mb, peak_mb))
+    seconds, settled_ms, unsettled_ms = bench_online(args.records)
+    if settled_ms is None:
+        print('  online timestamps:  %.0f us per datagram, within %.1f ms of '
+              'to_numpy (too short to settle after %d s)' % (
+                  seconds * 1e6, unsettled_ms, BciTimeEstimator.SETTLE_S))
+    else:
+        print('  online timestamps:  %.0f us per datagram, within %.2f ms of '
+              'to_numpy after %d s (%.1f ms before)' % (
+                  seconds * 1e6, settled_ms, BciTimeEstimator.SETTLE_S,
+                  unsettled_ms))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('suite', nargs='?', default='receive',
+                        choices=['receive', 'capture', 'decode', 'all'],
+                        help='Which benchmarks to run')
+    parser.add_argument('-n', '--records', type=int, default=200000,
+                        help='Number of records to feed through each logger, '
+                        'or to decode')
+    parser.add_argument('-p', '--pairs-per-datagram', type=int,
+                        help='Pairs per simulated UDP datagram (default 20, '
+                        'or for capture as many as the latency allows)')
+    parser.add_argument('-r', '--rates', type=float, nargs='+',
+                        default=[2000., 4000., 8000., 16000.],
+                        help='Sample rates to capture at')
+    parser.add_argument('-s', '--seconds', type=float, default=5.,
+                        help='Duration of each capture')
+    parser.add_argument('-l', '--latency-us', type=int, default=10000,
+                        help='Latency in usec to request when capturing')
+    parser.add_argument('-b', '--burst', action='store_true',
+                        help='Capture in burst mode')
+    parser.add_argument('-a', '--adaptive', action='store_true',
+                        help='Capture with adaptive latency and buffering')
+    parser.add_argument('--loss', type=float, default=0.,
+                        help='Probability of the simulator dropping each '
+                        'datagram when capturing')
+    parser.add_argument('--junk', type=float, default=0.,
+                        help='Probability of the simulator inserting junk '
+                        'into each datagram when capturing')
+    parser.add_argument('-f', '--feed', action='store_true',
+                        help='Capture with a shared memory feed, as '
+                        'bci_logger.py --feed')
+    args = parser.parse_args()
+
+    if args.suite in ['receive', 'all']:
+        print_receive(args)
+    if args.suite in ['capture', 'all']:
+        print_capture(args)
+    if args.suite in ['decode', 'all']:
+        print_decode(args)
+
+
+if __name__ == '__main__':
+    main()
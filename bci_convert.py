@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# Copyright 2019-2020 Brad Martin.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Converts a .bci log between the v1 and compressed v2 formats.
+
+The records are unchanged by conversion, so converting a log to v2 and back
+gives back the original file.  Any .bcix index is copied along with the log,
+since record numbers don't change either.
+"""
+
+import argparse
+import os
+import shutil
+
+from bci_data import BciLogIndex, BciLogMap, BciLogV2, BciLogV2Writer
+
+# Records converted per step.
+CHUNK_RECORDS = 16 * BciLogV2.DEFAULT_BLOCK_RECORDS
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-i', '--input', required=True,
+                        help='.bci log file to read')
+    parser.add_argument('-o', '--output', required=True,
+                        help='.bci log file to write')
+    parser.add_argument('--to', choices=['v1', 'v2'],
+                        help='Format to write (default whichever the input '
+                        'is not)')
+    parser.add_argument('-b', '--block-records', type=int,
+                        default=BciLogV2.DEFAULT_BLOCK_RECORDS,
+                        help='Records per v2 block')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='Worker processes for v2 compression')
+    args = parser.parse_args()
+
+    with open(args.input, 'rb') as f:
+        v2 = BciLogV2.is_v2(f.read(BciLogV2.HEADER.size))
+    to = args.to or ('v1' if v2 else 'v2')
+    log = BciLogMap(args.input)
+    n = len(log)
+
+    with open(args.output, 'xb') as f:
+        if to == 'v2':
+            writer = BciLogV2Writer(f, block_records=args.block_records,
+                                    jobs=args.jobs)
+            write = writer.write
+        else:
+            writer = None
+            write = f.write
+        try:
+            for start in range(0, n, CHUNK_RECORDS):
+                write(log.records(start, start + CHUNK_RECORDS))
+        finally:
+            if writer is not None:
+                writer.close()
+
+    if os.path.exists(args.input + BciLogIndex.SUFFIX):
+        shutil.copyfile(args.input + BciLogIndex.SUFFIX,
+                        args.output + BciLogIndex.SUFFIX)
+    print('%d records, %d -> %d bytes' % (
+        n, os.path.getsize(args.input), os.path.getsize(args.output)))
+
+
+if __name__ == '__main__':
+    main()
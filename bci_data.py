@@ -18,6 +18,17 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import bisect
+import collections
+import concurrent.futures
+import io
+import json
+import math
+import mmap
+import os
+import struct
+import zlib
+
 import numpy
 import scipy.stats
 
@@ -34,6 +45,8 @@ class BciData:
     STOP_BYTES = [0xC5, 0xC6]
     PKT_LEN = 33
     PAIR_LEN = 2 * PKT_LEN
+    # Lookup table of which byte values are valid stop bytes.
+    _IS_STOP = numpy.isin(numpy.arange(256), STOP_BYTES)
 
     @staticmethod
     def validate(data):
@@ -61,14 +74,71 @@ class BciData:
 
         return True
 
+    @staticmethod
+    def count_valid(data):
+        """Returns the number of leading valid pairs in the given data.
+
+        This is a vectorized equivalent of calling `validate` on each
+        successive pair and stopping at the first failure, except that no
+        diagnostics are printed.  Any trailing partial pair is ignored.
+        """
+        n = len(data) // BciData.PAIR_LEN
+        pairs = numpy.frombuffer(
+            data, dtype='B', count=n * BciData.PAIR_LEN).reshape(
+                (n, BciData.PAIR_LEN))
+        ok = ((pairs[:, 0] == BciData.START_BYTE) &
+              (pairs[:, BciData.PKT_LEN] == BciData.START_BYTE) &
+              BciData._IS_STOP[pairs[:, BciData.PKT_LEN - 1]] &
+              BciData._IS_STOP[pairs[:, BciData.PAIR_LEN - 1]] &
+              (pairs[:, 1] == pairs[:, BciData.PKT_LEN + 1]))
+        bad = numpy.flatnonzero(~ok)
+        return int(bad[0]) if bad.size else n
+
 
 class BciLogData:
     """Constants and functions specific to a log file of BCI data."""
     TIMESTAMP_SIZE = 4
     RECORD_LEN = TIMESTAMP_SIZE + BciData.PAIR_LEN
+    DTYPE = numpy.dtype([
+        ('sys_timestamp_ms', '>u4'),
+        ('packet', [
+            ('start_byte', 'B'),
+            ('sample_number', 'B'),
+            ('channel_data', [
+                ('h8', 'b'),
+                ('l16', '>u2')
+            ], (8,)),
+            ('aux', 'B', (2,)),
+            ('hw_timestamp_ms', '>u4'),
+            ('stop_byte', 'B'),
+        ], (2,))
+    ])
+    assert DTYPE.itemsize == RECORD_LEN
+    # Default block size for iter_numpy; about half a minute at 2kHz.
+    CHUNK_RECORDS = 65536
+    # Bound on how far iter_numpy timestamps may differ from to_numpy's, in
+    # seconds.
+    ITER_TOLERANCE_S = 1e-6
+    # Result layouts offered by to_numpy; see there.
+    LAYOUTS = ['combined', 'split', 'structured']
+    # One sample of the 'structured' layout.
+    SAMPLE_DTYPE = numpy.dtype([('time', '<f8'), ('channels', '<i4', (16,))])
+    # How thoroughly to_numpy checks the packet framing of its input.
+    VALIDATION_LEVELS = ['full', 'sampled', 'none']
+    # Number of records checked by 'sampled' validation.
+    VALIDATE_SAMPLES = 4096
+    # Bytes of a damaged log searched for records at a time by `resync`.
+    RESYNC_CHUNK_BYTES = 1 << 24
+    # Largest plausible step in either timestamp between consecutive records,
+    # in ms, for `resync`.
+    RESYNC_MAX_STEP_MS = 1000
+    # Offset of the hardware timestamp within a packet.
+    _HW_TIMESTAMP_OFFSET = 28
+    # Samples gathered at a time by `epochs`, across however many events.
+    _EPOCH_CHUNK_SAMPLES = 1 << 18
 
     @staticmethod
-    def to_numpy(data, separated=False):
+    def to_numpy(data, separated=False, layout='combined', validation='full'):
         """Parses binary log data into numpy format.
 
         Given the binary contents of a log file, parses the file data, and
@@ -83,42 +153,371 @@ class BciLogData:
         then such losses will be hidden within the one result array, with the
         available data directly concatenated.
 
+        `layout` selects other forms for the (or each) array, which avoid
+        storing the channel readings as float64:
+          'combined'    The (N, 17) float64 array described above.
+          'split'       A tuple of an (N,) float64 array of timestamps and an
+                        (N, 16) int32 array of channel readings.
+          'structured'  An (N,) array of `SAMPLE_DTYPE`, with the timestamp
+                        and channel readings of each sample in its 'time'
+                        and 'channels' fields.
+        Either takes a little over half the memory of 'combined'.
+
+        `validation` is how much of the packet framing (start and stop bytes,
+        and matching sample numbers) is checked: 'full' checks every record,
+        'sampled' only `VALIDATE_SAMPLES` of them spread through the log, and
+        'none' none of them, for trusted logs.
+
+        `data` may be in either the v1 or the v2 (`BciLogV2`) format.
         """
-        dt = numpy.dtype([
-            ('sys_timestamp_ms', '>u4'),
-            ('packet', [
-                ('start_byte', 'B'),
-                ('sample_number', 'B'),
-                ('channel_data', [
-                    ('h8', 'b'),
-                    ('l16', '>u2')
-                ], (8,)),
-                ('aux', 'B', (2,)),
-                ('hw_timestamp_ms', '>u4'),
-                ('stop_byte', 'B'),
-            ], (2,))
-        ])
-        assert dt.itemsize == BciLogData.RECORD_LEN
-        parsed = numpy.frombuffer(data, dtype=dt)
+        parsed = BciLogData._parse(data)
+        BciLogData._validate(parsed, validation)
+        fixed_s_no, fixed_sys_ms, _ = BciLogData._reconstruct(parsed)
+        return BciLogData._assemble(
+            parsed, fixed_s_no, fixed_sys_ms, separated, layout)
 
-        # Every packet must start with a valid start byte.
-        assert numpy.all(parsed['packet']['start_byte'] == BciData.START_BYTE)
-        # Every packet must end with one of the valid stop bytes.
-        assert numpy.all(
-            numpy.any(
-                numpy.stack(
-                    [parsed['packet']['stop_byte'] == b
-                     for b in BciData.STOP_BYTES],
-                    axis=2),
-                axis=2))
-        # Every record must have the same sample number in both packets.
-        s_no = parsed['packet'][:, 0]['sample_number'].astype('int64')
-        assert numpy.all(s_no == parsed['packet'][:, 1]['sample_number'])
+    @staticmethod
+    def load(filename, separated=False, use_cache=True, layout='combined',
+             validation='full'):
+        """Loads a log file into numpy format.
+
+        The result is the same as from `to_numpy`.  If `use_cache` is True,
+        reconstructed timestamps are kept in a `BciTimeCache` sidecar file,
+        so that subsequent loads of the same log can skip reconstruction;
+        once the log has grown, they can then differ from `to_numpy`'s by up
+        to `BciTimeCache.TOLERANCE_MS`.
+        For a log with the cache `bci_logger.py` writes as it logs, nothing
+        is reconstructed, and timestamps are instead those estimated while
+        logging (see `BciTimeEstimator.TOLERANCE_MS`).
+        """
+        parsed = BciLogMap(filename).records()
+        BciLogData._validate(parsed, validation)
+        if use_cache:
+            fixed_s_no, fixed_sys_ms = BciTimeCache.reconstruct(
+                filename, parsed)
+        else:
+            fixed_s_no, fixed_sys_ms, _ = BciLogData._reconstruct(parsed)
+        return BciLogData._assemble(
+            parsed, fixed_s_no, fixed_sys_ms, separated, layout)
+
+    @staticmethod
+    def load_segments(log_filename, separated=False, layout='combined',
+                      validation='full', jobs=None):
+        """Loads a segmented log (see `BciLogManifest`) into numpy format.
+
+        The segments are treated as one continuous log: the result is the
+        same as from `to_numpy` given all of their records at once, so that
+        timestamps are reconstructed across segment boundaries.  Segments
+        are read, decompressed and validated in parallel, by up to `jobs`
+        threads.  If every segment has an up to date `BciTimeCache`, e.g.
+        as written by `bci_logger.py`, timestamps come from those instead.
+        `log_filename` may name either the log or its manifest.
+        """
+        manifest = BciLogManifest.load(log_filename)
+        filenames = manifest.segment_files(log_filename)
+        logs = [BciLogMap(filename) for filename in filenames]
+        starts = numpy.cumsum([0] + [len(log) for log in logs])
+        parsed = numpy.empty(starts[-1], dtype=BciLogData.DTYPE)
+
+        def read(i):
+            segment = manifest.segments[i]
+            records = parsed[starts[i]:starts[i + 1]]
+            records[:] = logs[i].records()
+            BciLogData._validate(records, validation)
+            # Make sure this is the segment the manifest describes.
+            if segment.get('records') is not None and records.shape[0]:
+                assert records.shape[0] == segment['records']
+                assert records[0]['packet'][0]['sample_number'] == \
+                    segment['first_sample']
+                assert records[0]['sys_timestamp_ms'] == \
+                    segment['first_sys_ms']
+            return BciTimeCache.cached_times(filenames[i], records)
+
+        with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+            times = list(executor.map(read, range(len(logs))))
+        if all(t is not None for t in times):
+            times = numpy.concatenate(times)
+            fixed_s_no = times['fixed_s_no']
+            fixed_sys_ms = times['fixed_sys_ms']
+        else:
+            fixed_s_no, fixed_sys_ms, _ = BciLogData._reconstruct(parsed)
+        return BciLogData._assemble(
+            parsed, fixed_s_no, fixed_sys_ms, separated, layout)
+
+    @staticmethod
+    def recover(data, separated=False, layout='combined'):
+        """Parses possibly damaged binary log data into numpy format.
+
+        Unlike `to_numpy`, which asserts on any corruption, this skips over
+        anything that isn't a valid record (see `resync`), so that whatever
+        survives of e.g. a log truncated by a crash or a full disk can still
+        be used.  Returns (result, dropped), where result is as from
+        `to_numpy` and dropped is as from `resync`.  Only the v1 format is
+        supported.
+        """
+        parsed, dropped = BciLogData.resync(data)
+        fixed_s_no, fixed_sys_ms, _ = BciLogData._reconstruct(parsed)
+        return BciLogData._assemble(
+            parsed, fixed_s_no, fixed_sys_ms, separated, layout), dropped
+
+    @staticmethod
+    def epochs(data, events, pre_s, post_s, out=None, dtype='float32'):
+        """Extracts the samples around each of a set of events.
+
+        `data` is as for `to_numpy`, and `events` are times in seconds, in
+        the same form as its timestamps (or full epoch times, which are
+        taken modulo 2^32 ms).  Each epoch is the samples from `pre_s`
+        before its event up to `post_s` after it, the first being the first
+        sample at or after the start, so that it is aligned to within one
+        sample period.  Every epoch has the same number of samples,
+        `(pre_s + post_s)` times the sample rate, rounded.
+
+        Returns (epochs, complete): an (n_events, n_samples, 16) array of
+        channel readings, and an (n_events,) bool array of whether each
+        epoch has all of its samples.  Samples missing from an epoch, because
+        it spans a gap in the log or runs off either end of it, are NaN.
+        Readings are 24 bit, so the default float32 holds them exactly.
+
+        `out` may instead name a .npy file for the result to be written to
+        and memory-mapped from, for sets of epochs too large to hold in
+        memory.  The log is then also only ever decoded a few thousand
+        epochs at a time.
+        """
+        parsed = BciLogData._parse(data)
+        BciLogData._validate(parsed)
+        fixed_s_no, fixed_sys_ms, _ = BciLogData._reconstruct(parsed)
+        return BciLogData._epochs(parsed, fixed_s_no, fixed_sys_ms, events,
+                                  pre_s, post_s, out, dtype)
+
+    @staticmethod
+    def _epochs(parsed, fixed_s_no, fixed_sys_ms, events, pre_s, post_s, out,
+                dtype):
+        """Implements `epochs`, given reconstructed timestamps.
+
+        `parsed` may be anything indexable by slices, such as a memory map
+        or `BciLogV2Records`; only the records spanned by each chunk of
+        events are read.
+        """
+        n = parsed.shape[0]
+        assert n > 1
+        samples_per_s = 1e3 * (fixed_s_no[-1] - fixed_s_no[0]) / (
+            fixed_sys_ms[-1] - fixed_sys_ms[0])
+        n_samples = int(round((pre_s + post_s) * samples_per_s))
+        events = numpy.asarray(events, dtype='float64').reshape(-1)
+        shape = (events.shape[0], n_samples, 16)
+        if isinstance(out, str):
+            out = numpy.lib.format.open_memmap(out, mode='w+', dtype=dtype,
+                                               shape=shape)
+        elif out is None:
+            out = numpy.empty(shape, dtype=dtype)
+        complete = numpy.zeros(events.shape[0], dtype='bool')
+        if not events.shape[0] or not n_samples:
+            return out, complete
+
+        # Start times in ms, in the epoch of the log's timestamps.
+        period_ms = float(1 << 32)
+        start_ms = events * 1e3 - pre_s * 1e3 - fixed_sys_ms[0]
+        start_ms = fixed_sys_ms[0] + numpy.remainder(
+            start_ms + period_ms / 2, period_ms) - period_ms / 2
+        # The sample number of each epoch's first sample, counting back
+        # from the first sample received at or after its start.
+        first = numpy.minimum(
+            numpy.searchsorted(fixed_sys_ms, start_ms), n - 1)
+        start_s_no = fixed_s_no[first] - numpy.floor(
+            (fixed_sys_ms[first] - start_ms) * samples_per_s * 1e-3 +
+            1e-6).astype('int64')
+        first = numpy.searchsorted(fixed_s_no, start_s_no)
+        last = first + n_samples - 1
+        # An epoch is complete if it starts on a sample that exists, and
+        # ends within the same contiguous region.
+        regions = BciLogData._get_contiguous_regions(fixed_s_no)
+        complete[:] = last < n
+        complete &= fixed_s_no[numpy.minimum(first, n - 1)] == start_s_no
+        complete &= numpy.searchsorted(regions, first, side='right') == \
+            numpy.searchsorted(regions, numpy.minimum(last, n - 1),
+                               side='right')
+
+        # Events are gathered in time order, a chunk at a time, so that
+        # each chunk reads only a short span of the log.
+        order = numpy.argsort(events, kind='stable')
+        offsets = numpy.arange(n_samples)
+        chunk = max(BciLogData._EPOCH_CHUNK_SAMPLES // n_samples, 1)
+        for i in range(0, order.shape[0], chunk):
+            idx = order[i:i + chunk]
+            pos = first[idx, None] + offsets
+            found = numpy.ones(pos.shape, dtype='bool')
+            gaps = ~complete[idx]
+            if numpy.any(gaps):
+                # Where samples are missing, find each one that isn't.
+                targets = start_s_no[idx[gaps], None] + offsets
+                pos[gaps] = numpy.minimum(
+                    numpy.searchsorted(fixed_s_no, targets), n - 1)
+                found[gaps] = fixed_s_no[pos[gaps]] == targets
+            lo = int(pos.min())
+            records = parsed[lo:int(pos.max()) + 1]
+            if records.shape[0] <= pos.size:
+                # Overlapping epochs: decode each record only once.
+                channels = BciLogData._channel_data(records)[pos - lo]
+            else:
+                channels = BciLogData._channel_data(
+                    records[(pos - lo).reshape(-1)]).reshape(
+                        pos.shape + (16,))
+            result = channels.astype(dtype)
+            if not numpy.all(found):
+                result[~found] = numpy.nan
+            out[idx] = result
+        return out, complete
+
+    @staticmethod
+    def resync(data):
+        """Finds the valid records in possibly damaged binary log data.
+
+        Returns (records, dropped), where records is an array of `DTYPE` of
+        the records found by `find_records`, and dropped is the list of
+        (byte offset, byte count) spans of `data` that were skipped.  If
+        nothing is dropped, records is a view of `data`.
+        """
+        buf = numpy.frombuffer(data, dtype='B')
+        runs, dropped = BciLogData.find_records(buf)
+        if not dropped:
+            return buf.view(BciLogData.DTYPE), dropped
+        return numpy.concatenate(
+            [buf[start:stop] for start, stop in runs] or
+            [buf[:0]]).view(BciLogData.DTYPE), dropped
+
+    @staticmethod
+    def find_records(data):
+        """Finds the spans of valid records in possibly damaged log data.
+
+        Every offset in `data` is checked for a record with valid start and
+        stop bytes and matching sample numbers, a chunk of
+        `RESYNC_CHUNK_BYTES` at a time.  Candidates whose timestamps jump
+        by more than `RESYNC_MAX_STEP_MS` both from the candidate before and
+        to the one after are dropped too, as their framing is intact but
+        their timestamps are not, e.g. where part of a record was zeroed.
+        Runs of consecutive records are then chained together, skipping
+        anything between them; where runs overlap, the longer run wins.
+
+        Returns (runs, dropped), lists of (start, stop) byte spans of `data`
+        holding consecutive records, and of (byte offset, byte count) spans
+        skipped.
+        """
+        buf = numpy.frombuffer(data, dtype='B')
+        record_len = BciLogData.RECORD_LEN
+        chunks = range(0, buf.shape[0], BciLogData.RESYNC_CHUNK_BYTES)
+        jobs = os.cpu_count() or 1
+        if len(chunks) > 1 and jobs > 1:
+            # numpy releases the GIL for the bulk of the work.
+            with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+                found = list(executor.map(
+                    lambda chunk: BciLogData._find_chunk(buf, chunk), chunks))
+        else:
+            found = [BciLogData._find_chunk(buf, chunk) for chunk in chunks]
+        run_starts = numpy.concatenate(
+            [starts for starts, _ in found] or [[]]).astype('int64')
+        run_counts = numpy.concatenate(
+            [counts for _, counts in found] or [[]]).astype('int64')
+
+        runs = []
+        end = 0
+        for i in range(run_starts.shape[0]):
+            start = int(run_starts[i])
+            count = int(run_counts[i])
+            if start < end:
+                # Overlaps the last run taken; skip what it already covers.
+                skip = -((start - end) // record_len)
+                start += skip * record_len
+                count -= skip
+            if i + 1 < run_starts.shape[0] and \
+                    run_starts[i + 1] < start + count * record_len and \
+                    run_counts[i + 1] > count:
+                # Yield to a longer overlapping run.
+                count = (int(run_starts[i + 1]) - start) // record_len
+            if count <= 0:
+                continue
+            if runs and start == runs[-1][1]:
+                runs[-1][1] = start + count * record_len
+            else:
+                runs.append([start, start + count * record_len])
+            end = start + count * record_len
 
+        dropped = []
+        end = 0
+        for start, stop in runs:
+            if start > end:
+                dropped.append((end, start - end))
+            end = stop
+        if buf.shape[0] > end:
+            dropped.append((end, buf.shape[0] - end))
+        return [tuple(run) for run in runs], dropped
+
+    @staticmethod
+    def _find_chunk(buf, chunk):
+        """Returns the starts and lengths of runs of plausible records
+        starting in one chunk of `find_records`."""
+        record_len = BciLogData.RECORD_LEN
+        pkt = BciLogData.TIMESTAMP_SIZE
+        pkt2 = pkt + BciData.PKT_LEN
+        chunk_len = BciLogData.RESYNC_CHUNK_BYTES
+        # Each window takes in a record either side of its chunk, so that the
+        # candidates at its edges have neighbours to compare.
+        lo = max(chunk - record_len, 0)
+        w = buf[lo:chunk + chunk_len + 2 * record_len - 1]
+        n = w.shape[0] - record_len + 1
+        if n <= 0:
+            return [], []
+        # One cheap contiguous comparison first, to find candidates ...
+        offsets = numpy.flatnonzero(w[pkt:pkt + n] == BciData.START_BYTE)
+        # ... then the remaining checks on just those.
+        offsets = offsets[
+            (w[offsets + pkt2] == BciData.START_BYTE) &
+            BciData._IS_STOP[w[offsets + pkt2 - 1]] &
+            BciData._IS_STOP[w[offsets + record_len - 1]] &
+            (w[offsets + pkt + 1] == w[offsets + pkt2 + 1])]
+        steps_ok = numpy.ones(max(offsets.shape[0] - 1, 0), dtype=bool)
+        # A big endian uint32 at every byte offset of the window.
+        u32 = numpy.ndarray((w.shape[0] - 3,), dtype='>u4', buffer=w,
+                            strides=(1,))
+        for ts_offset in [0, pkt + BciLogData._HW_TIMESTAMP_OFFSET]:
+            # Unsigned subtraction allows for the timestamps wrapping.
+            steps_ok &= numpy.diff(u32[offsets + ts_offset]) < \
+                BciLogData.RESYNC_MAX_STEP_MS
+        plausible = numpy.zeros(offsets.shape[0], dtype=bool)
+        plausible[1:] |= steps_ok
+        plausible[:-1] |= steps_ok
+        offsets = offsets[plausible] + lo
+        offsets = offsets[(offsets >= chunk) & (offsets < chunk + chunk_len)]
+        if not offsets.size:
+            return [], []
+        breaks = numpy.flatnonzero(numpy.diff(offsets) != record_len) + 1
+        return (offsets[numpy.concatenate(([0], breaks))],
+                numpy.diff(numpy.concatenate(
+                    ([0], breaks, [offsets.shape[0]]))))
+
+    @staticmethod
+    def _parse(data):
+        """Returns the records of v1 or v2 log data, or of parsed records."""
+        if isinstance(data, numpy.ndarray) and data.dtype == BciLogData.DTYPE:
+            return data
+        if BciLogV2.is_v2(data):
+            return BciLogV2Records(data)[:]
+        return numpy.frombuffer(data, dtype=BciLogData.DTYPE)
+
+    @staticmethod
+    def _reconstruct(parsed):
+        """Reconstructs sample indexes and timestamps for parsed records.
+
+        Returns the unwrapped sample numbers, the reconstructed system
+        timestamps in ms, and a dict of the reconstruction state at the end
+        of the records, as used by `BciTimeCache` to extend them.
+        """
+        s_no = parsed['packet'][:, 0]['sample_number'].astype('int64')
         sys_ms = parsed['sys_timestamp_ms']
         hw_ms = parsed['packet'][:, 0]['hw_timestamp_ms']
-        sys_elapsed_ms = sys_ms[-1] - sys_ms[0]
-        hw_elapsed_ms = hw_ms[-1] - hw_ms[0]
+        # As Python ints, so that going backwards fails the asserts below
+        # instead of overflowing.
+        sys_elapsed_ms = int(sys_ms[-1]) - int(sys_ms[0])
+        hw_elapsed_ms = int(hw_ms[-1]) - int(hw_ms[0])
         assert sys_elapsed_ms > 0  # TODO(bmartin) This could wrap
         assert hw_elapsed_ms > 0   # This shouldn't wrap
         assert hw_elapsed_ms > 0.8 * sys_elapsed_ms
@@ -193,26 +592,110 @@ class BciLogData:
         assert numpy.all(d_sys > -500.)
         assert numpy.all(d_sys <= 0.)
 
-        ch_in = parsed['packet']['channel_data']
-        channel_data = (ch_in['h8'] * 65536 + ch_in['l16']).reshape(
-            (ch_in.shape[0], ch_in.shape[1] * ch_in.shape[2]))
+        state = {
+            'samples_per_ms': samples_per_ms[-1],
+            'sys_hw_slope': sys_hw_slope,
+            'sys_hw_intercept': sys_hw_intercept,
+            'fixed_hw_ms': fixed_hw_ms[-1],
+        }
+        return fixed_s_no, fixed_sys_ms, state
+
+    @staticmethod
+    def _assemble(parsed, fixed_s_no, fixed_sys_ms, separated,
+                  layout='combined'):
+        """Builds the result of `to_numpy` from reconstructed timestamps.
+
+        Timestamps and channel readings are written straight into the result
+        in the requested layout, without whole-log intermediate arrays.
+        """
+        n = parsed.shape[0]
+        if layout == 'combined':
+            combined = numpy.empty((n, 17))
+            times, channels = combined[:, 0], combined[:, 1:]
 
-        combined = numpy.concatenate(
-            (numpy.expand_dims(fixed_sys_ms * 1e-3, axis=1),
-             channel_data),
-            axis=1)
+            def split(start, stop):
+                return combined[start:stop, :]
+        elif layout == 'split':
+            times = numpy.empty(n)
+            channels = numpy.empty((n, 16), dtype='int32')
+
+            def split(start, stop):
+                return times[start:stop], channels[start:stop]
+        elif layout == 'structured':
+            samples = numpy.empty(n, dtype=BciLogData.SAMPLE_DTYPE)
+            times, channels = samples['time'], samples['channels']
+
+            def split(start, stop):
+                return samples[start:stop]
+        else:
+            raise ValueError('Unknown layout %r' % layout)
+        numpy.multiply(fixed_sys_ms, 1e-3, out=times)
+        # Converted a chunk at a time, as numpy would otherwise make a whole
+        # temporary copy to write into strided channel columns.
+        for start in range(0, n, BciLogData.CHUNK_RECORDS):
+            stop = start + BciLogData.CHUNK_RECORDS
+            channels[start:stop] = BciLogData._channel_data(
+                parsed[start:stop])
         if not separated:
-            return combined
+            return split(None, None)
 
         region_idxs = BciLogData._get_contiguous_regions(fixed_s_no)
         start_idx = 0
         result = []
         for idx in region_idxs:
-            result.append(combined[start_idx:idx, :])
+            result.append(split(start_idx, idx))
             start_idx = idx
-        result.append(combined[start_idx:, :])
+        result.append(split(start_idx, None))
         return result
 
+    @staticmethod
+    def iter_numpy(f, chunk_records=CHUNK_RECORDS):
+        """Parses a log file into numpy format, a block at a time.
+
+        This is a bounded-memory alternative to `to_numpy` for logs too large
+        to load at once.  `f` is a binary file object open for reading, which
+        must be seekable since the file is read several times: the timestamp
+        reconstruction done by `to_numpy` depends on the whole log, so the
+        global quantities it needs are gathered in streaming passes first.
+        The unwrapped sample numbers and timestamp reconstruction state are
+        carried across block boundaries.
+
+        Yields (n, 17) numpy arrays of up to `chunk_records` records each,
+        which concatenated are equivalent to `to_numpy(f.read())`.  Channel
+        values are identical, and timestamps agree to within
+        `ITER_TOLERANCE_S` (the only differences being floating point
+        summation order).
+        """
+        return _BciLogStream(f, chunk_records).decode()
+
+    @staticmethod
+    def _validate(parsed, level='full'):
+        """Checks the packet framing of parsed records; see `to_numpy`."""
+        if level == 'none':
+            return
+        if level == 'sampled':
+            n = parsed.shape[0]
+            if n > BciLogData.VALIDATE_SAMPLES:
+                BciLogData._validate(parsed[-1:])
+                parsed = parsed[::n // BciLogData.VALIDATE_SAMPLES]
+        elif level != 'full':
+            raise ValueError('Unknown validation level %r' % level)
+        packet = parsed['packet']
+        # Every packet must start with a valid start byte.
+        assert numpy.all(packet['start_byte'] == BciData.START_BYTE)
+        # Every packet must end with one of the valid stop bytes.
+        assert numpy.all(BciData._IS_STOP[packet['stop_byte']])
+        # Every record must have the same sample number in both packets.
+        assert numpy.all(packet['sample_number'][:, 0] ==
+                         packet['sample_number'][:, 1])
+
+    @staticmethod
+    def _channel_data(parsed):
+        """Returns the (N, 16) int32 channel readings of parsed records."""
+        ch_in = parsed['packet']['channel_data']
+        return (ch_in['h8'].astype('int32') * 65536 + ch_in['l16']).reshape(
+            (ch_in.shape[0], ch_in.shape[1] * ch_in.shape[2]))
+
     @staticmethod
     def _get_contiguous_regions(fixed_sample_nos):
         """Finds regions of contiguous sample data in a log.
@@ -223,3 +706,1406 @@ class BciLogData:
         """
         steps = fixed_sample_nos[1:] - fixed_sample_nos[:-1]
         return 1 + numpy.nonzero(steps != 1)[0]
+
+
+class BciLogMap:
+    """Lazy, memory-mapped access to a log file.
+
+    Opening a log only maps it; records are read from disk as windows of it
+    are requested, so looking at a short span of a huge log is cheap.
+    """
+    # Extra records decoded either side of a time window, so that the
+    # window's own timestamp reconstruction has some context and so that
+    # samples delivered up to 500ms late are found.
+    _TIME_MARGIN_MS = 1000
+
+    def __init__(self, filename):
+        # Any partial record at the end, e.g. from a log still being written,
+        # is ignored.
+        with open(filename, 'rb') as f:
+            v2 = BciLogV2.is_v2(f.read(BciLogV2.HEADER.size))
+            f.seek(0, 2)
+            n = f.tell() // BciLogData.RECORD_LEN
+        if v2:
+            # Blocks are decoded as they're needed instead.
+            self._records = BciLogV2Records(
+                numpy.memmap(filename, dtype='B', mode='r'))
+        else:
+            self._records = numpy.memmap(filename, dtype=BciLogData.DTYPE,
+                                         mode='r', shape=(n,))
+        self._sys_ms = self._records['sys_timestamp_ms']
+        self._times = BciTimeCache.cached_times(filename, self._records)
+        self._index = BciLogIndex.load(filename)
+
+    def __len__(self):
+        return self._records.shape[0]
+
+    def records(self, start=None, stop=None):
+        """Returns a memory-mapped view of the raw records in a range.
+
+        For v2 logs, the records are decoded into memory instead.
+        """
+        return self._records[start:stop]
+
+    def read(self, start=None, stop=None, separated=False):
+        """Decodes records in the range [start, stop).
+
+        The result is as from `BciLogData.to_numpy`.  If the log has an up to
+        date `BciTimeCache`, timestamps come from it.  Otherwise they are
+        reconstructed from the requested records and `_TIME_MARGIN_MS` of
+        records either side of them, so can differ by a few ms from those
+        found when decoding the whole log.
+        """
+        start, stop, _ = slice(start, stop).indices(len(self))
+        stop = max(start, stop)
+        parsed = self._records[start:stop]
+        BciLogData._validate(parsed)
+        if self._times is None:
+            fixed_s_no, fixed_sys_ms = self._reconstruct_around(start, stop)
+        else:
+            times = self._times[start:stop]
+            fixed_s_no = times['fixed_s_no']
+            fixed_sys_ms = times['fixed_sys_ms']
+        return BciLogData._assemble(parsed, fixed_s_no, fixed_sys_ms,
+                                    separated)
+
+    def start_time(self):
+        """Returns the system timestamp of the first record, in seconds."""
+        return self._sys_ms[0] * 1e-3
+
+    def find_time(self, t):
+        """Returns the index of the first record received at or after `t`.
+
+        `t` is in seconds, either as returned by `to_numpy` or as a full
+        epoch time.  This is a binary search, touching only a few pages of
+        the file.  Full epoch times are unambiguous if the log has a
+        `BciLogIndex`; otherwise they are taken modulo 2^32 ms relative to
+        the start of the log, like other times.  Infinite times give the
+        start or end of the log.
+        """
+        if math.isinf(t):
+            return len(self) if t > 0 else 0
+        if self._index is not None and t * 1e3 >= (1 << 32):
+            return self._index.find(self._records, t)
+        target = self._relative_ms(int(math.floor(t * 1e3)))
+        if target < 0:
+            return 0
+        lo = 0
+        hi = len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._relative_ms(int(self._sys_ms[mid])) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def read_time(self, t_start, t_end, separated=False):
+        """Decodes the samples with timestamps in [t_start, t_end)."""
+        margin_s = self._TIME_MARGIN_MS * 1e-3
+        start = self.find_time(t_start - margin_s)
+        stop = self.find_time(t_end + margin_s)
+        if stop <= start:
+            empty = numpy.empty((0, 17))
+            return [] if separated else empty
+        regions = self.read(start, stop, separated=True)
+        duration = t_end - t_start
+        t_start = self._unwrap_s(t_start, regions[0][0, 0])
+        t_end = t_start + duration
+        result = [r[(r[:, 0] >= t_start) & (r[:, 0] < t_end), :]
+                  for r in regions]
+        if separated:
+            return [r for r in result if r.shape[0]]
+        return numpy.concatenate(result)
+
+    def epochs(self, events, pre_s, post_s, out=None, dtype='float32'):
+        """Extracts the samples around events, as `BciLogData.epochs`.
+
+        Only the records around the events are read from disk, but unless
+        the log has an up to date `BciTimeCache`, timestamps are first
+        reconstructed from the whole log, as by `BciLogData.load`.
+        """
+        if self._times is None:
+            fixed_s_no, fixed_sys_ms, _ = BciLogData._reconstruct(
+                self._records[:])
+        else:
+            fixed_s_no = self._times['fixed_s_no']
+            fixed_sys_ms = self._times['fixed_sys_ms']
+        return BciLogData._epochs(self._records, fixed_s_no, fixed_sys_ms,
+                                  events, pre_s, post_s, out, dtype)
+
+    def _reconstruct_around(self, start, stop):
+        """Reconstructs timestamps for records [start, stop) in context.
+
+        A few records on their own may span too little time to reconstruct,
+        so this is done over `_TIME_MARGIN_MS` either side of them, and the
+        unwrapped sample numbers and system timestamps of just the requested
+        records are returned.
+        """
+        if start == stop:
+            return numpy.empty(0, dtype='int64'), numpy.empty(0)
+        margin_s = self._TIME_MARGIN_MS * 1e-3
+        lo = min(self.find_time(self._sys_ms[start] * 1e-3 - margin_s), start)
+        hi = max(self.find_time(self._sys_ms[stop - 1] * 1e-3 + margin_s),
+                 stop)
+        fixed_s_no, fixed_sys_ms, _ = BciLogData._reconstruct(
+            self._records[lo:hi])
+        return (fixed_s_no[start - lo:stop - lo],
+                fixed_sys_ms[start - lo:stop - lo])
+
+    def _relative_ms(self, ms):
+        """Returns ms relative to the first record, handling rollover.
+
+        Times up to 2^31 ms before the start of the log come out negative.
+        """
+        rel = (ms - int(self._sys_ms[0])) & 0xFFFFFFFF
+        return rel - (1 << 32) if rel >= (1 << 31) else rel
+
+    @staticmethod
+    def _unwrap_s(t, ref):
+        """Expresses time `t` in the same 32 bit ms epoch as `ref`."""
+        period = (1 << 32) * 1e-3
+        return ref + math.remainder(t - ref, period)
+
+
+class BciTimeCache:
+    """Sidecar file caching the timestamp reconstruction of a log.
+
+    This is kept next to the log, with `SUFFIX` appended to its name.  It
+    holds the unwrapped sample number and reconstructed system timestamp of
+    every record, keyed by the size and mtime of the log it was made from.
+    It also holds the reconstruction state at the last record.  If the log
+    has since grown (and the last cached record is unchanged), then that
+    state is used to extend the cache over the new records, instead of
+    reconstructing the whole log again.  Because this extrapolates the
+    sample rate and the sys/hw fit found for the earlier part of the log,
+    it is only done while the new records are no more than the cached ones,
+    and only if the results stay within the bounds `to_numpy` enforces.
+    The extended timestamps are then within `TOLERANCE_MS` of those from
+    reconstructing the whole log again.
+
+    `bci_logger.py` writes the cache as it logs (see `BciTimeCacheWriter`),
+    with times from a `BciTimeEstimator` rather than `to_numpy`'s.
+    """
+    SUFFIX = '.bcit'
+    DTYPE = numpy.dtype([('fixed_s_no', '<i8'), ('fixed_sys_ms', '<f8')])
+    TOLERANCE_MS = 1.
+    _MAGIC = b'BCIT'
+    _VERSION = 1
+    # magic, version, log size, log mtime (ns), record count,
+    # samples_per_ms, sys_hw_slope, sys_hw_intercept, fixed_hw_ms,
+    # raw last record.
+    _HEADER = struct.Struct('<4sLQqQdddd%ds' % BciLogData.RECORD_LEN)
+    _HEADER_LEN = 256
+    _STATE_KEYS = ['samples_per_ms', 'sys_hw_slope', 'sys_hw_intercept',
+                   'fixed_hw_ms']
+
+    @staticmethod
+    def reconstruct(filename, parsed):
+        """Returns (fixed_s_no, fixed_sys_ms) for the parsed log file.
+
+        These come from the cache if possible, which is created or updated
+        as necessary.
+        """
+        cache_filename = filename + BciTimeCache.SUFFIX
+        n = parsed.shape[0]
+        cached = BciTimeCache._read(filename, parsed)
+        if cached is not None:
+            state, times = cached
+            m = times.shape[0]
+            if m == n:
+                return times['fixed_s_no'], times['fixed_sys_ms']
+            if n <= 2 * m:
+                extended = BciTimeCache._extend(
+                    parsed[m - 1:], times[-1]['fixed_s_no'], state)
+                if extended is not None:
+                    fixed_s_no, fixed_sys_ms = extended
+                    BciTimeCache._write(cache_filename, filename, parsed,
+                                        state, fixed_s_no, fixed_sys_ms,
+                                        append_at=m)
+                    return (numpy.concatenate((times['fixed_s_no'],
+                                               fixed_s_no)),
+                            numpy.concatenate((times['fixed_sys_ms'],
+                                               fixed_sys_ms)))
+
+        fixed_s_no, fixed_sys_ms, state = BciLogData._reconstruct(parsed)
+        BciTimeCache._write(cache_filename, filename, parsed, state,
+                            fixed_s_no, fixed_sys_ms)
+        return fixed_s_no, fixed_sys_ms
+
+    @staticmethod
+    def cached_times(filename, parsed):
+        """Returns the cached times for a log, or None.
+
+        This only returns anything if the cache is complete and current; it
+        never updates the cache.  The result is a memory-mapped array of
+        `DTYPE`.
+        """
+        cached = BciTimeCache._read(filename, parsed)
+        if cached is None or cached[1].shape[0] != parsed.shape[0]:
+            return None
+        return cached[1]
+
+    @staticmethod
+    def _read(filename, parsed):
+        """Returns (state, memory-mapped times) if the cache is usable."""
+        cache_filename = filename + BciTimeCache.SUFFIX
+        try:
+            with open(cache_filename, 'rb') as f:
+                header = f.read(BciTimeCache._HEADER.size)
+            st = os.stat(filename)
+        except OSError:
+            return None
+        if len(header) != BciTimeCache._HEADER.size:
+            return None
+        fields = BciTimeCache._HEADER.unpack(header)
+        (magic, version, log_size, log_mtime_ns, m) = fields[:5]
+        last_record = fields[-1]
+        if (magic != BciTimeCache._MAGIC) or \
+           (version != BciTimeCache._VERSION) or (m < 2) or \
+           (m > parsed.shape[0]):
+            return None
+        if log_size == st.st_size:
+            if log_mtime_ns != st.st_mtime_ns:
+                return None
+        elif (log_size > st.st_size) or \
+                (parsed[m - 1:m].tobytes() != last_record):
+            return None
+        try:
+            times = numpy.memmap(cache_filename, dtype=BciTimeCache.DTYPE,
+                                 mode='r', offset=BciTimeCache._HEADER_LEN,
+                                 shape=(m,))
+        except ValueError:  # Truncated
+            return None
+        state = dict(zip(BciTimeCache._STATE_KEYS, fields[5:-1]))
+        return state, times
+
+    @staticmethod
+    def _write(cache_filename, filename, parsed, state, fixed_s_no,
+               fixed_sys_ms, append_at=None):
+        """Writes the cache, or appends to it if `append_at` is given.
+
+        `state` is updated to reflect the end of the given records.  Failure
+        to write the cache is reported, but is otherwise harmless.
+        """
+        times = numpy.empty(fixed_s_no.shape, dtype=BciTimeCache.DTYPE)
+        times['fixed_s_no'] = fixed_s_no
+        times['fixed_sys_ms'] = fixed_sys_ms
+        n = parsed.shape[0]
+        header = BciTimeCache._header(filename, state, n,
+                                      parsed[n - 1:n].tobytes())
+        try:
+            if append_at is None:
+                tmp_filename = cache_filename + '.tmp'
+                with open(tmp_filename, 'wb') as f:
+                    f.write(header)
+                    f.write(times)
+                os.replace(tmp_filename, cache_filename)
+            else:
+                # Records first, so an interrupted append leaves the old
+                # header, which still describes valid data.
+                with open(cache_filename, 'r+b') as f:
+                    f.seek(BciTimeCache._HEADER_LEN +
+                           append_at * BciTimeCache.DTYPE.itemsize)
+                    f.write(times)
+                    f.truncate()
+                    f.flush()
+                    f.seek(0)
+                    f.write(header)
+        except OSError as e:
+            print('Unable to write timestamp cache: %s' % e)
+
+    @staticmethod
+    def _header(filename, state, n, last_record):
+        """Returns the header for a cache of `n` records of a log."""
+        st = os.stat(filename)
+        return BciTimeCache._HEADER.pack(
+            BciTimeCache._MAGIC, BciTimeCache._VERSION, st.st_size,
+            st.st_mtime_ns, n,
+            *[state[k] for k in BciTimeCache._STATE_KEYS],
+            last_record).ljust(BciTimeCache._HEADER_LEN, b'\0')
+
+    @staticmethod
+    def _extend(parsed, last_fixed_s_no, state):
+        """Extends a reconstruction over records following it.
+
+        `parsed` starts with the last record already reconstructed.  Returns
+        (fixed_s_no, fixed_sys_ms) for the remaining records, updating
+        `state`, or None if the extrapolation is no longer good enough.
+        """
+        s_no = parsed['packet'][:, 0]['sample_number'].astype('int64')
+        hw_ms = parsed['packet'][:, 0]['hw_timestamp_ms']
+        sys_ms = parsed['sys_timestamp_ms'][1:]
+        samples_per_ms = state['samples_per_ms']
+
+        s_step = s_no[1:] - s_no[:-1]
+        s_step += 256 * (s_step <= 0)
+        # Fix any >256 gaps, as to_numpy does, but in one step since the
+        # sample rate is already known.
+        excess = samples_per_ms * (hw_ms[1:] - hw_ms[:-1]) - s_step - 100
+        s_step += 256 * numpy.maximum(numpy.ceil(excess / 256), 0).astype(
+            'int64')
+        fixed_s_no = last_fixed_s_no + numpy.cumsum(s_step)
+
+        fixed_hw_ms = state['fixed_hw_ms'] + numpy.cumsum(
+            s_step / samples_per_ms)
+        if not numpy.all(numpy.abs(fixed_hw_ms - hw_ms[1:]) < 5.):
+            return None
+        fixed_sys_ms = state['sys_hw_slope'] * fixed_hw_ms
+        fixed_sys_ms += state['sys_hw_intercept']
+        d_sys = fixed_sys_ms - sys_ms
+        if not (numpy.all(d_sys > -500.) and numpy.all(d_sys <= 0.)):
+            return None
+
+        state['fixed_hw_ms'] = fixed_hw_ms[-1]
+        return fixed_s_no, fixed_sys_ms
+
+
+class BciTimeEstimator:
+    """Reconstructs timestamps incrementally, as a log is being written.
+
+    This does what `BciLogData._reconstruct` does for a whole log, but a
+    batch of records at a time and using only the records seen so far, so
+    that `bci_logger.py` can write every record's timestamp as it logs it
+    (see `BciTimeCacheWriter`), and loading the log needs no reconstruction.
+
+    Sample numbers are unwrapped in the same way.  The hardware sample rate
+    is measured over the last `RATE_WINDOW_MS` of hardware time, rather than
+    over a window centered on each record, and the reconstructed hardware
+    time is steered towards the hardware timestamps with a time constant of
+    `STEER_MS`, rather than aligned with their mean over the whole log.  The
+    sys/hw slope is fitted to all of the records so far, and the intercept
+    is the one putting all of them at or before their receipt, found from
+    the lower convex hull of their (hardware, system) times.
+
+    Timestamps can be tens of ms off at first, mostly because the lowest
+    latency seen so far is well above the log's eventual lowest, but after
+    the first `SETTLE_S` seconds they agree with `to_numpy`'s for the whole
+    log to within `TOLERANCE_MS`, given realistic clock drift and network
+    latency (see bci_bench.py decode).
+    """
+    RATE_WINDOW_MS = 10000
+    STEER_MS = 1000
+    FIT_MIN_MS = 30000
+    SETTLE_S = 60
+    TOLERANCE_MS = 5.
+
+    def __init__(self):
+        self._s_no = None
+        self._hw_ms = None
+        self._fixed_s_no = None
+        self._fixed_hw_ms = None
+        self._samples_per_ms = None
+        # (fixed_s_no, hw_ms) at the end of each recent batch, for measuring
+        # the sample rate.
+        self._rate_marks = collections.deque()
+        # First system time and reconstructed hardware time, which the fit
+        # is relative to.
+        self._sys0 = None
+        self._hw0 = None
+        # Moments of the fit, merged a batch at a time.
+        self._n = 0
+        self._mean_x = 0.
+        self._mean_y = 0.
+        self._cxx = 0.
+        self._cxy = 0.
+        # 1, 2, 3, ..., for the fast path, grown as needed.
+        self._ramp = numpy.arange(1., 257.)
+        # Lower convex hull of the (hardware, system) times so far, and the
+        # slopes of its edges, which increase along it.
+        self._hull_x = []
+        self._hull_y = []
+        self._hull_slopes = []
+        # Reconstruction state at the last record, as kept by BciTimeCache.
+        self.state = None
+        self.last_sys_ms = None
+
+    def update(self, records, consecutive=False):
+        """Returns (fixed_s_no, fixed_sys_ms) for the next batch of records.
+
+        `records` are parsed records, or raw (n, RECORD_LEN) ones.  If
+        `consecutive` is True, the caller has checked that their sample
+        numbers simply count up from those of the last batch, which allows a
+        quicker path.  The system timestamp of the last record, unwrapped if
+        it has rolled over since the first, is left in `last_sys_ms`.
+        """
+        parsed = records.reshape(-1).view(BciLogData.DTYPE)
+        if self._s_no is None:
+            self._start(parsed[0])
+            consecutive = False
+        batch = None
+        sys_ms = parsed['sys_timestamp_ms']
+        if consecutive and self._samples_per_ms is not None and \
+                sys_ms[0] == sys_ms[-1]:
+            batch = self._update_consecutive(parsed)
+        if batch is None:
+            batch = self._update_any(parsed)
+        fixed_s_no, x, mean_x, mean_y, cxx, cxy, hull_xs, hull_ys = batch
+
+        # Merge the batch into the sys/hw fit.
+        m = x.shape[0]
+        delta_x = mean_x - self._mean_x
+        delta_y = mean_y - self._mean_y
+        weight = self._n * m / (self._n + m)
+        self._cxx += cxx + delta_x * delta_x * weight
+        self._cxy += cxy + delta_x * delta_y * weight
+        self._mean_x += delta_x * m / (self._n + m)
+        self._mean_y += delta_y * m / (self._n + m)
+        self._n += m
+        last_x = hull_xs[-1]
+        last_y = hull_ys[-1]
+        # Until the fit spans long enough to beat network jitter, the
+        # clocks are assumed to run at the same rate.
+        slope = self._cxy / self._cxx if last_x >= self.FIT_MIN_MS else 1.
+        for hull_x, hull_y in zip(hull_xs, hull_ys):
+            self._add_to_hull(hull_x, hull_y)
+        # The hull point lowest relative to the fit is where the hull's edge
+        # slopes pass the fit's.
+        i = bisect.bisect_left(self._hull_slopes, slope)
+        intercept = self._hull_y[i] - slope * self._hull_x[i]
+        fixed_sys_ms = x * slope
+        fixed_sys_ms += self._sys0 + intercept
+
+        self.last_sys_ms = self._sys0 + last_y
+        self.state = {
+            'samples_per_ms': self._samples_per_ms or 1.,
+            'sys_hw_slope': slope,
+            'sys_hw_intercept': self._sys0 + intercept - slope * self._hw0,
+            'fixed_hw_ms': self._fixed_hw_ms,
+        }
+        return fixed_s_no, fixed_sys_ms
+
+    def _start(self, record):
+        """Starts the reconstruction at the first record."""
+        # Scalar state is kept as python numbers, which are much quicker
+        # than numpy's for this.
+        s_no = int(record['packet'][0]['sample_number'])
+        hw_ms = int(record['packet'][0]['hw_timestamp_ms'])
+        # As if just after the sample before the first.
+        self._s_no = s_no - 1
+        self._fixed_s_no = s_no - 1
+        self._hw_ms = hw_ms
+        self._fixed_hw_ms = float(hw_ms)
+        self._rate_marks.append((s_no, hw_ms))
+        self._sys0 = int(record['sys_timestamp_ms'])
+        self._hw0 = float(hw_ms)
+
+    def _update_any(self, parsed):
+        """Reconstructs any batch of records.
+
+        Returns (fixed_s_no, x, mean x, mean y, cxx, cxy, hull x, hull y)
+        for the batch, where x and y are the reconstructed hardware and the
+        system times relative to the first record's, cxx and cxy are the
+        batch's own moments about its means, and the hull x and y are those
+        of the points that might be on the lower convex hull.
+        """
+        packet = parsed['packet'][:, 0]
+        s_no = packet['sample_number'].astype('int64')
+        hw_ms = packet['hw_timestamp_ms'].astype('int64')
+        m = s_no.shape[0]
+
+        s_step = numpy.empty_like(s_no)
+        s_step[0] = s_no[0] - self._s_no
+        numpy.subtract(s_no[1:], s_no[:-1], out=s_step[1:])
+        s_step += 256 * (s_step <= 0)
+        if self._samples_per_ms is not None:
+            # Fix any >256 gaps, as BciTimeCache._extend does.
+            d_hw_ms = numpy.empty_like(hw_ms)
+            d_hw_ms[0] = hw_ms[0] - self._hw_ms
+            numpy.subtract(hw_ms[1:], hw_ms[:-1], out=d_hw_ms[1:])
+            excess = self._samples_per_ms * d_hw_ms - s_step - 100
+            if excess.max() > 0:
+                s_step += 256 * numpy.maximum(
+                    numpy.ceil(excess / 256), 0).astype('int64')
+        steps = numpy.cumsum(s_step)
+        fixed_s_no = steps + self._fixed_s_no
+        self._s_no = int(s_no[-1])
+        self._hw_ms = int(hw_ms[-1])
+        self._fixed_s_no = int(fixed_s_no[-1])
+        self._measure_rate()
+
+        if self._samples_per_ms is None:
+            x = hw_ms - self._hw0
+        else:
+            x = steps / self._samples_per_ms
+            x += self._fixed_hw_ms - self._hw0
+            x += self._steer(hw_ms, float(x.sum()) / m)
+        self._fixed_hw_ms = self._hw0 + float(x[-1])
+
+        sys_ms = parsed['sys_timestamp_ms'].astype('int64')
+        y = sys_ms - (self._sys0 - (1 << 31))
+        y &= 0xFFFFFFFF
+        y = y.astype('float64') - (1 << 31)
+        mean_x = float(x.sum()) / m
+        mean_y = float(y.sum()) / m
+        dx = x - mean_x
+        # Only the last record received at each time can be on the hull.
+        last = numpy.append(numpy.flatnonzero(y[1:] != y[:-1]), m - 1)
+        return (fixed_s_no, x, mean_x, mean_y, float(numpy.dot(dx, dx)),
+                float(numpy.dot(dx, y - mean_y)), x[last].tolist(),
+                y[last].tolist())
+
+    def _update_consecutive(self, parsed):
+        """Reconstructs a batch of consecutive samples, all received at once.
+
+        Returns the same as `_update_any`, but works the batch's moments out
+        directly, or returns None if the batch might hide a >256 sample gap
+        after all.
+        """
+        m = parsed.shape[0]
+        hw_ms = parsed['packet'][:, 0]['hw_timestamp_ms']
+        last_hw_ms = int(hw_ms[-1])
+        # A >256 sample gap anywhere in the batch would show as that many
+        # samples' worth of hardware time more than the batch spans.
+        if self._samples_per_ms * (last_hw_ms - self._hw_ms) - m > 100 or \
+                last_hw_ms < self._hw_ms:
+            return None
+
+        fixed_s_no = numpy.arange(self._fixed_s_no + 1,
+                                  self._fixed_s_no + m + 1)
+        self._s_no = (self._s_no + m) & 0xFF
+        self._hw_ms = last_hw_ms
+        self._fixed_s_no += m
+        self._measure_rate()
+
+        period = 1. / self._samples_per_ms
+        start = self._fixed_hw_ms - self._hw0
+        start += self._steer(hw_ms, start + period * (m + 1) / 2)
+        if self._ramp.shape[0] < m:
+            self._ramp = numpy.arange(1., m + 1.)
+        x = self._ramp[:m] * period
+        x += start
+        last_x = start + m * period
+        self._fixed_hw_ms = self._hw0 + last_x
+
+        y = int(parsed[0]['sys_timestamp_ms']) - self._sys0
+        y = float(((y + (1 << 31)) & 0xFFFFFFFF) - (1 << 31))
+        return (fixed_s_no, x, start + period * (m + 1) / 2, y,
+                period * period * m * (m * m - 1) / 12, 0., (last_x,), (y,))
+
+    def _measure_rate(self):
+        """Measures the sample rate over the last RATE_WINDOW_MS."""
+        marks = self._rate_marks
+        marks.append((self._fixed_s_no, self._hw_ms))
+        while len(marks) > 2 and \
+                marks[1][1] <= self._hw_ms - self.RATE_WINDOW_MS:
+            marks.popleft()
+        if self._hw_ms > marks[0][1]:
+            self._samples_per_ms = (self._fixed_s_no - marks[0][0]) / \
+                (self._hw_ms - marks[0][1])
+
+    def _steer(self, hw_ms, mean_x):
+        """Returns the correction to steer a batch, whose reconstructed
+        hardware times have mean `mean_x`, towards its hardware times."""
+        gain = min(max(int(hw_ms[-1]) - int(hw_ms[0]), 1) / self.STEER_MS,
+                   1.)
+        return gain * (int(hw_ms.sum(dtype='int64')) / hw_ms.shape[0] -
+                       self._hw0 - mean_x)
+
+    def _add_to_hull(self, x, y):
+        hull_x = self._hull_x
+        hull_y = self._hull_y
+        slopes = self._hull_slopes
+        while len(hull_x) > 1 and \
+                (hull_x[-1] - hull_x[-2]) * (y - hull_y[-2]) <= \
+                (hull_y[-1] - hull_y[-2]) * (x - hull_x[-2]):
+            hull_x.pop()
+            hull_y.pop()
+            slopes.pop()
+        if hull_x:
+            slopes.append((y - hull_y[-1]) / (x - hull_x[-1])
+                          if x > hull_x[-1] else math.inf)
+        hull_x.append(x)
+        hull_y.append(y)
+
+
+class BciTimeCacheWriter:
+    """Writes a BciTimeCache incrementally, as a log is being written.
+
+    The times written are those of a `BciTimeEstimator`.  The header, which
+    keys the cache to the size and mtime of the log, is only written by
+    `flush` and `close`, which must each follow the flush or close of the
+    log itself.  If logging stops without a `close`, loading the log
+    extends the cache over the records logged since the last `flush`, as it
+    would for any log that has grown.
+    """
+
+    def __init__(self, log_filename):
+        self._log_filename = log_filename
+        self._file = open(log_filename + BciTimeCache.SUFFIX, 'xb')
+        # Not recognised as a cache until the first flush.
+        self._file.write(bytes(BciTimeCache._HEADER_LEN))
+        self._records = 0
+        self._state = None
+        self._last_record = None
+
+    def add(self, records, fixed_s_no, fixed_sys_ms, state):
+        """Accounts for raw `records` written, with their reconstructed
+        times and the estimator's state after them."""
+        times = numpy.empty(fixed_s_no.shape, dtype=BciTimeCache.DTYPE)
+        times['fixed_s_no'] = fixed_s_no
+        times['fixed_sys_ms'] = fixed_sys_ms
+        self._file.write(times)
+        self._records += times.shape[0]
+        self._state = state
+        self._last_record = bytes(
+            memoryview(records).cast('B')[-BciLogData.RECORD_LEN:])
+
+    def flush(self):
+        self._file.flush()
+        if self._records < 2:
+            return
+        self._file.seek(0)
+        self._file.write(BciTimeCache._header(
+            self._log_filename, self._state, self._records,
+            self._last_record))
+        self._file.seek(0, os.SEEK_END)
+        self._file.flush()
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+class BciLogIndex:
+    """Sparse index from full epoch time to record number in a log.
+
+    This is kept next to the log, with `SUFFIX` appended to its name.  The
+    log itself only stores the lower 32 bits of each timestamp, which roll
+    over every 49.7 days; the index stores the full 64 bit epoch time in ms
+    of every `interval`th record, so that finding a time in the log is a
+    binary search of the index plus a single read of at most `interval`
+    records.  `bci_logger.py` writes an index as it logs, and `bci_index.py`
+    can build one for an existing log.
+    """
+    SUFFIX = '.bcix'
+    DTYPE = numpy.dtype([('epoch_ms', '<i8'), ('record', '<i8')])
+    DEFAULT_INTERVAL = 1000
+    _MAGIC = b'BCIX'
+    _VERSION = 1
+    # magic, version, interval
+    _HEADER = struct.Struct('<4sLQ')
+
+    def __init__(self, entries, interval):
+        self.entries = entries
+        self.interval = interval
+
+    @staticmethod
+    def load(log_filename):
+        """Returns the index for a log, or None if it doesn't have one."""
+        try:
+            with open(log_filename + BciLogIndex.SUFFIX, 'rb') as f:
+                header = f.read(BciLogIndex._HEADER.size)
+                data = f.read()
+        except OSError:
+            return None
+        if len(header) != BciLogIndex._HEADER.size:
+            return None
+        magic, version, interval = BciLogIndex._HEADER.unpack(header)
+        if (magic != BciLogIndex._MAGIC) or \
+           (version != BciLogIndex._VERSION) or (interval < 1):
+            return None
+        # Ignore any partial entry at the end, e.g. if the logger crashed.
+        n = len(data) // BciLogIndex.DTYPE.itemsize
+        return BciLogIndex(
+            numpy.frombuffer(data, dtype=BciLogIndex.DTYPE, count=n),
+            interval)
+
+    @staticmethod
+    def build(records, interval=DEFAULT_INTERVAL, reference_ms=None):
+        """Builds an index for existing parsed (or memory-mapped) records.
+
+        The log only holds the lower 32 bits of its timestamps, so the rest
+        are taken from `reference_ms`, a full epoch time in ms which should
+        be within 24 days of the end of the log.  It is usually the mtime of
+        the log file.  Only every `interval`th record is read.
+        """
+        idxs = numpy.arange(0, records.shape[0], interval)
+        entries = numpy.empty(idxs.shape, dtype=BciLogIndex.DTYPE)
+        if not idxs.shape[0]:
+            return BciLogIndex(entries, interval)
+        low_ms = records['sys_timestamp_ms'][::interval].astype('int64')
+        last_ms = BciLogIndex.unwrap_ms(int(low_ms[-1]), reference_ms)
+        entries['epoch_ms'] = last_ms - ((low_ms[-1] - low_ms) & 0xFFFFFFFF)
+        entries['record'] = idxs
+        return BciLogIndex(entries, interval)
+
+    def write(self, log_filename, overwrite=False):
+        with open(log_filename + BciLogIndex.SUFFIX,
+                  'wb' if overwrite else 'xb') as f:
+            f.write(BciLogIndex._header(self.interval))
+            f.write(self.entries)
+
+    def find(self, records, t):
+        """Returns the index of the first record received at or after `t`.
+
+        `t` is a full epoch time in seconds, and `records` the parsed (or
+        memory-mapped) records of the indexed log.
+        """
+        t_ms = int(math.floor(t * 1e3))
+        # The last entry strictly before `t`, since records ahead of an
+        # entry with the same ms, from the same datagram, may be the ones
+        # sought.
+        k = numpy.searchsorted(self.entries['epoch_ms'], t_ms,
+                               side='left') - 1
+        if k < 0:
+            return 0
+        start = int(self.entries['record'][k])
+        base_ms = int(self.entries['epoch_ms'][k])
+        low_ms = records['sys_timestamp_ms'][
+            start:start + self.interval + 1].astype('int64')
+        full_ms = base_ms + ((low_ms - base_ms) & 0xFFFFFFFF)
+        return start + int(numpy.searchsorted(full_ms, t_ms))
+
+    @staticmethod
+    def _header(interval):
+        return BciLogIndex._HEADER.pack(
+            BciLogIndex._MAGIC, BciLogIndex._VERSION, interval)
+
+    @staticmethod
+    def unwrap_ms(low_ms, reference_ms):
+        """Returns the full epoch time in ms closest to `reference_ms` whose
+        lower 32 bits are `low_ms`."""
+        delta_ms = low_ms - reference_ms
+        return reference_ms + \
+            ((delta_ms + (1 << 31)) & 0xFFFFFFFF) - (1 << 31)
+
+
+class BciLogIndexWriter:
+    """Writes a BciLogIndex incrementally, as a log is being written."""
+
+    def __init__(self, log_filename, interval=BciLogIndex.DEFAULT_INTERVAL):
+        self._file = open(log_filename + BciLogIndex.SUFFIX, 'xb')
+        self._file.write(BciLogIndex._header(interval))
+        self._interval = interval
+        self._records = 0
+
+    def add(self, n_records, epoch_ms):
+        """Accounts for `n_records` written, all with time `epoch_ms`."""
+        first = -(-self._records // self._interval) * self._interval
+        self._records += n_records
+        if first < self._records:
+            idxs = numpy.arange(first, self._records, self._interval)
+            entries = numpy.empty(idxs.shape, dtype=BciLogIndex.DTYPE)
+            entries['epoch_ms'] = epoch_ms
+            entries['record'] = idxs
+            self._file.write(entries)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class BciLogManifest:
+    """The segments making up a log that was split as it was written.
+
+    `bci_logger.py` can rotate to a new segment file every so many bytes or
+    seconds.  A log named e.g. session.bci is then written as segments
+    session.0000.bci, session.0001.bci, etc, each of them an ordinary log,
+    and this manifest of them is kept in session.bcim.  It is json, listing
+    for each segment in order its file name (relative to the manifest),
+    record count, the sample numbers and 32 bit system timestamps of its
+    first and last records, and the full epoch times in ms at which those
+    were received.  The manifest is rewritten as each segment is started and
+    finished, so if the logger is interrupted only the details of the last
+    segment are missing (as None), and `BciLogData.load_segments` reads
+    those from the segment itself.
+    """
+    SUFFIX = '.bcim'
+    _VERSION = 1
+    _SEGMENT_FORMAT = '%s.%04d.bci'
+
+    def __init__(self, segments=None):
+        self.segments = segments if segments is not None else []
+
+    @staticmethod
+    def filename(log_filename):
+        """Returns the manifest file name for a segmented log."""
+        return os.path.splitext(log_filename)[0] + BciLogManifest.SUFFIX
+
+    @staticmethod
+    def segment_filename(log_filename, i):
+        """Returns the file name of segment `i` of a segmented log."""
+        return BciLogManifest._SEGMENT_FORMAT % (
+            os.path.splitext(log_filename)[0], i)
+
+    @staticmethod
+    def load(log_filename):
+        """Loads the manifest of a segmented log.
+
+        `log_filename` may name either the log or its manifest.
+        """
+        with open(BciLogManifest.filename(log_filename)) as f:
+            manifest = json.load(f)
+        assert manifest['version'] == BciLogManifest._VERSION
+        return BciLogManifest(manifest['segments'])
+
+    def write(self, log_filename):
+        """Writes the manifest, atomically replacing any previous one."""
+        filename = BciLogManifest.filename(log_filename)
+        with open(filename + '.tmp', 'w') as f:
+            json.dump({'version': BciLogManifest._VERSION,
+                       'segments': self.segments}, f, indent=1)
+        os.replace(filename + '.tmp', filename)
+
+    def segment_files(self, log_filename):
+        """Returns the paths of the segments, in order."""
+        directory = os.path.dirname(BciLogManifest.filename(log_filename))
+        return [os.path.join(directory, segment['file'])
+                for segment in self.segments]
+
+
+class BciLogV2:
+    """Constants and functions for the block-compressed (v2) log format.
+
+    A v2 log holds exactly the same records as a v1 log, which is a bare
+    array of `BciLogData.DTYPE`, but stores them in independently compressed
+    blocks of `block_records` records each (the last block may be shorter):
+
+      file header:  magic, version, block_records
+      each block:   block header, then a zlib compressed payload
+
+    A block header holds the 32 bit system timestamp and the unwrapped
+    sample number of the block's first record, its record count, and the
+    length and CRC-32 of its payload.  Sample numbers are unwrapped simply
+    by counting modulo 256 from the start of the log, so gaps of more than
+    256 samples are not accounted for; `BciLogData.to_numpy` still works
+    that out.
+
+    The payload stores each field of the block's records as a column.
+    System timestamps, first packet sample numbers and hardware timestamps,
+    and channel readings are stored as deltas from the previous record;
+    the second packet's sample number and hardware timestamp as deltas from
+    the first's; and aux and stop bytes as they are.  Start bytes are
+    implied.  Each column is byte-shuffled, so the mostly constant high
+    bytes of the deltas are grouped together for the compressor.
+    """
+    MAGIC = b'BCI2'
+    VERSION = 2
+    # About 2s at 2kHz.
+    DEFAULT_BLOCK_RECORDS = 4096
+    # magic, version, block_records.  The version's low byte sits where a
+    # v1 log has its first start byte, so the two can't be confused.
+    HEADER = struct.Struct('<4sLL')
+    # first sys_timestamp_ms, first unwrapped sample number, record count,
+    # payload length, payload CRC-32
+    BLOCK_HEADER = struct.Struct('<LqLLL')
+    # (dtype, values per record) of each payload column, in order.
+    _COLUMNS = [
+        ('<u4', 1),   # sys_timestamp_ms delta
+        ('u1', 1),    # Packet 0 sample_number delta
+        ('u1', 1),    # Packet 1 sample_number - packet 0's
+        ('<u4', 1),   # Packet 0 hw_timestamp_ms delta
+        ('<u4', 1),   # Packet 1 hw_timestamp_ms - packet 0's
+        ('<i4', 16),  # Channel reading deltas
+        ('u1', 4),    # aux
+        ('u1', 2),    # stop_byte
+    ]
+    _COMPRESS_LEVEL = 6
+
+    @staticmethod
+    def is_v2(data):
+        """Returns whether `data`, the start of a log, is in v2 format."""
+        head = bytes(data[:BciLogV2.HEADER.size])
+        return len(head) == BciLogV2.HEADER.size and \
+            head[:4] == BciLogV2.MAGIC and head[4] != BciData.START_BYTE
+
+    @staticmethod
+    def header(block_records):
+        return BciLogV2.HEADER.pack(
+            BciLogV2.MAGIC, BciLogV2.VERSION, block_records)
+
+    @staticmethod
+    def encode_block(data, first_sample):
+        """Returns a block (header and payload) holding v1 record bytes.
+
+        `first_sample` is the unwrapped sample number of the first record.
+        """
+        parsed = numpy.frombuffer(data, dtype=BciLogData.DTYPE)
+        n = parsed.shape[0]
+        pkt = parsed['packet']
+        if not numpy.all(pkt['start_byte'] == BciData.START_BYTE):
+            raise ValueError('Record without a start byte')
+        sys_ms = parsed['sys_timestamp_ms'].astype('<u4')
+        s_no = pkt['sample_number']
+        hw_ms = pkt['hw_timestamp_ms'].astype('<u4')
+        channels = BciLogData._channel_data(parsed)
+        columns = [
+            numpy.diff(sys_ms, prepend=sys_ms[:1]),
+            numpy.diff(s_no[:, 0], prepend=s_no[:1, 0]),
+            s_no[:, 1] - s_no[:, 0],
+            numpy.diff(hw_ms[:, 0], prepend=numpy.zeros(1, dtype='<u4')),
+            hw_ms[:, 1] - hw_ms[:, 0],
+            numpy.diff(channels, axis=0,
+                       prepend=numpy.zeros((1, 16), dtype='int32')),
+            pkt['aux'],
+            pkt['stop_byte'],
+        ]
+        payload = zlib.compress(b''.join(
+            numpy.ascontiguousarray(c, dtype=dtype).reshape(n, -1).view(
+                'B').T.tobytes()
+            for c, (dtype, _) in zip(columns, BciLogV2._COLUMNS)),
+            BciLogV2._COMPRESS_LEVEL)
+        return BciLogV2.BLOCK_HEADER.pack(
+            int(sys_ms[0]), first_sample, n, len(payload),
+            zlib.crc32(payload)) + payload
+
+    @staticmethod
+    def decode_block(header, payload):
+        """Returns the records of a block, given its unpacked header."""
+        sys_ms, first_sample, n, _, crc = header
+        if zlib.crc32(payload) != crc:
+            raise ValueError('Corrupt v2 log block')
+        raw = numpy.frombuffer(zlib.decompress(payload), dtype='B')
+        columns = []
+        pos = 0
+        for dtype, width in BciLogV2._COLUMNS:
+            size = n * width * numpy.dtype(dtype).itemsize
+            columns.append(raw[pos:pos + size].reshape((-1, n)).T.copy().view(
+                dtype).reshape((n, width)))
+            pos += size
+        if pos != raw.shape[0]:
+            raise ValueError('Corrupt v2 log block')
+        (d_sys, d_s_no, s_no_1, d_hw, hw_1, d_channels, aux, stop) = columns
+
+        parsed = numpy.empty(n, dtype=BciLogData.DTYPE)
+        pkt = parsed['packet']
+        parsed['sys_timestamp_ms'] = numpy.cumsum(d_sys[:, 0], dtype='<u4') \
+            + numpy.uint32(sys_ms)
+        s_no_0 = numpy.cumsum(d_s_no[:, 0], dtype='B') + \
+            numpy.uint8(first_sample & 0xFF)
+        pkt['start_byte'] = BciData.START_BYTE
+        pkt['sample_number'][:, 0] = s_no_0
+        pkt['sample_number'][:, 1] = s_no_0 + s_no_1[:, 0]
+        channels = numpy.cumsum(d_channels, axis=0, dtype='int32').reshape(
+            (n, 2, 8))
+        pkt['channel_data']['h8'] = channels >> 16
+        pkt['channel_data']['l16'] = channels & 0xFFFF
+        pkt['aux'] = aux.reshape((n, 2, 2))
+        hw_0 = numpy.cumsum(d_hw[:, 0], dtype='<u4')
+        pkt['hw_timestamp_ms'][:, 0] = hw_0
+        pkt['hw_timestamp_ms'][:, 1] = hw_0 + hw_1[:, 0]
+        pkt['stop_byte'] = stop
+        return parsed
+
+    @staticmethod
+    def map_file(f):
+        """Returns the contents of an open log file as a buffer.
+
+        The file is memory-mapped if possible, else read.
+        """
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+            f.seek(0)
+            return f.read()
+
+
+class BciLogV2Records:
+    """Random access to the records of a v2 log, as if it were an array.
+
+    `data` is the contents of the log, e.g. as from `BciLogV2.map_file`.
+    Indexing with an int or slice decodes only the blocks needed, returning
+    records as a `BciLogData.DTYPE` array; larger reads decode blocks in
+    parallel.  Indexing with a field name gives an object which can be
+    indexed the same way to get just that field.  Any partial block at the
+    end of the log, e.g. from a log still being written, is ignored.
+    """
+    # Reads spanning at least this many blocks are decoded in parallel.
+    _PARALLEL_BLOCKS = 8
+
+    def __init__(self, data):
+        self._data = data
+        _, _, self.block_records = BciLogV2.HEADER.unpack_from(data)
+        headers = []
+        offsets = []
+        pos = BciLogV2.HEADER.size
+        end = len(data)
+        while pos + BciLogV2.BLOCK_HEADER.size <= end:
+            header = BciLogV2.BLOCK_HEADER.unpack_from(data, pos)
+            pos += BciLogV2.BLOCK_HEADER.size
+            if pos + header[3] > end:
+                break
+            headers.append(header)
+            offsets.append(pos)
+            pos += header[3]
+        self._headers = headers
+        self._offsets = offsets
+        # Index of the first record of each block, plus the total.
+        self._starts = numpy.concatenate(
+            ([0], numpy.cumsum([h[2] for h in headers], dtype='int64')))
+        self.shape = (int(self._starts[-1]),)
+        self._cached = (None, None)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return _BciLogV2Field(self, key)
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return self[start:stop][::step]
+            return self._read(start, max(stop, start))
+        idx = range(len(self))[key]
+        return self._read(idx, idx + 1)[0]
+
+    def block_headers(self):
+        """Returns the unpacked header of each block."""
+        return list(self._headers)
+
+    def _read(self, start, stop):
+        b0 = int(numpy.searchsorted(self._starts, start, side='right')) - 1
+        b1 = int(numpy.searchsorted(self._starts, stop, side='left'))
+        blocks = range(max(b0, 0), min(b1, len(self._headers)))
+        if not blocks:
+            return numpy.empty(0, dtype=BciLogData.DTYPE)
+        if len(blocks) >= self._PARALLEL_BLOCKS:
+            with concurrent.futures.ThreadPoolExecutor() as executor:
+                parsed = list(executor.map(self._decode, blocks))
+        else:
+            parsed = [self._block(b) for b in blocks]
+        offset = int(self._starts[blocks[0]])
+        # The dtype must be given, or the result could be in native byte
+        # order.
+        return numpy.concatenate(parsed, dtype=BciLogData.DTYPE)[
+            start - offset:stop - offset]
+
+    def _block(self, b):
+        """Decodes block `b`, remembering the last one decoded."""
+        if self._cached[0] != b:
+            self._cached = (b, self._decode(b))
+        return self._cached[1]
+
+    def _decode(self, b):
+        header = self._headers[b]
+        pos = self._offsets[b]
+        return BciLogV2.decode_block(
+            header, self._data[pos:pos + header[3]])
+
+
+class _BciLogV2Field:
+    """A single field of `BciLogV2Records`."""
+
+    def __init__(self, records, name):
+        self._records = records
+        self._name = name
+        self.shape = records.shape
+
+    def __len__(self):
+        return len(self._records)
+
+    def __getitem__(self, key):
+        return self._records[key][self._name]
+
+
+class BciLogV2Writer:
+    """Writes records to a v2 log file, a block at a time.
+
+    `f` is a binary file object open for writing at the start of a new log.
+    Records are buffered until a block is full, so up to a block of them are
+    lost if the writer isn't closed.  With `jobs` greater than 1, blocks are
+    compressed by that many worker processes.
+    """
+
+    def __init__(self, f, block_records=BciLogV2.DEFAULT_BLOCK_RECORDS,
+                 jobs=1):
+        self._f = f
+        self._block_len = block_records * BciLogData.RECORD_LEN
+        self._buf = bytearray()
+        self._last_sample = None
+        self._last_s_no = None
+        self._jobs = jobs
+        self._executor = concurrent.futures.ProcessPoolExecutor(jobs) \
+            if jobs > 1 else None
+        self._pending = collections.deque()
+        f.write(BciLogV2.header(block_records))
+
+    def write(self, records):
+        """Writes v1 records, as bytes or as a numpy array."""
+        self._buf += memoryview(records).cast('B')
+        if len(self._buf) < self._block_len:
+            return
+        n = len(self._buf) // self._block_len * self._block_len
+        for pos in range(0, n, self._block_len):
+            self._write_block(bytes(self._buf[pos:pos + self._block_len]))
+        del self._buf[:n]
+
+    def close(self):
+        """Writes any partial block.  The file itself is left open."""
+        if self._buf:
+            self._write_block(bytes(self._buf))
+            self._buf = bytearray()
+        while self._pending:
+            self._f.write(self._pending.popleft().result())
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _write_block(self, data):
+        s_no = numpy.frombuffer(data, dtype='B')[
+            BciLogData.TIMESTAMP_SIZE + 1::BciLogData.RECORD_LEN]
+        if self._last_sample is None:
+            first = int(s_no[0])
+        else:
+            first = self._last_sample + ((int(s_no[0]) - self._last_s_no) &
+                                         0xFF)
+        self._last_sample = first + int(numpy.sum(numpy.diff(s_no)))
+        self._last_s_no = int(s_no[-1])
+
+        if self._executor is None:
+            self._f.write(BciLogV2.encode_block(data, first))
+            return
+        self._pending.append(
+            self._executor.submit(BciLogV2.encode_block, data, first))
+        while len(self._pending) > 2 * self._jobs:
+            self._f.write(self._pending.popleft().result())
+
+
+class _BciLogStream:
+    """Implementation of BciLogData.iter_numpy.
+
+    This repeats the reconstruction steps of `to_numpy`, with each step
+    turned into a pass over the file that carries its state from one chunk to
+    the next:
+     1. Unwrap sample numbers, repeated as long as >256 sample gaps are being
+        fixed.
+     2. Reconstruct the hardware time index from the sliding sample rate
+        estimate, accumulating its mean offset and the sys/hw regression.
+     3. Find the minimum latency intercept of the system timestamps.
+     4. Decode, yielding results.
+    """
+
+    def __init__(self, f, chunk_records):
+        self._f = f
+        self._chunk_records = chunk_records
+        self._gap_steps = numpy.empty(0, dtype='int64')
+
+        f.seek(0)
+        if BciLogV2.is_v2(f.read(BciLogV2.HEADER.size)):
+            self._v2 = BciLogV2Records(BciLogV2.map_file(f))
+            self._n = len(self._v2)
+        else:
+            self._v2 = None
+            f.seek(0, 2)
+            size = f.tell()
+            assert size % BciLogData.RECORD_LEN == 0
+            self._n = size // BciLogData.RECORD_LEN
+        ends = numpy.concatenate(
+            (self._read(0, 1), self._read(self._n - 1, 1)))
+        sys_ms = ends['sys_timestamp_ms']
+        hw_ms = ends['packet'][:, 0]['hw_timestamp_ms']
+        sys_elapsed_ms = int(sys_ms[-1]) - int(sys_ms[0])
+        hw_elapsed_ms = int(hw_ms[-1]) - int(hw_ms[0])
+        assert sys_elapsed_ms > 0  # TODO(bmartin) This could wrap
+        assert hw_elapsed_ms > 0   # This shouldn't wrap
+        assert hw_elapsed_ms > 0.8 * sys_elapsed_ms
+        assert hw_elapsed_ms < 1.2 * sys_elapsed_ms
+
+        samples_per_ms = None
+        n_samples, _ = self._unwrap_pass(samples_per_ms, validate=True)
+        while True:
+            assert self._n > 0.9 * n_samples
+            assert self._n < 1.1 * n_samples
+            samples_per_ms = n_samples / hw_elapsed_ms
+            n_samples, gaps = self._unwrap_pass(samples_per_ms)
+            if not gaps.size:
+                break
+            print('Fixing >256 gap')
+            self._gap_steps = numpy.sort(
+                numpy.concatenate((self._gap_steps, gaps)))
+        self._samples_per_ms = samples_per_ms
+        self._rate_interval = int(round(10000 * samples_per_ms))
+
+        # Running totals for the mean hw offset, and for the regression of
+        # sys_ms against fixed_hw_ms, which are merged chunk by chunk.
+        hw_offset_sum = 0.
+        n = 0
+        mean_x = mean_y = sxx = sxy = 0.
+        for parsed, _, fixed_hw_ms in self._fixed_chunks():
+            hw_ms = parsed['packet'][:, 0]['hw_timestamp_ms']
+            sys_ms = parsed['sys_timestamp_ms']
+            hw_offset_sum += numpy.sum(hw_ms - fixed_hw_ms)
+
+            n_b = fixed_hw_ms.shape[0]
+            mean_xb = numpy.mean(fixed_hw_ms)
+            mean_yb = numpy.mean(sys_ms)
+            dx = fixed_hw_ms - mean_xb
+            sxx_b = numpy.dot(dx, dx)
+            sxy_b = numpy.dot(dx, sys_ms - mean_yb)
+            total = n + n_b
+            delta_x = mean_xb - mean_x
+            delta_y = mean_yb - mean_y
+            sxx += sxx_b + delta_x * delta_x * n * n_b / total
+            sxy += sxy_b + delta_x * delta_y * n * n_b / total
+            mean_x += delta_x * n_b / total
+            mean_y += delta_y * n_b / total
+            n = total
+        self._hw_offset = hw_offset_sum / self._n
+        self._sys_hw_slope = sxy / sxx
+
+        self._sys_hw_intercept = numpy.inf
+        for parsed, _, fixed_hw_ms in self._fixed_chunks():
+            hw_ms = parsed['packet'][:, 0]['hw_timestamp_ms']
+            sys_ms = parsed['sys_timestamp_ms']
+            fixed_hw_ms += self._hw_offset
+            d_hw = fixed_hw_ms - hw_ms
+            assert numpy.all(numpy.abs(d_hw) < 5.)
+            self._sys_hw_intercept = min(
+                self._sys_hw_intercept,
+                numpy.min(sys_ms - self._sys_hw_slope * fixed_hw_ms))
+
+    def decode(self):
+        for parsed, _, fixed_hw_ms in self._fixed_chunks():
+            sys_ms = parsed['sys_timestamp_ms']
+            fixed_hw_ms += self._hw_offset
+            fixed_sys_ms = self._sys_hw_slope * fixed_hw_ms
+            fixed_sys_ms += self._sys_hw_intercept
+            d_sys = fixed_sys_ms - sys_ms
+            assert numpy.all(d_sys > -500.)
+            assert numpy.all(d_sys <= 0.)
+
+            yield numpy.concatenate(
+                (numpy.expand_dims(fixed_sys_ms * 1e-3, axis=1),
+                 BciLogData._channel_data(parsed)),
+                axis=1)
+
+    def _read(self, start, count):
+        if self._v2 is not None:
+            return self._v2[start:start + count]
+        self._f.seek(start * BciLogData.RECORD_LEN)
+        return numpy.frombuffer(
+            self._f.read(count * BciLogData.RECORD_LEN),
+            dtype=BciLogData.DTYPE)
+
+    def _chunks(self):
+        """Yields (index of first record, parsed records) for each chunk."""
+        for start in range(0, self._n, self._chunk_records):
+            yield start, self._read(
+                start, min(self._chunk_records, self._n - start))
+
+    def _steps(self, start, s_no, hw_ms, prev):
+        """Returns unwrapped sample number steps within a chunk.
+
+        The result is (index of first step, s_step, hw_ms step), where step i
+        is the one leading up to record i.  `prev` holds the (s_no, hw_ms) of
+        the last record of the previous chunk, or None for the first chunk.
+        """
+        if prev is not None:
+            s_no = numpy.concatenate((prev[0], s_no))
+            hw_ms = numpy.concatenate((prev[1], hw_ms))
+        else:
+            start += 1
+        s_step = s_no[1:] - s_no[:-1]
+        s_step += 256 * (s_step <= 0)
+        lo, hi = numpy.searchsorted(
+            self._gap_steps, [start, start + s_step.shape[0]])
+        numpy.add.at(s_step, self._gap_steps[lo:hi] - start, 256)
+        return start, s_step, hw_ms[1:] - hw_ms[:-1]
+
+    def _unwrap_pass(self, samples_per_ms, validate=False):
+        """Unwraps sample numbers given the current set of >256 gaps.
+
+        If `samples_per_ms` is given, this also looks for additional gaps
+        implied by the hardware timestamps at that rate.  Returns the number
+        of samples spanned once any such gaps are fixed, and the step indexes
+        of those gaps.
+        """
+        n_samples = 0
+        gaps = []
+        prev = None
+        for start, parsed in self._chunks():
+            if validate:
+                BciLogData._validate(parsed)
+            s_no = parsed['packet'][:, 0]['sample_number'].astype('int64')
+            hw_ms = parsed['packet'][:, 0]['hw_timestamp_ms']
+            first, s_step, hw_step = self._steps(start, s_no, hw_ms, prev)
+            prev = (s_no[-1:], hw_ms[-1:])
+            n_samples += numpy.sum(s_step)
+            if samples_per_ms is not None:
+                hw_gaps = (samples_per_ms * hw_step - s_step) > 100
+                n_samples += 256 * numpy.sum(hw_gaps)
+                gaps.append(first + numpy.flatnonzero(hw_gaps))
+        if not gaps:
+            return n_samples, self._gap_steps[:0]
+        return n_samples, numpy.concatenate(gaps)
+
+    def _fixed_chunks(self):
+        """Yields (parsed, fixed_s_no, fixed_hw_ms) for each chunk.
+
+        fixed_hw_ms does not yet include the mean hw offset.  The sliding
+        sample rate estimate needs up to half of its window beyond the end
+        of a chunk, so chunks are held back until enough data has been read.
+        """
+        n = self._n
+        r = self._rate_interval
+        windowed = n > r
+        # Unwrapped sample numbers and hw timestamps for the sliding rate
+        # estimate, starting at record hist_start.
+        hist_s = numpy.empty(0, dtype='int64')
+        hist_hw = numpy.empty(0, dtype='>u4')
+        hist_start = 0
+        pending = collections.deque()
+        prev = None
+        last_fixed_s_no = None
+        # Of the last record yielded.
+        p_prev_fixed_s_no = None
+        last_fixed_hw_ms = 0.
+
+        def window_start(i):
+            return numpy.clip(i - r // 2, 0, n - r - 1)
+
+        for start, parsed in self._chunks():
+            s_no = parsed['packet'][:, 0]['sample_number'].astype('int64')
+            hw_ms = parsed['packet'][:, 0]['hw_timestamp_ms']
+            _, s_step, _ = self._steps(start, s_no, hw_ms, prev)
+            prev = (s_no[-1:], hw_ms[-1:])
+            if last_fixed_s_no is None:
+                fixed_s_no = s_no[0] + numpy.cumsum(numpy.insert(s_step, 0, 0))
+            else:
+                fixed_s_no = last_fixed_s_no + numpy.cumsum(s_step)
+            last_fixed_s_no = fixed_s_no[-1]
+
+            pending.append((start, parsed, fixed_s_no))
+            if windowed:
+                hist_s = numpy.concatenate((hist_s, fixed_s_no))
+                hist_hw = numpy.concatenate((hist_hw, hw_ms))
+            read_end = start + fixed_s_no.shape[0]
+
+            while pending:
+                p_start, p_parsed, p_fixed_s_no = pending[0]
+                p_end = p_start + p_fixed_s_no.shape[0]
+                if windowed:
+                    if window_start(p_end - 1) + r >= read_end:
+                        break
+                    j = window_start(numpy.arange(p_start, p_end)) - hist_start
+                    samples_per_ms = (
+                        (hist_s[j + r] - hist_s[j]) /
+                        (hist_hw[j + r] - hist_hw[j]))
+                else:
+                    samples_per_ms = self._samples_per_ms
+                pending.popleft()
+
+                if p_start == 0:
+                    s_step = numpy.insert(p_fixed_s_no[1:] - p_fixed_s_no[:-1],
+                                          0, 0)
+                    fixed_hw_ms = numpy.cumsum(s_step / samples_per_ms)
+                else:
+                    s_step = p_fixed_s_no - numpy.insert(
+                        p_fixed_s_no[:-1], 0, p_prev_fixed_s_no)
+                    fixed_hw_ms = numpy.cumsum(numpy.insert(
+                        s_step / samples_per_ms, 0, last_fixed_hw_ms))[1:]
+                p_prev_fixed_s_no = p_fixed_s_no[-1]
+                last_fixed_hw_ms = fixed_hw_ms[-1]
+                yield p_parsed, p_fixed_s_no, fixed_hw_ms
+
+            if windowed:
+                next_start = pending[0][0] if pending else read_end
+                trim = window_start(next_start) - hist_start
+                if trim > 0:
+                    hist_s = hist_s[trim:]
+                    hist_hw = hist_hw[trim:]
+                    hist_start += trim
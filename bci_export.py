@@ -0,0 +1,375 @@
+# Copyright 2019-2020 Brad Martin.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Streaming export of decoded log data to CSV, numpy and EDF/BDF files.
+
+All of the writers here take data a block at a time, in the (n, 17) format
+produced by `BciLogData.to_numpy` and `BciLogData.iter_numpy`, so that logs
+of any length can be exported in bounded memory.
+"""
+
+import collections
+import concurrent.futures
+import os
+import tempfile
+import time
+import zipfile
+
+import numpy
+
+from bci_data import BciLogData, BciLogIndex
+
+FORMATS = ['csv', 'npy', 'npz', 'edf', 'bdf']
+# Rows per unit of CSV formatting work.
+CSV_BLOCK_ROWS = 16384
+# Layout of .npy exports.
+NPY_DTYPE = BciLogData.SAMPLE_DTYPE
+# Channel gain, as configured by bci_logger.py.
+DEFAULT_GAIN = 24
+# Microvolts per ADC count at unity gain: 4.5V reference, 24 bit signed.
+UV_PER_COUNT = 4.5 / (2 ** 23 - 1) * 1e6
+
+
+def guess_format(filename):
+    """Returns the export format implied by a filename, defaulting to csv."""
+    ext = os.path.splitext(filename)[1][1:].lower()
+    return ext if ext in FORMATS else 'csv'
+
+
+def log_start_time(filename, records):
+    """Returns the full epoch time, in seconds, of a log's first record.
+
+    `records` are the log's raw records.  The upper bits that the log itself
+    lacks come from its .bcix index if it has one, else its mtime.
+    """
+    index = BciLogIndex.load(filename)
+    if index is not None and index.entries.shape[0]:
+        reference_ms = int(index.entries['epoch_ms'][0])
+    else:
+        reference_ms = int(os.stat(filename).st_mtime * 1e3)
+    return 1e-3 * BciLogIndex.unwrap_ms(
+        int(records['sys_timestamp_ms'][0]), reference_ms)
+
+
+def export(blocks, n_rows, filename, fmt=None, jobs=1, start_time=None,
+           sample_rate=None, gain=DEFAULT_GAIN):
+    """Writes blocks of decoded log data, `n_rows` in total, to a file.
+
+    `fmt` is one of `FORMATS`, or is guessed from `filename` if None.  `jobs`
+    is the number of worker processes used for CSV formatting.
+    `start_time`, `sample_rate` and `gain` only apply to EDF/BDF output; see
+    `EdfWriter`.
+    """
+    fmt = fmt or guess_format(filename)
+    if fmt == 'csv':
+        writer = CsvWriter(filename, jobs=jobs)
+    elif fmt == 'npy':
+        writer = NpyWriter(filename, n_rows)
+    elif fmt == 'npz':
+        writer = NpzWriter(filename, n_rows)
+    elif fmt in ['edf', 'bdf']:
+        writer = EdfWriter(filename, bdf=(fmt == 'bdf'),
+                           start_time=start_time, sample_rate=sample_rate,
+                           gain=gain)
+    else:
+        raise ValueError('Unknown export format %r' % fmt)
+    try:
+        for block in blocks:
+            writer.write(block)
+    finally:
+        writer.close()
+
+
+def format_csv(block):
+    """Formats a block as CSV, returning bytes.
+
+    The output is byte-for-byte what numpy.savetxt would write with
+    `delimiter=','` and `fmt=['%.6f'] + ['%d'] * 16`.  Only the timestamps
+    go through Python string formatting; the channel values are converted to
+    fixed-width digits with numpy, and then the unused leading positions are
+    squeezed out.
+    """
+    n, cols = block.shape
+    if not n:
+        return b''
+    times = numpy.array(
+        ('%.6f,' * n % tuple(block[:, 0].tolist())).encode('ascii').split(
+            b',')[:-1])
+    times = times.view('B').reshape((n, times.dtype.itemsize))
+
+    values = block[:, 1:].astype('int64')
+    x = numpy.abs(values)
+    width = len(str(int(x.max())))
+    # Each value is a comma, a sign, then `width` digits.
+    chars = numpy.empty((n, cols - 1, width + 2), dtype='B')
+    for i in range(width + 1, 1, -1):
+        q = x // 10
+        chars[:, :, i] = x - q * 10
+        x = q
+    keep = numpy.empty(chars.shape, dtype=bool)
+    numpy.logical_or.accumulate(chars[:, :, 2:] != 0, axis=2,
+                                out=keep[:, :, 2:])
+    keep[:, :, -1] = True
+    keep[:, :, 0] = True
+    keep[:, :, 1] = values < 0
+    chars[:, :, 2:] += ord('0')
+    chars[:, :, 0] = ord(',')
+    chars[:, :, 1] = ord('-')
+
+    newlines = numpy.full((n, 1), ord('\n'), dtype='B')
+    rows = numpy.concatenate((times, chars.reshape((n, -1)), newlines),
+                             axis=1)
+    keep = numpy.concatenate(
+        (times != 0, keep.reshape((n, -1)), numpy.ones((n, 1), dtype=bool)),
+        axis=1)
+    return rows[keep].tobytes()
+
+
+class CsvWriter:
+    """Writes CSV, optionally formatting with a pool of worker processes.
+
+    Blocks are split into units of `CSV_BLOCK_ROWS` rows, which are handed
+    to the workers and written back in order as they complete, with a
+    bounded number in flight.  The output is identical for any number of
+    jobs.
+    """
+
+    def __init__(self, filename, jobs=1):
+        self._file = open(filename, 'wb')
+        self._pool = concurrent.futures.ProcessPoolExecutor(jobs) \
+            if jobs > 1 else None
+        self._pending = collections.deque()
+        self._max_pending = 2 * jobs
+
+    def write(self, block):
+        for i in range(0, block.shape[0], CSV_BLOCK_ROWS):
+            rows = block[i:i + CSV_BLOCK_ROWS]
+            if self._pool is None:
+                self._file.write(format_csv(rows))
+                continue
+            self._pending.append(self._pool.submit(format_csv, rows))
+            while len(self._pending) >= self._max_pending:
+                self._file.write(self._pending.popleft().result())
+
+    def close(self):
+        try:
+            while self._pending:
+                self._file.write(self._pending.popleft().result())
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown(cancel_futures=True)
+            self._file.close()
+
+
+class NpyWriter:
+    """Writes a .npy file of `NPY_DTYPE` records, one per sample."""
+
+    def __init__(self, filename, n_rows):
+        self._file = open(filename, 'wb')
+        numpy.lib.format.write_array_header_1_0(self._file, {
+            'descr': numpy.lib.format.dtype_to_descr(NPY_DTYPE),
+            'fortran_order': False,
+            'shape': (n_rows,),
+        })
+        self._n_rows = n_rows
+        self._written = 0
+
+    def write(self, block):
+        rows = numpy.empty(block.shape[0], dtype=NPY_DTYPE)
+        rows['time'] = block[:, 0]
+        rows['channels'] = block[:, 1:]
+        self._file.write(rows)
+        self._written += rows.shape[0]
+
+    def close(self):
+        self._file.close()
+        assert self._written == self._n_rows
+
+
+class NpzWriter:
+    """Writes a .npz file holding `time` (float64, (N,)) and `channels`
+    (int32, (N, 16)) arrays.
+
+    Channels are streamed straight into the archive, while the much smaller
+    times are spooled to a temporary file until the end.
+    """
+
+    def __init__(self, filename, n_rows):
+        self._zip = zipfile.ZipFile(filename, 'w', allowZip64=True)
+        self._channels = self._zip.open('channels.npy', 'w', force_zip64=True)
+        numpy.lib.format.write_array_header_1_0(self._channels, {
+            'descr': '<i4', 'fortran_order': False, 'shape': (n_rows, 16)})
+        self._times = tempfile.TemporaryFile()
+        self._n_rows = n_rows
+        self._written = 0
+
+    def write(self, block):
+        self._channels.write(block[:, 1:].astype('<i4').tobytes())
+        self._times.write(block[:, 0].astype('<f8').tobytes())
+        self._written += block.shape[0]
+
+    def close(self):
+        try:
+            self._channels.close()
+            with self._zip.open('time.npy', 'w', force_zip64=True) as f:
+                numpy.lib.format.write_array_header_1_0(f, {
+                    'descr': '<f8', 'fortran_order': False,
+                    'shape': (self._n_rows,)})
+                self._times.seek(0)
+                while True:
+                    data = self._times.read(1 << 20)
+                    if not data:
+                        break
+                    f.write(data)
+        finally:
+            self._times.close()
+            self._zip.close()
+        assert self._written == self._n_rows
+
+
+class EdfWriter:
+    """Writes EDF (16 bit) or BDF (24 bit) files.
+
+    EDF assumes a constant sample rate, so the time column is not stored,
+    and any dropped samples are simply skipped over.  Data records are one
+    second long; the last one is padded with zeros.  EDF only has room for
+    16 bits per sample, so the 24 bit readings lose their lowest 8 bits
+    there; BDF keeps them exactly.
+
+    `start_time` is the full epoch time of the first sample, in seconds
+    (written as UTC).  If `sample_rate` is None, it is estimated from the
+    timestamps of the first block.  `gain` is the channel gain used to
+    scale readings to microvolts.
+    """
+    _N_SIGNALS = 16
+
+    def __init__(self, filename, bdf=False, start_time=None,
+                 sample_rate=None, gain=DEFAULT_GAIN):
+        self._file = open(filename, 'wb')
+        self._bdf = bdf
+        self._start_time = start_time
+        self._sample_rate = sample_rate
+        self._gain = gain
+        self._samples_per_record = None
+        self._pending = numpy.empty((0, self._N_SIGNALS), dtype='int32')
+        self._n_records = 0
+
+    def write(self, block):
+        if not block.shape[0]:
+            return
+        if self._samples_per_record is None:
+            if self._sample_rate is None:
+                assert block.shape[0] > 1
+                self._sample_rate = (block.shape[0] - 1) / (
+                    block[-1, 0] - block[0, 0])
+            self._samples_per_record = int(round(self._sample_rate))
+            self._file.write(self._header(-1))
+
+        data = numpy.concatenate(
+            (self._pending, block[:, 1:].astype('int32')))
+        n = data.shape[0] // self._samples_per_record
+        self._write_records(data[:n * self._samples_per_record])
+        self._pending = data[n * self._samples_per_record:]
+
+    def close(self):
+        try:
+            if self._samples_per_record is None:
+                return
+            if self._pending.shape[0]:
+                padded = numpy.zeros(
+                    (self._samples_per_record, self._N_SIGNALS),
+                    dtype='int32')
+                padded[:self._pending.shape[0]] = self._pending
+                self._write_records(padded)
+            self._file.seek(0)
+            self._file.write(self._header(self._n_records))
+        finally:
+            self._file.close()
+
+    def _write_records(self, data):
+        spr = self._samples_per_record
+        n = data.shape[0] // spr
+        # Records are stored signal by signal.
+        data = numpy.ascontiguousarray(
+            data.reshape((n, spr, self._N_SIGNALS)).transpose((0, 2, 1)))
+        if self._bdf:
+            out = data.astype('<i4').view('B').reshape(data.shape + (4,))
+            self._file.write(out[..., :3].tobytes())
+        else:
+            self._file.write((data >> 8).astype('<i2').tobytes())
+        self._n_records += n
+
+    def _header(self, n_records):
+        ns = self._N_SIGNALS
+        if self._bdf:
+            digital_max = (1 << 23) - 1
+            counts_per_digital = 1
+        else:
+            digital_max = (1 << 15) - 1
+            counts_per_digital = 256
+        digital_min = -digital_max - 1
+        uv_per_digital = counts_per_digital * UV_PER_COUNT / self._gain
+
+        if self._start_time is not None:
+            start = time.gmtime(self._start_time)
+        else:
+            start = time.gmtime(473385600)  # 1985-01-01, EDF's earliest
+        fields = [
+            ('\xffBIOSEMI' if self._bdf else '0', 8),
+            ('X X X X', 80),  # Patient
+            ('Startdate X X X bci_logger', 80),  # Recording
+            (time.strftime('%d.%m.%y', start), 8),
+            (time.strftime('%H.%M.%S', start), 8),
+            (256 * (ns + 1), 8),
+            ('24BIT' if self._bdf else '', 44),
+            (n_records, 8),
+            (1, 8),  # Seconds per data record
+            (ns, 4),
+        ]
+        signal_fields = [
+            (['EEG %d' % (i + 1) for i in range(ns)], 16),
+            (['AgAgCl electrode'] * ns, 80),
+            (['uV'] * ns, 8),
+            ([digital_min * uv_per_digital] * ns, 8),
+            ([digital_max * uv_per_digital] * ns, 8),
+            ([digital_min] * ns, 8),
+            ([digital_max] * ns, 8),
+            ([''] * ns, 80),  # Prefiltering
+            ([self._samples_per_record] * ns, 8),
+            ([''] * ns, 32),
+        ]
+        header = ''.join(self._field(v, w) for v, w in fields)
+        header += ''.join(self._field(v, w)
+                          for vs, w in signal_fields for v in vs)
+        assert len(header) == 256 * (ns + 1)
+        return header.encode('latin-1')
+
+    @staticmethod
+    def _field(value, width):
+        """Formats a header field: ASCII, left-justified, space padded."""
+        if isinstance(value, float):
+            for precision in range(6, -1, -1):
+                text = '%.*f' % (precision, value)
+                if len(text) <= width:
+                    break
+        else:
+            text = str(value)
+        assert len(text) <= width
+        return text.ljust(width)
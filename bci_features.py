@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+# Copyright 2019-2020 Brad Martin.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Windowed band power features of logs, for every channel at once.
+
+`band_powers` computes, for each window of a log, the power of each channel
+in each of a set of frequency bands, by Welch's method: the average
+periodogram of overlapping Hann-windowed segments.  `BandPowers` does the
+same for a stream of decoded blocks.
+
+The work is arranged so that overlapping windows cost no more than
+non-overlapping ones.  Segments overlap by half, and windows and their steps
+are whole numbers of half segments, so every window is made of segments
+shared with its neighbours.  Each segment is transformed only once, reduced
+straight to its band powers, and each window's result is the mean of its
+segments'.  All segments in a block are transformed as one batch, and
+blocks can be transformed on several threads at once.
+
+Results are cached next to the log, one file per combination of window,
+step, segment length and bands, keyed by the size and mtime of the log.
+
+Run this module with a log to extract its features.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+import time
+
+import numpy
+import scipy.fft
+import scipy.signal
+
+from bci_data import BciLogData, BciLogMap, BciTimeCache
+
+# Bands as (name, low Hz, high Hz), each including its low edge but not its
+# high one.
+DEFAULT_BANDS = (
+    ('delta', 1., 4.),
+    ('theta', 4., 8.),
+    ('alpha', 8., 13.),
+    ('beta', 13., 30.),
+    ('gamma', 30., 100.),
+)
+WINDOW_S = 2.
+STEP_S = 0.5
+SEGMENT_S = 1.
+SUFFIX = '.bcif'
+_CACHE_VERSION = 1
+
+
+def feature_dtype(n_bands):
+    """Returns the dtype of the features of one window."""
+    return numpy.dtype([
+        ('time', '<f8'),         # Of the window's first sample, as to_numpy
+        ('contiguous', '?'),     # No samples missing within the window
+        ('power', '<f8', (16, n_bands)),  # By channel, then band
+    ])
+
+
+class BandPowers:
+    """Extracts band power features from a stream of decoded blocks.
+
+    Blocks are in the (n, 17) format of `BciLogData.to_numpy`, at
+    `sample_rate` Hz.  Windows of `window_s` seconds, starting every
+    `step_s` seconds, are each split into segments of `segment_s` seconds
+    overlapping by half, which must divide both evenly.  Band power is the
+    sum of the one-sided power spectral density over the band's frequency
+    bins, each `sample_rate / segment length` Hz wide, so that it is the
+    same as from `scipy.signal.welch` with a Hann window and constant
+    detrending.  It is in ADC counts squared.
+    """
+
+    def __init__(self, sample_rate, window_s=WINDOW_S, step_s=STEP_S,
+                 bands=DEFAULT_BANDS, segment_s=SEGMENT_S):
+        self.sample_rate = sample_rate
+        self.bands = [tuple(band) for band in bands]
+        self.segment = 2 * int(round(segment_s * sample_rate / 2))
+        self._hop = self.segment // 2
+        # Counted in half segments from the lengths in seconds, since the
+        # lengths in samples needn't be multiples of the hop when the sample
+        # rate isn't a round number.
+        window_hops = window_s / (segment_s / 2)
+        step_hops = step_s / (segment_s / 2)
+        if self._hop < 1 or \
+                abs(window_hops - round(window_hops)) > 1e-6 or \
+                abs(step_hops - round(step_hops)) > 1e-6 or \
+                round(window_hops) < 2 or round(step_hops) < 1:
+            raise ValueError(
+                'Window and step must be whole numbers of half segments, '
+                'and the window at least one segment')
+        self._window_segments = int(round(window_hops)) - 1
+        self._step_segments = int(round(step_hops))
+        self.dtype = feature_dtype(len(self.bands))
+
+        self._taper = scipy.signal.get_window('hann', self.segment)
+        self._taper_dc = scipy.fft.rfft(self._taper)
+        self._dc_bins = numpy.flatnonzero(
+            numpy.abs(self._taper_dc) > 1e-9 * self._taper_dc[0].real)
+        freqs = numpy.fft.rfftfreq(self.segment, 1. / sample_rate)
+        # Density scaling as for scipy.signal.welch, doubled for the
+        # one-sided spectrum, and times the bin width.
+        scale = numpy.full(freqs.shape, 2.)
+        scale[0] = 1.
+        scale[-1] = 1.
+        scale /= sample_rate * numpy.sum(self._taper ** 2)
+        scale *= sample_rate / self.segment
+        # Bins on a band edge stay on the same side of it when the sample
+        # rate is estimated a little off its nominal value.
+        freqs += 1e-2 * freqs[1]
+        self._band_matrix = numpy.stack(
+            [scale * ((freqs >= lo) & (freqs < hi)) for _, lo, hi in bands],
+            axis=1)
+
+        # Samples not yet in a complete segment.
+        self._tail = numpy.empty((0, 17))
+        # Band powers, start times and gap counts of the segments not yet in
+        # a complete window.
+        self._powers = numpy.empty((0, 16, len(self.bands)))
+        self._times = numpy.empty(0)
+        self._gaps = numpy.empty(0, dtype='int64')
+
+    def feed(self, block):
+        """Returns the features of the windows completed by a block."""
+        samples, times, gaps = self._split(block)
+        return self._windows(self._segment_powers(samples), times, gaps)
+
+    def _split(self, block):
+        """Takes the complete segments from the stream.
+
+        Returns the samples they span, and the start time and count of
+        missing sample gaps within each.
+        """
+        samples = numpy.concatenate((self._tail, block)) \
+            if self._tail.shape[0] else block
+        n_hops = samples.shape[0] // self._hop
+        self._tail = samples[max(n_hops - 1, 0) * self._hop:]
+        samples = samples[:n_hops * self._hop]
+        n_segments = max(n_hops - 1, 0)
+
+        is_gap = numpy.zeros(samples.shape[0], dtype='int64')
+        is_gap[1:] = numpy.diff(samples[:, 0]) > 1.5 / self.sample_rate
+        gap_count = numpy.cumsum(is_gap)
+        starts = numpy.arange(n_segments) * self._hop
+        gaps = gap_count[starts + self.segment - 1] - gap_count[starts]
+        return samples, samples[starts, 0], gaps
+
+    def _segment_powers(self, samples):
+        """Returns the (n, 16, bands) band powers of every segment."""
+        n_hops = samples.shape[0] // self._hop
+        if n_hops < 2:
+            return numpy.empty((0, 16, len(self.bands)))
+        channels = numpy.ascontiguousarray(samples[:, 1:].T)
+        # Each segment is two hops, so its mean is that of two hop sums.
+        hop_sums = channels.reshape((16, n_hops, self._hop)).sum(axis=2)
+        means = (hop_sums[:, :-1] + hop_sums[:, 1:]) / self.segment
+        frames = numpy.lib.stride_tricks.sliding_window_view(
+            channels, self.segment, axis=1)[:, ::self._hop]
+        spectra = scipy.fft.rfft(frames * self._taper, axis=2)
+        # Detrending, by subtracting the transform of the tapered mean,
+        # which is only nonzero in the few lowest bins.
+        spectra[:, :, self._dc_bins] -= \
+            means[:, :, None] * self._taper_dc[self._dc_bins]
+        power = numpy.square(spectra.real)
+        power += numpy.square(spectra.imag)
+        return (power @ self._band_matrix).transpose((1, 0, 2))
+
+    def _windows(self, powers, times, gaps):
+        """Adds segments to those pending, returning any windows complete.
+        """
+        if self._powers.shape[0]:
+            powers = numpy.concatenate((self._powers, powers))
+            times = numpy.concatenate((self._times, times))
+            gaps = numpy.concatenate((self._gaps, gaps))
+        n = self._window_segments
+        step = self._step_segments
+        n_windows = max(-(-(powers.shape[0] - n + 1) // step), 0)
+        starts = numpy.arange(n_windows) * step
+        result = numpy.empty(n_windows, dtype=self.dtype)
+        result['time'] = times[starts]
+        # Means over each window's segments, from running sums.
+        csum = numpy.zeros((powers.shape[0] + 1,) + powers.shape[1:])
+        numpy.cumsum(powers, axis=0, out=csum[1:])
+        result['power'] = (csum[starts + n] - csum[starts]) / n
+        gap_sum = numpy.concatenate(([0], numpy.cumsum(gaps)))
+        result['contiguous'] = gap_sum[starts + n] == gap_sum[starts]
+
+        keep = n_windows * step
+        self._powers = powers[keep:]
+        self._times = times[keep:]
+        self._gaps = gaps[keep:]
+        return result
+
+
+def _blocks(log, chunk_records=BciLogData.CHUNK_RECORDS):
+    """Yields a log decoded a block at a time, as `BciLogData.iter_numpy`.
+
+    If the log has a complete `BciTimeCache`, its blocks are read directly,
+    which needs only one pass over the log.
+    """
+    log_map = BciLogMap(log)
+    if BciTimeCache.cached_times(log, log_map.records()) is not None:
+        for start in range(0, len(log_map), chunk_records):
+            yield log_map.read(start, start + chunk_records)
+        return
+    with open(log, 'rb') as f:
+        yield from BciLogData.iter_numpy(f, chunk_records)
+
+
+def cache_filename(log, sample_rate=None, window_s=WINDOW_S, step_s=STEP_S,
+                   bands=DEFAULT_BANDS, segment_s=SEGMENT_S):
+    """Returns the name of the file caching a log's features."""
+    key = json.dumps([_CACHE_VERSION, sample_rate, window_s, step_s,
+                      segment_s, [list(band) for band in bands]])
+    return '%s.%s%s' % (log, hashlib.sha1(key.encode()).hexdigest()[:16],
+                        SUFFIX)
+
+
+def _read_cache(filename, log):
+    """Returns the features in a cache file, or None if it's not current."""
+    try:
+        st = os.stat(log)
+        with numpy.load(filename) as cache:
+            if int(cache['log_size']) != st.st_size or \
+               int(cache['log_mtime_ns']) != st.st_mtime_ns:
+                return None
+            return cache['features']
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def band_powers(log, sample_rate=None, window_s=WINDOW_S, step_s=STEP_S,
+                bands=DEFAULT_BANDS, segment_s=SEGMENT_S, jobs=1,
+                use_cache=True):
+    """Returns the band power features of every window of a log.
+
+    The result is an array of `feature_dtype`, as from `BandPowers`, which
+    has the meaning of the other arguments.  `sample_rate` defaults to that
+    of the first block of the log.  The log is streamed, so can be of any
+    length, and with `jobs` > 1 its blocks are transformed on that many
+    threads while the next are decoded.
+
+    Unless `use_cache` is false, the features are cached next to the log
+    (see `cache_filename`), and read back from there while the log is
+    unchanged.  These files can be deleted at any time.
+    """
+    if use_cache:
+        filename = cache_filename(log, sample_rate, window_s, step_s, bands,
+                                  segment_s)
+        cached = _read_cache(filename, log)
+        if cached is not None:
+            return cached
+        st = os.stat(log)
+
+    extractor = None
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max(jobs, 1)) as executor:
+        # Blocks are split in order, and their windows assembled in order
+        # as their transforms complete, with at most 2 * jobs in flight.
+        pending = collections.deque()
+
+        def finish():
+            future, times, gaps = pending.popleft()
+            results.append(extractor._windows(future.result(), times, gaps))
+
+        for block in _blocks(log):
+            if extractor is None:
+                rate = sample_rate or 1. / numpy.median(numpy.diff(
+                    block[:, 0]))
+                extractor = BandPowers(rate, window_s, step_s, bands,
+                                       segment_s)
+            samples, times, gaps = extractor._split(block)
+            if jobs > 1:
+                pending.append((executor.submit(
+                    extractor._segment_powers, samples), times, gaps))
+                if len(pending) >= 2 * jobs:
+                    finish()
+            else:
+                results.append(extractor._windows(
+                    extractor._segment_powers(samples), times, gaps))
+        while pending:
+            finish()
+
+    features = numpy.concatenate(results) if results else \
+        numpy.empty(0, dtype=feature_dtype(len(bands)))
+    if use_cache:
+        # Written under a temporary name and renamed into place, so that a
+        # partial cache is never read.
+        tmp = filename + '.tmp.npz'
+        numpy.savez(tmp, features=features, log_size=st.st_size,
+                    log_mtime_ns=st.st_mtime_ns)
+        os.replace(tmp, filename)
+    return features
+
+
+def parse_bands(text):
+    """Parses bands given as e.g. 'alpha:8-13,beta:13-30'."""
+    bands = []
+    for item in text.split(','):
+        name, _, edges = item.rpartition(':')
+        lo, _, hi = edges.partition('-')
+        bands.append((name or edges, float(lo), float(hi)))
+    return bands
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('log', help='.bci log to extract features from')
+    parser.add_argument('-w', '--window', type=float, default=WINDOW_S,
+                        help='Window length in s')
+    parser.add_argument('-s', '--step', type=float, default=STEP_S,
+                        help='Time between the starts of windows in s')
+    parser.add_argument('--segment', type=float, default=SEGMENT_S,
+                        help='Welch segment length in s')
+    parser.add_argument('-b', '--bands',
+                        default=','.join('%s:%g-%g' % band
+                                         for band in DEFAULT_BANDS),
+                        help='Bands, as name:low-high, comma separated')
+    parser.add_argument('-r', '--sample-rate', type=float,
+                        help='Sample rate in Hz (default estimated from the '
+                        'data)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='Threads to transform with')
+    parser.add_argument('-o', '--output',
+                        help='.npy file to write the features to')
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Don't read or write the features cache")
+    args = parser.parse_args()
+
+    bands = parse_bands(args.bands)
+    start = time.time()
+    features = band_powers(args.log, args.sample_rate, args.window,
+                           args.step, bands, args.segment, args.jobs,
+                           not args.no_cache)
+    elapsed = time.time() - start
+    print('%d windows in %.2f s, %d not contiguous' % (
+        features.shape[0], elapsed,
+        features.shape[0] - numpy.count_nonzero(features['contiguous'])))
+    if features.shape[0]:
+        print('Median power by band (counts^2), over channels and windows:')
+        median = numpy.median(features['power'], axis=(0, 1))
+        for (name, lo, hi), power in zip(bands, median):
+            print('  %-8s %5g-%-5g Hz: %.4g' % (name, lo, hi, power))
+    if args.output:
+        numpy.save(args.output, features)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# Copyright 2019-2020 Brad Martin.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Live feed of decoded samples from a running logger, via shared memory.
+
+`SampleFeed` is used by bci_logger.py (see its --feed option) to publish
+every sample it logs into a ring buffer in a `multiprocessing.shared_memory`
+block, and `SampleFeedReader` lets other local processes attach to that
+block and look at the latest samples without copying them.
+
+The block starts with a `HEADER_LEN` byte header, followed by the ring of
+`DTYPE` records.  Each holds the raw log record, as written to the .bci
+file, so that publishing costs no more than copying it; readers decode the
+channel readings and hardware timestamps they want with
+`SampleFeedReader.channels` and `SampleFeedReader.hw_timestamps`.  The ring
+holds `capacity` samples but is stored twice over
+(every sample is written both at its slot and `capacity` records later), so
+that the latest M samples are always contiguous and can be returned as a
+plain numpy view.  Two sequence counters in the header count the samples
+ever published: `begin` is advanced before a batch of samples is written,
+and `end` after, so a reader can tell which samples are complete and
+whether the ones it is looking at have since been overwritten.
+
+Run this module with a feed name to monitor a feed.
+"""
+
+import argparse
+import struct
+import sys
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy
+
+from bci_data import BciLogData
+
+
+class SampleFeed:
+    """Publishes decoded samples into a shared memory ring buffer."""
+    MAGIC = b'BCIF'
+    VERSION = 3
+    DTYPE = numpy.dtype([
+        ('sample_number', '<i8'),  # Unwrapped, counting any dropped samples
+        ('time', '<f8'),           # System time of receipt, epoch seconds
+        ('sample_time', '<f8'),    # Reconstructed sample time, epoch seconds
+        ('record', 'B', (BciLogData.RECORD_LEN,)),  # As in the log
+    ])
+    # magic, version, capacity, record size, begin, end
+    _HEADER = struct.Struct('<4sLQQQQ')
+    HEADER_LEN = 64
+    _BEGIN_OFFSET = 24
+    _END_OFFSET = 32
+    DEFAULT_CAPACITY = 1 << 16  # About 30 s at 2 kHz
+
+    def __init__(self, name, capacity=DEFAULT_CAPACITY):
+        size = self.HEADER_LEN + 2 * capacity * self.DTYPE.itemsize
+        try:
+            self._shm = shared_memory.SharedMemory(name, create=True,
+                                                   size=size)
+        except FileExistsError:
+            # Most likely left behind by a logger that didn't exit cleanly.
+            print('Replacing existing shared memory feed %r' % name)
+            old = shared_memory.SharedMemory(name)
+            old.close()
+            old.unlink()
+            self._shm = shared_memory.SharedMemory(name, create=True,
+                                                   size=size)
+        self._shm.buf[:self._HEADER.size] = self._HEADER.pack(
+            self.MAGIC, self.VERSION, capacity, self.DTYPE.itemsize, 0, 0)
+        self._capacity = capacity
+        self._begin, self._end, self._ring = _map(self._shm, capacity)
+        # The same memory as bytes, for mirroring batches into the other
+        # copy of the ring.
+        self._ring_bytes = self._ring.view('B')
+        self._seq = 0
+        self._sample_number = -1
+        # 1, 2, 3, ..., for numbering consecutive samples, grown as needed.
+        self._ramp = numpy.arange(1, 257)
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def publish(self, records, now, steps=None, times=None):
+        """Publishes a batch of raw (n, RECORD_LEN) records.
+
+        `now` is the time the records were received.  `steps` gives each
+        record's sample number increment over the record before it (more
+        than 1 after dropped samples), or is None if they all follow on
+        consecutively.  `times` gives each record's reconstructed sample
+        time (see bci_data.BciTimeEstimator), or is None to use `now`.
+        """
+        n = records.shape[0]
+        if steps is None:
+            if self._ramp.shape[0] < n:
+                self._ramp = numpy.arange(1, n + 1)
+            sample_numbers = self._ramp[:n] + self._sample_number
+        else:
+            sample_numbers = self._sample_number + numpy.cumsum(steps)
+        self._sample_number = int(sample_numbers[-1])
+        if n > self._capacity:
+            records = records[-self._capacity:]
+            sample_numbers = sample_numbers[-self._capacity:]
+            if times is not None:
+                times = times[-self._capacity:]
+            self._seq += n - self._capacity
+            n = self._capacity
+
+        self._begin[0] = self._seq + n
+        cap = self._capacity
+        start = self._seq % cap
+        out = self._ring[start:start + n]
+        out['sample_number'] = sample_numbers
+        out['time'] = now
+        out['sample_time'] = now if times is None else times
+        out['record'] = records
+        # Mirror the batch into the other copy of the ring.
+        size = self.DTYPE.itemsize
+        ring = self._ring_bytes
+        if start + n <= cap:
+            ring[(start + cap) * size:(start + cap + n) * size] = \
+                ring[start * size:(start + n) * size]
+        else:
+            ring[(start + cap) * size:] = ring[start * size:cap * size]
+            ring[:(start + n - cap) * size] = \
+                ring[cap * size:(start + n) * size]
+        self._seq += n
+        self._end[0] = self._seq
+
+    def close(self):
+        del self._begin, self._end, self._ring, self._ring_bytes
+        self._shm.close()
+        self._shm.unlink()
+
+
+class SampleFeedReader:
+    """Read access to a `SampleFeed` published by another process."""
+
+    def __init__(self, name):
+        if sys.version_info >= (3, 13):
+            self._shm = shared_memory.SharedMemory(name, track=False)
+        else:
+            self._shm = shared_memory.SharedMemory(name)
+            # Otherwise the feed is unlinked when this process exits.
+            resource_tracker.unregister(self._shm._name, 'shared_memory')
+        magic, version, capacity, itemsize, _, _ = SampleFeed._HEADER.unpack(
+            bytes(self._shm.buf[:SampleFeed._HEADER.size]))
+        if magic != SampleFeed.MAGIC or version != SampleFeed.VERSION or \
+                itemsize != SampleFeed.DTYPE.itemsize:
+            self._shm.close()
+            raise ValueError('%r is not a compatible sample feed' % name)
+        self.capacity = capacity
+        self._begin, self._end, self._ring = _map(self._shm, capacity)
+
+    def sequence(self):
+        """Returns the number of samples published so far."""
+        return int(self._end[0])
+
+    def latest(self, m):
+        """Returns (seq, samples) for the latest `m` samples.
+
+        `samples` is a view into shared memory of up to `m` records, the last
+        of which is sample `seq - 1` of the feed.  It stays valid only until
+        the writer wraps around onto it; check `intact(seq, m)` after using
+        it, or copy it.
+        """
+        if m > self.capacity:
+            raise ValueError('Feed only holds %d samples' % self.capacity)
+        seq = self.sequence()
+        return seq, self._window(seq, min(m, seq))
+
+    def since(self, seq):
+        """Returns (new seq, samples) for samples published after `seq`.
+
+        Like `latest`, but for polling: pass the returned seq back in to get
+        only samples that are new since then.  If more than the ring's
+        capacity have been published, the oldest are missed.
+        """
+        end = self.sequence()
+        return end, self._window(end, min(end - seq, self.capacity))
+
+    @staticmethod
+    def channels(samples):
+        """Returns the (n, 16) int32 channel readings of feed samples."""
+        return BciLogData._channel_data(SampleFeedReader._parse(samples))
+
+    @staticmethod
+    def hw_timestamps(samples):
+        """Returns the hardware timestamps of feed samples, in ms."""
+        return SampleFeedReader._parse(samples)['packet'][:, 0][
+            'hw_timestamp_ms'].astype('<u4')
+
+    def intact(self, seq, m):
+        """Returns whether the `m` samples before `seq` are still unchanged.
+        """
+        return int(self._begin[0]) <= seq - m + self.capacity
+
+    def close(self):
+        del self._begin, self._end, self._ring
+        self._shm.close()
+
+    @staticmethod
+    def _parse(samples):
+        return numpy.ascontiguousarray(samples['record']).reshape(-1).view(
+            BciLogData.DTYPE)
+
+    def _window(self, end, m):
+        start = (end - m) % self.capacity
+        return self._ring[start:start + m]
+
+
+def _map(shm, capacity):
+    """Returns the (begin, end, ring) arrays of a feed's shared memory."""
+    begin = numpy.ndarray((1,), dtype='<u8', buffer=shm.buf,
+                          offset=SampleFeed._BEGIN_OFFSET)
+    end = numpy.ndarray((1,), dtype='<u8', buffer=shm.buf,
+                        offset=SampleFeed._END_OFFSET)
+    ring = numpy.ndarray((2 * capacity,), dtype=SampleFeed.DTYPE,
+                         buffer=shm.buf, offset=SampleFeed.HEADER_LEN)
+    return begin, end, ring
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('name', help='Name of the feed, as given to '
+                        'bci_logger.py --feed')
+    parser.add_argument('-n', '--samples', type=int, default=2000,
+                        help='Samples to summarise in each report')
+    parser.add_argument('--interval', type=float, default=1.,
+                        help='Seconds between reports')
+    args = parser.parse_args()
+
+    reader = SampleFeedReader(args.name)
+    try:
+        last_seq = reader.sequence()
+        while True:
+            time.sleep(args.interval)
+            seq, samples = reader.latest(args.samples)
+            if not samples.shape[0]:
+                continue
+            rate = (seq - last_seq) / args.interval
+            age_ms = 1e3 * (time.time() - samples['time'][-1])
+            channels = reader.channels(samples)
+            rms = numpy.sqrt(numpy.mean(numpy.square(
+                channels - channels.mean(axis=0))))
+            if not reader.intact(seq, samples.shape[0]):
+                print('Overwritten while reading; reading less at once')
+                continue
+            print('sample %d: %.0f Hz, latest %.1f ms old, rms %.1f' % (
+                samples['sample_number'][-1], rate, age_ms, rms))
+            last_seq = seq
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.close()
+
+
+if __name__ == '__main__':
+    main()
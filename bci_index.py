@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# Copyright 2019-2020 Brad Martin.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""Builds the time index for an existing .bci log file."""
+
+import argparse
+import os
+import time
+
+from bci_data import BciLogIndex, BciLogMap
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-i', '--input', required=True,
+                        help='.bci log file to index')
+    parser.add_argument('-n', '--interval', type=int,
+                        default=BciLogIndex.DEFAULT_INTERVAL,
+                        help='Records between index entries')
+    parser.add_argument('-r', '--reference', type=float,
+                        help='Epoch time in seconds within 24 days of the end '
+                        'of the log (default is the log file mtime)')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Overwrite any existing index')
+    parser.add_argument('-t', '--time', type=float, action='append',
+                        help='Epoch time in seconds to look up after '
+                        'indexing; may be repeated')
+    args = parser.parse_args()
+
+    reference = args.reference if args.reference is not None \
+        else os.stat(args.input).st_mtime
+    log = BciLogMap(args.input)
+    index = BciLogIndex.build(log.records(), interval=args.interval,
+                              reference_ms=int(reference * 1e3))
+    index.write(args.input, overwrite=args.force)
+    if index.entries.shape[0]:
+        print('Indexed %d records, %s to %s' % (
+            len(log),
+            time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(
+                index.entries['epoch_ms'][0] * 1e-3)),
+            time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(
+                index.entries['epoch_ms'][-1] * 1e-3))))
+
+    for t in args.time or []:
+        print('%.3f: record %d' % (t, index.find(log.records(), t)))
+
+
+if __name__ == '__main__':
+    main()
@@ -24,30 +24,109 @@ import sys
 import numpy as np
 import matplotlib.pyplot as plt
 
-from bci_data import BciLogData
+from bci_data import BciLogMap
 
 AVG_LEN = 2000
 COLORS = ['0.5', 'm', 'b', 'g', 'y', '#ff8000', 'r', '#804000']
 
 
+def moving_average(data, n):
+    """Averages `data` over `n` samples along axis 0.
+
+    Equivalent to np.convolve(column, np.ones(n) / n, mode='same') for each
+    column, but O(N) in the length of the data regardless of `n`.
+    """
+    length = data.shape[0]
+    csum = np.zeros((length + 1,) + data.shape[1:])
+    np.cumsum(data, axis=0, out=csum[1:])
+    idx = np.arange(length)
+    lo = np.maximum(idx - n // 2, 0)
+    hi = np.minimum(idx + (n - 1) // 2 + 1, length)
+    return (csum[hi] - csum[lo]) / n
+
+
+def decimate(t, data, n_bins):
+    """Reduces `data` to the min and max of each of `n_bins` bins.
+
+    Returns times and data with two points per bin, which plots
+    indistinguishably from the full data at a resolution of `n_bins`
+    pixels.  Data short enough to plot directly is returned unchanged.
+    """
+    bin_len = data.shape[0] // n_bins
+    if bin_len < 2:
+        return t, data
+    n = n_bins * bin_len
+    bins = data[:n].reshape((n_bins, bin_len) + data.shape[1:])
+    out = np.empty((n_bins, 2) + data.shape[1:])
+    out[:, 0] = bins.min(axis=1)
+    out[:, 1] = bins.max(axis=1)
+    out_t = np.repeat(t[:n:bin_len], 2)
+    out = out.reshape((2 * n_bins,) + data.shape[1:])
+    # Whatever doesn't fill a whole bin is plotted as is.
+    return (np.concatenate((out_t, t[n:])),
+            np.concatenate((out, data[n:])))
+
+
+class DecimatedPlot:
+    """Plots the columns of `data` against `t`, decimated to screen width.
+
+    The plot is re-decimated whenever the x limits change, so zooming in
+    reveals full detail while only a few thousand points are ever drawn.
+    """
+
+    def __init__(self, ax, t, data, colors):
+        self._ax = ax
+        self._t = t
+        self._data = data
+        self._lines = [
+            ax.plot(t[:1], data[:1, i], color=colors[i % len(colors)],
+                    linewidth=0.5)[0]
+            for i in range(data.shape[1])]
+        ax.set_xlim(t[0], t[-1])
+        ymin, ymax = data.min(), data.max()
+        margin = 0.05 * (ymax - ymin)
+        ax.set_ylim(ymin - margin, ymax + margin)
+        self._update(ax)
+        ax.callbacks.connect('xlim_changed', self._update)
+
+    def _update(self, ax):
+        x0, x1 = ax.get_xlim()
+        i0 = max(np.searchsorted(self._t, x0) - 1, 0)
+        i1 = np.searchsorted(self._t, x1) + 1
+        n_bins = max(int(ax.get_window_extent().width), 1)
+        t, data = decimate(self._t[i0:i1], self._data[i0:i1], n_bins)
+        for i, line in enumerate(self._lines):
+            line.set_data(t, data[:, i])
+        ax.figure.canvas.draw_idle()
+
+
 def main():
-    if len(sys.argv) != 2:
-        print('Usage: %s <log.bci>' % sys.argv[0])
+    if len(sys.argv) not in [2, 4]:
+        print('Usage: %s <log.bci> [<start_s> <end_s>]' % sys.argv[0])
+        print('  Times are in seconds from the start of the log.')
         sys.exit(1)
-    with open(sys.argv[1], 'rb') as f:
-        d = f.read()
-    p = BciLogData.to_numpy(d)
+    log = BciLogMap(sys.argv[1])
+    if len(sys.argv) == 4:
+        t0 = log.start_time()
+        p = log.read_time(t0 + float(sys.argv[2]), t0 + float(sys.argv[3]))
+    else:
+        p = log.read()
     print('Loaded %r' % sys.argv[1])
+    if len(p) <= AVG_LEN:
+        # The filter's edges are trimmed, which would leave nothing to plot.
+        print('Only %d samples loaded; need more than %d to filter and plot.'
+              % (len(p), AVG_LEN))
+        sys.exit(1)
+
+    print('Filtering')
+    hp = p[:, 1:] - moving_average(p[:, 1:], AVG_LEN)
+    edge = slice(AVG_LEN // 2, -AVG_LEN // 2)
 
     plt.figure()
-    for i in range(1, p.shape[1]):
-        print('Filtering channel %d' % i)
-        hp = p[:, i] - np.convolve(
-            p[:, i], np.ones(AVG_LEN) / AVG_LEN, mode='same')
-        plt.plot(p[AVG_LEN // 2:-AVG_LEN // 2, 0],
-                 hp[AVG_LEN // 2:-AVG_LEN // 2],
-                 color=COLORS[(i - 1) % len(COLORS)],
-                 linewidth=0.5)
+    # Matplotlib only holds a weak reference to the callback, so keep this
+    # alive as long as the figure.
+    plt.gcf()._decimated_plot = DecimatedPlot(
+        plt.gca(), p[edge, 0], hp[edge], COLORS)
     plt.xlabel('s')
     plt.show()
 
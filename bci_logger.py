@@ -24,25 +24,38 @@
 # Some of this code is based on or inspired by the wifi module in pyOpenBCI.
 
 import argparse
+import collections
 import math
+import numpy
+import os
+import queue
 import requests
-import select
+import selectors
 import socket
 import struct
+import threading
 import time
 
-from bci_data import BciData
+import bci_metrics
+from bci_data import BciData, BciLogData, BciLogIndex, BciLogIndexWriter, \
+    BciLogManifest, BciLogV2, BciLogV2Writer, BciTimeCacheWriter, \
+    BciTimeEstimator
+from bci_feed import SampleFeed
 
 
 def get_local_ip(remote_ip):
+    # The remote address may have an HTTP port, e.g. for bci_sim.py.
     sock = socket.socket(type=socket.SOCK_DGRAM)
-    sock.connect((remote_ip, 0))
+    sock.connect((remote_ip.split(':')[0], 0))
     local_ip = sock.getsockname()[0]
     sock.close()
     return local_ip
 
 
 class OpenBCIWifi:
+    # Copies of each datagram the shield sends in burst mode.
+    BURST_COPIES = 3
+
     def __init__(self, ip):
         self._ip = ip
         self._session = requests.Session()
@@ -52,13 +65,16 @@ class OpenBCIWifi:
     def send_command(self, cmd):
         self._do_post('command', json={'command': cmd})
 
-    def start_stream(self, ip, port, latency_us):
+    def start_stream(self, ip, port, latency_us, burst=False):
+        """Starts streaming to ip:port.  In burst mode, the shield sends
+        every datagram `BURST_COPIES` times, so that it is only lost if all
+        of the copies are."""
         self._do_post('udp', json={
             'ip': ip,
             'port': port,
             'output': 'raw',
             'latency': latency_us,
-            'burst': False})
+            'burst': burst})
         self._do_get('stream/start')
 
     def stop_stream(self):
@@ -88,82 +104,527 @@ class OpenBCIWifi:
         return result.text
 
 
+class LogWriter:
+    """Writes batches of log records to a new log file.
+
+    Unless `index_interval` is None, a BciLogIndex of the log is written
+    alongside it.  If `block_records` is given, the log is written in the
+    compressed v2 format, with blocks of that many records.  If `time_cache`
+    is True, the reconstructed times given with each batch are written to a
+    BciTimeCache alongside it, so that loading the log can skip
+    reconstructing them.
+
+    If `segment_bytes` or `segment_seconds` is given, the log is split into
+    segments, each started once the previous one reaches that many bytes or
+    has been written for that long, and listed in a BciLogManifest.  Batches
+    are never split between segments.
+    """
+
+    # A bci_metrics.LoggerMetrics, if set, times each write to the file.
+    metrics = None
+
+    def __init__(self, filename, index_interval=None, block_records=None,
+                 time_cache=False, segment_bytes=None, segment_seconds=None):
+        self._filename = filename
+        self._index_interval = index_interval
+        self._block_records = block_records
+        self._time_cache = time_cache
+        self._segment_bytes = segment_bytes
+        self._segment_seconds = segment_seconds
+        self._manifest = None
+        if segment_bytes or segment_seconds:
+            self._manifest = BciLogManifest()
+            # Claim the name, as opening the log itself would.
+            open(BciLogManifest.filename(filename), 'x').close()
+            self._open(BciLogManifest.segment_filename(filename, 0))
+        else:
+            self._open(filename)
+
+    def write(self, records, now, times=None):
+        """Writes records, all of which were received at time `now`.
+
+        `times` is (fixed_s_no, fixed_sys_ms, state) for the records, from a
+        BciTimeEstimator, for the time cache.
+        """
+        if self._manifest is not None:
+            self._segment_write(records, now)
+        self._write_records(records)
+        self._account(records, now, times)
+
+    def wants_times(self):
+        """Returns whether `write` needs the records' reconstructed times."""
+        return self._time_cache
+
+    def flush(self):
+        self._file.flush()
+        if self._index is not None:
+            self._index.flush()
+        if self._times is not None:
+            self._times.flush()
+
+    def close(self):
+        self._close()
+
+    def _open(self, filename):
+        self._file = open(filename, 'xb')
+        self._v2 = BciLogV2Writer(self._file, self._block_records) \
+            if self._block_records else None
+        self._index = BciLogIndexWriter(filename, self._index_interval) \
+            if self._index_interval else None
+        self._times = BciTimeCacheWriter(filename) \
+            if self._time_cache else None
+        if self._manifest is not None:
+            self._manifest.segments.append({
+                'file': os.path.basename(filename), 'records': None})
+            self._manifest.write(self._filename)
+            self._segment_records = 0
+            self._segment_first = None
+            self._segment_last = None
+            self._segment_start = None
+            self._segment_end = None
+
+    def _close(self):
+        if self._v2 is not None:
+            self._v2.close()
+        self._file.close()
+        if self._index is not None:
+            self._index.close()
+        if self._times is not None:
+            self._times.close()
+        if self._manifest is not None and self._segment_records:
+            first, last = numpy.frombuffer(
+                self._segment_first + self._segment_last,
+                dtype=BciLogData.DTYPE)
+            self._manifest.segments[-1].update({
+                'records': self._segment_records,
+                'first_sample': int(first['packet'][0]['sample_number']),
+                'last_sample': int(last['packet'][0]['sample_number']),
+                'first_sys_ms': int(first['sys_timestamp_ms']),
+                'last_sys_ms': int(last['sys_timestamp_ms']),
+                'start_epoch_ms': self._segment_start,
+                'end_epoch_ms': self._segment_end,
+            })
+            self._manifest.write(self._filename)
+
+    def _write_group(self, group):
+        """Writes a list of batches, each as (records, now, times).
+
+        Unless the log is segmented, their records are written to the file
+        all at once.
+        """
+        if self._manifest is not None:
+            for batch in group:
+                LogWriter.write(self, *batch)
+            return
+        self._write_records(b''.join([batch[0] for batch in group]))
+        for batch in group:
+            self._account(*batch)
+
+    def _write_records(self, records):
+        start = time.perf_counter() if self.metrics is not None else None
+        if self._v2 is not None:
+            self._v2.write(records)
+        else:
+            self._file.write(records)
+        if start is not None:
+            self.metrics.file_write_seconds.observe(
+                time.perf_counter() - start)
+
+    def _account(self, records, now, times):
+        """Adds written records to the index and time cache."""
+        if self._index is not None:
+            self._index.add(
+                memoryview(records).nbytes // BciLogData.RECORD_LEN,
+                int(now * 1e3))
+        if self._times is not None:
+            self._times.add(records, *times)
+
+    def _segment_write(self, records, now):
+        """Starts a new segment if due, and notes the records' details."""
+        if self._segment_records and (
+                (self._segment_bytes and
+                 self._file.tell() >= self._segment_bytes) or
+                (self._segment_seconds and now * 1e3 - self._segment_start >=
+                 self._segment_seconds * 1e3)):
+            self._close()
+            self._open(BciLogManifest.segment_filename(
+                self._filename, len(self._manifest.segments)))
+        records = memoryview(records).cast('B')
+        if not self._segment_records:
+            self._segment_first = bytes(records[:BciLogData.RECORD_LEN])
+            self._segment_start = int(now * 1e3)
+        self._segment_last = bytes(records[-BciLogData.RECORD_LEN:])
+        self._segment_end = int(now * 1e3)
+        self._segment_records += records.nbytes // BciLogData.RECORD_LEN
+
+
+class ThreadedLogWriter(LogWriter):
+    """A LogWriter that does its file I/O from a dedicated thread.
+
+    Batches are handed off through a bounded queue, so that a slow disk
+    never blocks the caller.  They are queued in groups of `group_batches`,
+    or fewer if the first of them was written `group_seconds` before,
+    so that handing them off, and waking the thread, is paid once per group
+    rather than once per batch.  If the queue is full, the group is
+    discarded and reported, much as the kernel would do with a full socket
+    buffer.  If the thread fails to write, e.g. because the disk is full,
+    the error is raised from the next `write` or `close`.
+    """
+
+    def __init__(self, filename, max_batches=1024, flush_interval=1.,
+                 fsync_interval=None, group_batches=64, group_seconds=0.05,
+                 **kwargs):
+        super().__init__(filename, **kwargs)
+        self._queue = queue.Queue()
+        self._max_batches = max_batches
+        self._group_batches = group_batches
+        self._group_seconds = group_seconds
+        # Batches not yet queued, as (records, now, times).
+        self._group = []
+        # Batches queued, and written, so far, each only updated by one
+        # thread, so that the queue can be bounded in batches.
+        self._batches_queued = 0
+        self._batches_written = 0
+        self._flush_interval = flush_interval
+        self._fsync_interval = fsync_interval
+        self._high_water = 0
+        self._reported_high_water = 0
+        self._lost_records = 0
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def queue_depth(self):
+        """Returns the number of batches waiting to be written."""
+        return self._batches_queued - self._batches_written + \
+            len(self._group)
+
+    def lost_records(self):
+        return self._lost_records
+
+    def write(self, records, now, times=None):
+        self._check_error()
+        group = self._group
+        group.append((bytes(records), now, times))
+        if len(group) >= self._group_batches or \
+                now >= group[0][1] + self._group_seconds:
+            self._queue_group()
+
+    def close(self):
+        if self._group and self._thread.is_alive():
+            self._queue_group()
+        self._queue.put(None)
+        self._thread.join()
+        print('Writer queue high-water mark: %d of %d batches' %
+              (self._high_water, self._max_batches))
+        if self._lost_records:
+            print('Writer discarded %d records' % self._lost_records)
+        super().close()
+        self._check_error()
+
+    def _queue_group(self):
+        group = self._group
+        self._group = []
+        depth = self._batches_queued - self._batches_written + len(group)
+        if depth > self._max_batches:
+            n = sum(len(records) for records, _, _ in group) // \
+                BciLogData.RECORD_LEN
+            self._lost_records += n
+            print('Writer queue full!  Discarded %d records' % n)
+            return
+        self._batches_queued += len(group)
+        self._queue.put(group)
+
+        if depth > self._high_water:
+            self._high_water = depth
+            if depth >= 2 * max(self._reported_high_water, 1):
+                print('Writer queue high-water mark: %d of %d batches' %
+                      (depth, self._max_batches))
+                self._reported_high_water = depth
+
+    def _check_error(self):
+        if self._error is not None:
+            raise RuntimeError('Error writing log: %s' % self._error) \
+                from self._error
+
+    def _run(self):
+        try:
+            self._write_queued()
+        except Exception as e:
+            self._error = e
+
+    def _write_queued(self):
+        now = time.monotonic()
+        next_flush = now + self._flush_interval
+        next_fsync = (now + self._fsync_interval) \
+            if self._fsync_interval is not None else math.inf
+        while True:
+            try:
+                item = self._queue.get(
+                    timeout=max(min(next_flush, next_fsync) - now, 0.))
+            except queue.Empty:
+                item = ()
+            if item is None:
+                if self._fsync_interval is not None:
+                    self.flush()
+                    os.fsync(self._file.fileno())
+                break
+            if item:
+                self._write_group(item)
+            self._batches_written += len(item)
+
+            now = time.monotonic()
+            if now >= next_fsync:
+                self.flush()
+                os.fsync(self._file.fileno())
+                next_fsync = now + self._fsync_interval
+                next_flush = now + self._flush_interval
+            elif now >= next_flush:
+                self.flush()
+                next_flush = now + self._flush_interval
+
+
 class Logger:
     _SPINNER = '|/-\\'
+    # Large enough for the biggest possible UDP datagram plus a partial pair
+    # left over from the previous one.
+    _RECV_BUF_LEN = 65536 + BciData.PAIR_LEN
+    _MAX_RECORDS = _RECV_BUF_LEN // BciData.PAIR_LEN
+    # Translation table mapping each sample number to the one following it.
+    _NEXT_SAMPLE = bytes(range(1, 256)) + bytes([0])
+    # Initial socket receive buffer size, in bytes.
+    RCVBUF = 1024 * 1024
+    # Recent datagrams remembered to spot repeats in burst mode.
+    _BURST_HISTORY = 2 * OpenBCIWifi.BURST_COPIES
 
-    def __init__(self, filename):
-        self._file = open(filename, 'xb')
+    def __init__(self, writer, name=None, feed=None, metrics=None,
+                 burst=False):
+        """If `name` is given, messages are prefixed with it and the spinner
+        is left to the caller, which can use `rate_hz()` to show progress.
+        If `feed` is given, it is a `bci_feed.SampleFeed` which every logged
+        sample is published to, after it has been handed to the writer.
+        If `metrics` is given, it is a `bci_metrics.LoggerMetrics` which is
+        kept up to date with what is received and logged.  If `burst` is
+        True, the board is sending each datagram several times, and repeats
+        are discarded.
+
+        If the writer keeps a time cache or there is a feed, timestamps are
+        reconstructed as samples arrive, by a BciTimeEstimator, and given to
+        the writer with each batch and published to the feed."""
+        self._writer = writer
+        self._name = name
+        self._feed = feed
+        self._metrics = metrics
+        self._recent = collections.deque(maxlen=self._BURST_HISTORY) \
+            if burst else None
+        # Samples received or found missing, and of those missing, for
+        # AdaptiveTuner.
+        self.samples = 0
+        self.dropped_samples = 0
         self._socket = socket.socket(type=socket.SOCK_DGRAM)
         self._socket.bind(('', 0))
-        self._data = bytes()
+        # Received data is accumulated in a preallocated buffer, and complete
+        # records are assembled in another one, so that the steady state
+        # receive path does not allocate per packet.
+        self._buf = bytearray(self._RECV_BUF_LEN)
+        self._buf_view = memoryview(self._buf)
+        self._buf_len = 0
+        self._records = numpy.empty(
+            (self._MAX_RECORDS, BciLogData.RECORD_LEN), dtype='B')
         self._time_fmt = struct.Struct('>L')
+        self._times = BciTimeEstimator() \
+            if writer.wants_times() or feed is not None else None
         self._last_sample = None
         self._spinner_idx = 0
         self._spinner_time = None
         self._spinner_samples = 0
+        self._rate_hz = 0.
+
+        self.set_rcvbuf(self.RCVBUF)
 
-        self._socket.setsockopt(
-            socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+        if metrics is not None:
+            writer.metrics = metrics
+            metrics.collectors.append(self._collect_metrics)
 
     def get_port(self):
         return self._socket.getsockname()[1]
 
+    def set_rcvbuf(self, size):
+        """Sets the socket receive buffer size, returning the size actually
+        granted, which the kernel may cap (see net.core.rmem_max)."""
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+        return self.rcvbuf()
+
+    def rcvbuf(self):
+        # Linux reports double the size set, to allow for its overheads.
+        return self._socket.getsockopt(
+            socket.SOL_SOCKET, socket.SO_RCVBUF) // 2
+
     def close(self):
         self._socket.close()
-        self._file.close()
+        self._writer.close()
+        if self._feed is not None:
+            self._feed.close()
 
     def rlist(self):
         return [self._socket]
 
+    def rate_hz(self):
+        """Returns the most recently measured sample rate."""
+        return self._rate_hz
+
     def handle_event(self, obj, now):
         if obj != self._socket:
             print('Unrecognized wait object!')
             return
 
-        self._data += self._socket.recv(4096)
+        metrics = self._metrics
+        if metrics is not None:
+            start = time.perf_counter()
+        received = self._socket.recv_into(self._buf_view[self._buf_len:])
+        if self._recent is not None:
+            datagram = bytes(
+                self._buf_view[self._buf_len:self._buf_len + received])
+            if datagram in self._recent:
+                if metrics is not None:
+                    metrics.duplicate_datagrams += 1
+                return
+            self._recent.append(datagram)
+        self._buf_len += received
 
         samples = 0
-        while len(self._data) >= BciData.PAIR_LEN:
-            if not BciData.validate(self._data):
-                self._discard_junk()
+        pos = 0
+        while self._buf_len - pos >= BciData.PAIR_LEN:
+            data = self._buf_view[pos:self._buf_len]
+            valid = BciData.count_valid(data)
+            if not valid:
+                if self._name is not None:
+                    print(self._prefix(), end='')
+                BciData.validate(data)  # Report what was wrong with it.
+                junk_start = pos
+                pos = self._find_start(pos + 1)
+                if metrics is not None:
+                    metrics.invalid += 1
+                    metrics.junk_bytes += pos - junk_start
                 continue
 
-            if self._last_sample is not None:
-                expected_sample = (self._last_sample + 1) & 0xFF
-                if self._data[1] not in [self._last_sample, expected_sample]:
-                    lost = self._data[1] - expected_sample
-                    if lost < 0:
-                        lost += 256
-                    samples += lost
-                    f, _ = math.modf(now)
-                    print('%s.%03d: Dropped %d samples (%d -> %d)' %
-                          (time.strftime('%H:%M:%S', time.gmtime(now)),
-                           int(1e3 * f), lost,
-                           self._last_sample, self._data[1]))
-            self._last_sample = self._data[1]
-
-            self._file.write(self._time_fmt.pack(int(now * 1e3) & 0xFFFFFFFF) +
-                             self._data[:BciData.PAIR_LEN])
-            self._data = self._data[BciData.PAIR_LEN:]
-            samples += 1
+            end = valid * BciData.PAIR_LEN
+            samples += self._write_pairs(data[:end], now)
+            pos += end
+
+        # Move any trailing partial pair back to the start of the buffer.
+        remain = self._buf_len - pos
+        if remain and pos:
+            self._buf[:remain] = self._buf[pos:self._buf_len]
+        self._buf_len = remain
+
+        if metrics is not None:
+            metrics.datagrams += 1
+            metrics.bytes += received
+            metrics.event_seconds.observe(time.perf_counter() - start)
 
+        self.samples += samples
         self._spinner_samples += samples
         if samples and ((self._spinner_time is None) or
                         (now >= self._spinner_time + 0.2)):
             dt = (now - self._spinner_time) \
                  if self._spinner_time is not None else 1.
-            print('Logging... %s (%.0f Hz)     \r' %
-                  (self._spinner(), self._spinner_samples / dt),
-                  end='')
+            self._rate_hz = self._spinner_samples / dt
+            if self._name is None:
+                print('Logging... %s (%.0f Hz)     \r' %
+                      (self._spinner(), self._rate_hz),
+                      end='')
             self._spinner_time = now
             self._spinner_samples = 0
 
-    def _discard_junk(self):
-        idx = self._data[1:].find(BciData.START_BYTE)
-        if idx < 0:
-            self._data = bytes()
+    def _write_pairs(self, data, now):
+        """Logs a batch of already-validated pairs.
+
+        Returns the number of samples this batch accounts for, including any
+        dropped ones.
+        """
+        n = len(data) // BciData.PAIR_LEN
+        records = self._records[:n]
+        records[:, BciLogData.TIMESTAMP_SIZE:] = numpy.frombuffer(
+            data, dtype='B').reshape((n, BciData.PAIR_LEN))
+        records[:, :BciLogData.TIMESTAMP_SIZE] = numpy.frombuffer(
+            self._time_fmt.pack(int(now * 1e3) & 0xFFFFFFFF), dtype='B')
+        # Check whether the sample numbers simply count up, as they usually
+        # do, which allows faster paths here and in the estimator.
+        s_no = bytes(data[1::BciData.PAIR_LEN])
+        consecutive = ((self._last_sample is None or
+                        s_no[0] == (self._last_sample + 1) & 0xFF) and
+                       s_no[1:] == s_no[:-1].translate(self._NEXT_SAMPLE))
+        times = None
+        if self._times is not None:
+            fixed_s_no, fixed_sys_ms = self._times.update(records,
+                                                          consecutive)
+            times = (fixed_s_no, fixed_sys_ms, self._times.state)
+        if self._feed is not None:
+            # The same times as full epoch seconds.
+            sample_times = (fixed_sys_ms - self._times.last_sys_ms +
+                            int(now * 1e3)) * 1e-3
+        metrics = self._metrics
+        if metrics is not None:
+            start = time.perf_counter()
+            self._writer.write(records, now, times)
+            metrics.write_seconds.observe(time.perf_counter() - start)
+            metrics.records += n
         else:
-            self._data = self._data[idx + 1:]
+            self._writer.write(records, now, times)
+
+        if consecutive:
+            self._last_sample = s_no[-1]
+            if self._feed is not None:
+                self._feed.publish(records, now, times=sample_times)
+            return n
+
+        s_no = numpy.frombuffer(s_no, dtype='B').astype('int')
+        prev = numpy.empty_like(s_no)
+        prev[0] = s_no[0] if self._last_sample is None else self._last_sample
+        prev[1:] = s_no[:-1]
+        lost = (s_no - prev - 1) & 0xFF
+        lost[s_no == prev] = 0
+        if self._feed is not None:
+            steps = lost + 1
+            steps[s_no == prev] = 0
+            if self._last_sample is None:
+                steps[0] = 1
+            self._feed.publish(records, now, steps, sample_times)
+        self.dropped_samples += int(numpy.sum(lost))
+        for idx in numpy.flatnonzero(lost):
+            if metrics is not None:
+                metrics.dropped_samples += int(lost[idx])
+                metrics.drop_gaps.observe(int(lost[idx]))
+            f, _ = math.modf(now)
+            print('%s%s.%03d: Dropped %d samples (%d -> %d)' %
+                  (self._prefix(),
+                   time.strftime('%H:%M:%S', time.gmtime(now)),
+                   int(1e3 * f), lost[idx], prev[idx], s_no[idx]))
+        self._last_sample = int(s_no[-1])
+
+        return n + int(numpy.sum(lost))
+
+    def _collect_metrics(self):
+        """Updates the gauges of `self._metrics`."""
+        metrics = self._metrics
+        try:
+            stats = bci_metrics.udp_socket_stats(self.get_port())
+        except OSError:  # Closed
+            stats = None
+        if stats is not None:
+            metrics.socket_rx_queue_bytes, metrics.socket_drops = stats
+        if isinstance(self._writer, ThreadedLogWriter):
+            metrics.writer_queue_batches = self._writer.queue_depth()
+            metrics.writer_discarded_records = self._writer.lost_records()
+
+    def _find_start(self, pos):
+        """Returns the offset of the next possible start of a pair."""
+        idx = self._buf.find(BciData.START_BYTE, pos, self._buf_len)
+        return idx if idx >= 0 else self._buf_len
+
+    def _prefix(self):
+        return '%s: ' % self._name if self._name is not None else ''
 
     def _spinner(self):
         i = self._spinner_idx
@@ -171,42 +632,423 @@ class Logger:
         return self._SPINNER[i]
 
 
+# Sample rate commands, by rate in Hz.
+SAMPLE_RATES = {16000 >> i: '~%d' % i for i in range(7)}
+DEFAULT_SAMPLE_RATE = 2000
+# The commands selecting each channel, in order, for channel settings.
+_CHANNEL_COMMANDS = '12345678QWERTYUI'
+# Power on channel at max gain, normal input type, include in BIAS, connect
+# to SRB2.
+DEFAULT_CHANNEL_SETTINGS = '060110'
+
+
+class BoardSession:
+    """Logging of a single board: its wifi interface plus its Logger.
+
+    The board is configured for `sample_rate` Hz (a key of `SAMPLE_RATES`),
+    with `channel_settings` (see `configure_board`).  If `adaptive` is True,
+    an AdaptiveTuner adjusts the stream's latency and socket buffer while
+    logging, up to `max_latency_us`.
+    """
+
+    def __init__(self, ip, make_writer, name=None, make_feed=None,
+                 metrics=None, sample_rate=DEFAULT_SAMPLE_RATE,
+                 channel_settings=None, burst=False, adaptive=False,
+                 max_latency_us=None):
+        self.ip = ip
+        self.name = name if name is not None else ip
+        self.burst = burst
+        self.latency_us = None
+        self._iface = OpenBCIWifi(ip)
+        configure_board(self._iface, sample_rate, channel_settings)
+        self.logger = Logger(
+            make_writer(), name=name,
+            feed=make_feed() if make_feed is not None else None,
+            metrics=metrics, burst=burst)
+        self.tuner = AdaptiveTuner(self, max_latency_us=max_latency_us) \
+            if adaptive else None
+        self.deadline = None
+        self._streaming = False
+        self._closed = False
+        self._restart = None
+
+    def start(self, latency_us, timeout):
+        local_ip = get_local_ip(self.ip)
+        port = self.logger.get_port()
+        print('%s: Listening on %s:%d' % (self.name, local_ip, port))
+        self._iface.start_stream(local_ip, port, latency_us, self.burst)
+        self.latency_us = latency_us
+        self._streaming = True
+        self.deadline = time.monotonic() + timeout
+
+    def set_latency(self, latency_us):
+        """Restarts the stream with a different latency.
+
+        This is done from a separate thread, since it takes two requests to
+        the board, and meanwhile the sockets of every board must still be
+        read.  If it fails, the stream is restarted with the old latency.
+        """
+        if self.restarting():
+            return
+        self._restart = threading.Thread(
+            target=self._restart_stream, args=(latency_us,), daemon=True)
+        self._restart.start()
+
+    def restarting(self):
+        return self._restart is not None and self._restart.is_alive()
+
+    def poll(self, mono):
+        """Does any periodic work, given the current monotonic time."""
+        if self.tuner is not None and self._streaming and \
+                not self.restarting():
+            self.tuner.poll(mono)
+
+    def stop(self):
+        """Stops streaming and closes the log.  Safe to call repeatedly."""
+        try:
+            if self._restart is not None:
+                self._restart.join()
+            if self._streaming:
+                self._streaming = False
+                self._iface.stop_stream()
+        finally:
+            if not self._closed:
+                self._closed = True
+                self.logger.close()
+
+    def _restart_stream(self, latency_us):
+        local_ip = get_local_ip(self.ip)
+        port = self.logger.get_port()
+        try:
+            self._iface.stop_stream()
+            self._iface.start_stream(local_ip, port, latency_us, self.burst)
+        except Exception as e:
+            print('%s: Error changing latency to %d us: %s' % (
+                self.name, latency_us, e))
+            try:
+                self._iface.start_stream(local_ip, port, self.latency_us,
+                                         self.burst)
+            except Exception as e:
+                print('%s: Error restarting stream: %s' % (self.name, e))
+            return
+        self.latency_us = latency_us
+
+
+class AdaptiveTuner:
+    """Adjusts a BoardSession's stream to the drops it sees.
+
+    Every `interval` seconds, the samples dropped since the last check are
+    compared with those logged.  Datagrams dropped by the kernel, or a
+    receive queue more than half full, mean the socket buffer is too small
+    for the bursts it has to absorb while the logger is busy, so it is
+    doubled, up to `max_rcvbuf`.  Otherwise, more than `max_drop_rate` of
+    samples missing means datagrams are being lost on the way, and the
+    stream is restarted with double the latency, up to `max_latency_us`:
+    fewer, larger datagrams are less likely to be lost over wifi, and cost
+    less to handle.  Settings are never reduced again, as each latency
+    change briefly interrupts the stream.
+
+    Kernel drops and queue depth are only available on Linux; elsewhere,
+    only latency is tuned.
+    """
+    DEFAULT_MAX_LATENCY_US = 100000
+    DEFAULT_MAX_RCVBUF = 64 * 1024 * 1024
+
+    def __init__(self, session, interval=2., max_drop_rate=1e-3,
+                 max_latency_us=None, max_rcvbuf=DEFAULT_MAX_RCVBUF):
+        self._session = session
+        self._interval = interval
+        self._max_drop_rate = max_drop_rate
+        self._max_latency_us = max_latency_us or self.DEFAULT_MAX_LATENCY_US
+        self._max_rcvbuf = max_rcvbuf
+        self._next_poll = None
+        self._samples = 0
+        self._dropped = 0
+        self._socket_drops = None
+
+    def poll(self, mono):
+        if self._next_poll is None:
+            self._next_poll = mono + self._interval
+            self._socket_drops = self._socket_stats()[1]
+        if mono < self._next_poll:
+            return
+        self._next_poll = mono + self._interval
+
+        session = self._session
+        logger = session.logger
+        samples = logger.samples - self._samples
+        dropped = logger.dropped_samples - self._dropped
+        self._samples = logger.samples
+        self._dropped = logger.dropped_samples
+        rx_queue, socket_drops = self._socket_stats()
+        kernel_drops = socket_drops - self._socket_drops \
+            if socket_drops is not None and self._socket_drops is not None \
+            else 0
+        self._socket_drops = socket_drops
+
+        rcvbuf = logger.rcvbuf()
+        if (kernel_drops or (rx_queue or 0) > rcvbuf // 2) and \
+                rcvbuf < self._max_rcvbuf:
+            granted = logger.set_rcvbuf(min(2 * rcvbuf, self._max_rcvbuf))
+            print('%s: %d datagrams dropped by the kernel, receive buffer '
+                  '%d -> %d bytes' % (session.name, kernel_drops, rcvbuf,
+                                      granted))
+            if granted <= rcvbuf:
+                # Capped by the kernel; no use trying again.
+                self._max_rcvbuf = rcvbuf
+        elif samples and dropped > self._max_drop_rate * samples and \
+                session.latency_us < self._max_latency_us:
+            latency_us = min(2 * session.latency_us, self._max_latency_us)
+            print('%s: %.2f%% of samples dropped, latency %d -> %d us' % (
+                session.name, 100. * dropped / samples, session.latency_us,
+                latency_us))
+            session.set_latency(latency_us)
+
+    def _socket_stats(self):
+        try:
+            stats = bci_metrics.udp_socket_stats(
+                self._session.logger.get_port())
+        except OSError:  # Closed
+            stats = None
+        return stats if stats is not None else (None, None)
+
+
+def parse_channel_settings(text):
+    """Parses channel settings from the command line.
+
+    These are either one set of settings for every channel, or 16
+    comma-separated ones, each being the six digits of a Cyton channel
+    settings command: power down, gain, input type, bias, SRB2, SRB1.
+    """
+    settings = text.split(',')
+    if len(settings) == 1:
+        settings *= len(_CHANNEL_COMMANDS)
+    if len(settings) != len(_CHANNEL_COMMANDS):
+        raise ValueError('Need 1 or %d channel settings' %
+                         len(_CHANNEL_COMMANDS))
+    for setting in settings:
+        if len(setting) != 6 or not setting.isdigit() or \
+                setting[0] > '1' or setting[1] > '6' or setting[2] > '7' or \
+                max(setting[3:]) > '1':
+            raise ValueError('Invalid channel settings %r' % setting)
+    return settings
+
+
+def configure_board(iface, sample_rate=DEFAULT_SAMPLE_RATE,
+                    channel_settings=None):
+    """Configures the board for logging.
+
+    `channel_settings` is a list of settings for each channel, as from
+    `parse_channel_settings`, or None for `DEFAULT_CHANNEL_SETTINGS`.
+    """
+    iface.send_command(SAMPLE_RATES[sample_rate])
+    iface.send_command('/4')  # Marker mode
+    iface.send_command('<')   # Enable timestamps
+    for ch, setting in zip(_CHANNEL_COMMANDS, channel_settings or
+                           [DEFAULT_CHANNEL_SETTINGS] *
+                           len(_CHANNEL_COMMANDS)):
+        iface.send_command('x%s%sX' % (ch, setting))
+
+
+def run(sessions, timeout=5., metrics_file=None):
+    """Logs from all sessions until every one of them has timed out.
+
+    A board that stops sending data for `timeout` seconds is stopped on its
+    own, while the remaining boards continue to be logged.  If given,
+    `metrics_file` is a `bci_metrics.MetricsFile` to keep updated.
+    """
+    sel = selectors.DefaultSelector()
+    for session in sessions:
+        for obj in session.logger.rlist():
+            sel.register(obj, selectors.EVENT_READ, session)
+
+    active = list(sessions)
+    multi = len(sessions) > 1
+    spinner = Logger._SPINNER
+    spinner_idx = 0
+    status_time = time.monotonic()
+    while active:
+        wait = min(session.deadline for session in active) - time.monotonic()
+        if metrics_file is not None:
+            wait = min(wait, metrics_file.next_write - time.monotonic())
+        events = sel.select(max(wait, 0.))
+        now = time.time()
+        mono = time.monotonic()
+        for key, _ in events:
+            key.data.logger.handle_event(key.fileobj, now)
+            key.data.deadline = mono + timeout
+        for session in active:
+            session.poll(mono)
+
+        for session in [s for s in active if s.deadline <= mono]:
+            print('%s: Data timeout!' % session.name)
+            for obj in session.logger.rlist():
+                sel.unregister(obj)
+            active.remove(session)
+            session.stop()
+
+        if multi and active and mono >= status_time + 0.2:
+            print('Logging... %s (%s)     \r' % (
+                spinner[spinner_idx],
+                ', '.join('%s %.0f Hz' % (s.name, s.logger.rate_hz())
+                          for s in active)),
+                  end='')
+            spinner_idx = (spinner_idx + 1) % len(spinner)
+            status_time = mono
+
+        if metrics_file is not None:
+            metrics_file.poll(mono)
+
+    sel.close()
+    raise RuntimeError('Data timeout!')
+
+
 def main():
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument('-i', '--ip', required=True,
-                        help='IP address of wifi shield')
-    parser.add_argument('-o', '--output', required=True,
-                        help='File name of .bci log file to write')
+    parser.add_argument('-i', '--ip', required=True, action='append',
+                        help='IP address of wifi shield; may be repeated to '
+                        'log several boards at once')
+    parser.add_argument('-o', '--output', required=True, action='append',
+                        help='File name of .bci log file to write; one per '
+                        '--ip, in the same order')
     parser.add_argument('-l', '--latency-us', type=int, default=10000,
                         help='Latency in usec to request')
+    parser.add_argument('-r', '--sample-rate', type=int,
+                        choices=sorted(SAMPLE_RATES),
+                        default=DEFAULT_SAMPLE_RATE,
+                        help='Sample rate in Hz; for 4000 and up, see also '
+                        '--burst and --adaptive')
+    parser.add_argument('--channel-settings',
+                        default=DEFAULT_CHANNEL_SETTINGS,
+                        help='Cyton channel settings digits (power down, '
+                        'gain, input type, bias, SRB2, SRB1), for all '
+                        'channels or as 16 comma-separated ones')
+    parser.add_argument('-b', '--burst', action='store_true',
+                        help='Have the shield send each datagram several '
+                        'times, so that fewer are lost')
+    parser.add_argument('-a', '--adaptive', action='store_true',
+                        help='Raise the latency and socket buffer size as '
+                        'needed to stop drops')
+    parser.add_argument('--max-latency-us', type=int,
+                        default=AdaptiveTuner.DEFAULT_MAX_LATENCY_US,
+                        help='Highest latency in usec --adaptive may request')
+    parser.add_argument('-t', '--writer-thread', action='store_true',
+                        help='Write to disk from a separate thread')
+    parser.add_argument('--queue-batches', type=int, default=1024,
+                        help='Max batches queued for the writer thread')
+    parser.add_argument('--flush-interval', type=float, default=1.,
+                        help='Seconds between flushes by the writer thread')
+    parser.add_argument('--fsync-interval', type=float,
+                        help='Seconds between fsyncs by the writer thread '
+                        '(default never)')
+    parser.add_argument('--index-interval', type=int,
+                        default=BciLogIndex.DEFAULT_INTERVAL,
+                        help='Records between time index entries, or 0 for '
+                        'no index')
+    parser.add_argument('-z', '--compress', action='store_true',
+                        help='Write logs in the compressed v2 format')
+    parser.add_argument('--block-records', type=int,
+                        default=BciLogV2.DEFAULT_BLOCK_RECORDS,
+                        help='Records per block of v2 logs')
+    parser.add_argument('--no-time-cache', action='store_true',
+                        help='Don\'t write reconstructed timestamps '
+                        'alongside each log (see BciTimeCache)')
+    parser.add_argument('--segment-mb', type=float,
+                        help='Start a new segment of the log every this many '
+                        'MB (see BciLogManifest)')
+    parser.add_argument('--segment-minutes', type=float,
+                        help='Start a new segment of the log every this many '
+                        'minutes')
+    parser.add_argument('-s', '--feed', action='append',
+                        help='Publish samples to a shared memory feed of '
+                        'this name (see bci_feed.py); one per --ip, in the '
+                        'same order')
+    parser.add_argument('--feed-samples', type=int,
+                        default=SampleFeed.DEFAULT_CAPACITY,
+                        help='Samples held by each shared memory feed')
+    parser.add_argument('--metrics-file',
+                        help='File to rewrite periodically with metrics, in '
+                        'Prometheus text format')
+    parser.add_argument('--metrics-interval', type=float, default=5.,
+                        help='Seconds between rewrites of --metrics-file')
+    parser.add_argument('--metrics-port', type=int,
+                        help='Local port to serve metrics on, at /metrics')
+    parser.add_argument('--timeout', type=float, default=5.,
+                        help='Seconds without data before giving up on a '
+                        'board')
     args = parser.parse_args()
+    if len(args.ip) != len(args.output):
+        parser.error('Need exactly one --output per --ip')
+    if args.feed is not None and len(args.feed) != len(args.ip):
+        parser.error('Need exactly one --feed per --ip')
+    try:
+        channel_settings = parse_channel_settings(args.channel_settings)
+    except ValueError as e:
+        parser.error(str(e))
 
-    iface = OpenBCIWifi(args.ip)
-    iface.send_command('~3')  # 2 kHz; in practice faster rates don't work
-    iface.send_command('/4')  # Marker mode
-    iface.send_command('<')   # Enable timestamps
-    for ch in '12345678QWERTYUI':
-        # Power on channel at max gain, normal input type, include in BIAS,
-        # connect to SRB2.
-        iface.send_command('x%s060110X' % ch)
-
-    logger = Logger(args.output)
-    local_ip = get_local_ip(args.ip)
-    port = logger.get_port()
-    print('Listening on %s:%d' % (local_ip, port))
-    iface.start_stream(local_ip, port, args.latency_us)
+    writer_args = {
+        'index_interval': args.index_interval,
+        'block_records': args.block_records if args.compress else None,
+        'time_cache': not args.no_time_cache,
+        'segment_bytes': int(args.segment_mb * 1e6)
+        if args.segment_mb else None,
+        'segment_seconds': args.segment_minutes * 60.
+        if args.segment_minutes else None,
+    }
+
+    def writer_factory(output):
+        if args.writer_thread:
+            return lambda: ThreadedLogWriter(
+                output, max_batches=args.queue_batches,
+                flush_interval=args.flush_interval,
+                fsync_interval=args.fsync_interval, **writer_args)
+        return lambda: LogWriter(output, **writer_args)
+
+    def feed_factory(feed):
+        if feed is None:
+            return None
+        return lambda: SampleFeed(feed, capacity=args.feed_samples)
+
+    multi = len(args.ip) > 1
+    sessions = []
+    all_metrics = []
+    metrics_file = None
+    metrics_server = None
     try:
-        while True:
-            rlist, _, _ = select.select(logger.rlist(), [], [], 5.)
-            if not rlist:
-                raise RuntimeError('Data timeout!')
-            now = time.time()
-            for obj in rlist:
-                logger.handle_event(obj, now)
+        for ip, output, feed in zip(args.ip, args.output,
+                                    args.feed or [None] * len(args.ip)):
+            metrics = None
+            if args.metrics_file or args.metrics_port is not None:
+                metrics = bci_metrics.LoggerMetrics(ip)
+                all_metrics.append(metrics)
+            sessions.append(BoardSession(
+                ip, writer_factory(output), name=ip if multi else None,
+                make_feed=feed_factory(feed), metrics=metrics,
+                sample_rate=args.sample_rate,
+                channel_settings=channel_settings, burst=args.burst,
+                adaptive=args.adaptive, max_latency_us=args.max_latency_us))
+        if args.metrics_file:
+            metrics_file = bci_metrics.MetricsFile(
+                args.metrics_file, all_metrics,
+                interval=args.metrics_interval)
+        if args.metrics_port is not None:
+            metrics_server = bci_metrics.MetricsServer(
+                args.metrics_port, all_metrics)
+        for session in sessions:
+            session.start(args.latency_us, args.timeout)
+        run(sessions, timeout=args.timeout, metrics_file=metrics_file)
 
     finally:
-        iface.stop_stream()
-        logger.close()
+        # Every log is closed even if stopping some board's stream fails.
+        for session in sessions:
+            try:
+                session.stop()
+            except Exception as e:
+                print('%s: Error stopping: %s' % (session.name, e))
+        if metrics_file is not None:
+            metrics_file.write()
+        if metrics_server is not None:
+            metrics_server.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,238 @@
+# Copyright 2019-2020 Brad Martin.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Runtime metrics for the logger, in the Prometheus text format.
+
+Each `Logger` given a `LoggerMetrics` counts what it receives, validates,
+drops and writes into it.  The metrics of all boards can then be exposed
+either as a file rewritten every few seconds (`MetricsFile`), e.g. for the
+node exporter's textfile collector, or over HTTP (`MetricsServer`).
+"""
+
+import bisect
+import http.server
+import os
+import threading
+
+# Upper bounds of the histogram buckets for times, in seconds.
+LATENCY_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3,
+                   5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 1.)
+# Upper bounds of the histogram buckets for gaps, in samples.  The logger
+# can't see gaps of more than 255, since sample numbers wrap at 256.
+GAP_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 255)
+
+
+class Histogram:
+    """A Prometheus style histogram, with fixed bucket upper bounds."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def lines(self, name, labels):
+        total = 0
+        for le, count in zip(
+                [repr(float(b)) for b in self.buckets] + ['+Inf'],
+                self.counts):
+            total += count
+            yield '%s_bucket%s %d' % (
+                name, _labels(dict(labels, le=le)), total)
+        yield '%s_sum%s %r' % (name, _labels(labels), self.sum)
+        yield '%s_count%s %d' % (name, _labels(labels), total)
+
+
+class LoggerMetrics:
+    """The metrics of one board's Logger.
+
+    Counters are plain attributes, so that updating them costs next to
+    nothing on the receive path.  Gauges are refreshed by the functions in
+    `collectors` just before the metrics are rendered.
+    """
+    # (attribute, metric name, type, help)
+    FAMILIES = [
+        ('datagrams', 'bci_datagrams_received_total', 'counter',
+         'UDP datagrams received'),
+        ('bytes', 'bci_bytes_received_total', 'counter',
+         'Bytes received'),
+        ('records', 'bci_records_total', 'counter',
+         'Valid packet pairs received and logged'),
+        ('duplicate_datagrams', 'bci_duplicate_datagrams_total', 'counter',
+         'Repeated datagrams discarded in burst mode'),
+        ('invalid', 'bci_validation_failures_total', 'counter',
+         'Times received data failed validation'),
+        ('junk_bytes', 'bci_junk_bytes_total', 'counter',
+         'Bytes discarded as junk after validation failures'),
+        ('dropped_samples', 'bci_dropped_samples_total', 'counter',
+         'Samples missing from the sample number sequence'),
+        ('drop_gaps', 'bci_drop_gap_samples', 'histogram',
+         'Sizes of gaps in the sample number sequence, in samples'),
+        ('event_seconds', 'bci_event_seconds', 'histogram',
+         'Time to handle each received datagram'),
+        ('write_seconds', 'bci_write_seconds', 'histogram',
+         'Time the receive loop spends handing each batch to the writer'),
+        ('file_write_seconds', 'bci_file_write_seconds', 'histogram',
+         'Time to write each batch to the log file'),
+        ('writer_queue_batches', 'bci_writer_queue_batches', 'gauge',
+         'Batches queued for the writer thread'),
+        ('writer_discarded_records', 'bci_writer_discarded_records_total',
+         'counter', 'Records discarded because the writer queue was full'),
+        ('socket_rx_queue_bytes', 'bci_socket_rx_queue_bytes', 'gauge',
+         'Bytes waiting in the socket receive queue'),
+        ('socket_drops', 'bci_socket_drops_total', 'counter',
+         'Datagrams dropped by the kernel, e.g. for a full receive queue'),
+    ]
+
+    def __init__(self, board):
+        self.labels = {'board': board}
+        self.datagrams = 0
+        self.bytes = 0
+        self.records = 0
+        self.duplicate_datagrams = 0
+        self.invalid = 0
+        self.junk_bytes = 0
+        self.dropped_samples = 0
+        self.drop_gaps = Histogram(GAP_BUCKETS)
+        self.event_seconds = Histogram(LATENCY_BUCKETS)
+        self.write_seconds = Histogram(LATENCY_BUCKETS)
+        self.file_write_seconds = Histogram(LATENCY_BUCKETS)
+        self.writer_queue_batches = None
+        self.writer_discarded_records = None
+        self.socket_rx_queue_bytes = None
+        self.socket_drops = None
+        self.collectors = []
+
+    def collect(self):
+        for collector in self.collectors:
+            collector()
+
+
+def render(all_metrics):
+    """Returns the Prometheus text exposition of several LoggerMetrics."""
+    for metrics in all_metrics:
+        metrics.collect()
+    lines = []
+    for attr, name, kind, help_text in LoggerMetrics.FAMILIES:
+        values = [(m, getattr(m, attr)) for m in all_metrics
+                  if getattr(m, attr) is not None]
+        if not values:
+            continue
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for metrics, value in values:
+            if kind == 'histogram':
+                lines.extend(value.lines(name, metrics.labels))
+            else:
+                lines.append('%s%s %r' % (name, _labels(metrics.labels),
+                                          value))
+    return '\n'.join(lines) + '\n'
+
+
+def udp_socket_stats(port):
+    """Returns (receive queue bytes, drops) for a local UDP port, or None.
+
+    These come from /proc/net/udp, so are only available on Linux.
+    """
+    try:
+        with open('/proc/net/udp') as f:
+            next(f)
+            for line in f:
+                fields = line.split()
+                if int(fields[1].split(':')[1], 16) == port:
+                    rx_queue = int(fields[4].split(':')[1], 16)
+                    return rx_queue, int(fields[-1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+class MetricsFile:
+    """Rewrites a file with the current metrics every `interval` seconds.
+
+    The file is replaced atomically, so readers never see it half written.
+    Call `poll` regularly with the current monotonic time.
+    """
+
+    def __init__(self, filename, all_metrics, interval=5.):
+        self._filename = filename
+        self._all_metrics = all_metrics
+        self._interval = interval
+        self.next_write = 0.
+
+    def poll(self, mono):
+        if mono >= self.next_write:
+            self.write()
+            self.next_write = mono + self._interval
+
+    def write(self):
+        tmp_filename = self._filename + '.tmp'
+        try:
+            with open(tmp_filename, 'w') as f:
+                f.write(render(self._all_metrics))
+            os.replace(tmp_filename, self._filename)
+        except OSError as e:
+            print('Unable to write metrics: %s' % e)
+
+
+class MetricsServer:
+    """Serves the current metrics over HTTP, at /metrics.
+
+    The server runs in a background thread until `close` is called.
+    """
+
+    def __init__(self, port, all_metrics, host='127.0.0.1'):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                data = render(all_metrics).encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _labels(labels):
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in labels.items())
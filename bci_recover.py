@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# Copyright 2019-2020 Brad Martin.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Recovers the valid records from a damaged or truncated .bci log.
+
+Anything that isn't a valid record, such as a partial record left at the end
+by a crash, or garbage or zeros left by a full disk, is skipped, and the
+remaining records are written to a new v1 log that the other tools can read.
+Each skipped span of the input is reported.
+"""
+
+import argparse
+import os
+
+import numpy
+
+from bci_data import BciLogData
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-i', '--input', required=True,
+                        help='Damaged v1 .bci log file to read')
+    parser.add_argument('-o', '--output', required=True,
+                        help='.bci log file to write')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='Only report totals, not each skipped span')
+    args = parser.parse_args()
+
+    data = numpy.memmap(args.input, dtype='B', mode='r')
+    runs, dropped = BciLogData.find_records(data)
+    with open(args.output, 'xb') as f:
+        for start, stop in runs:
+            f.write(data[start:stop])
+
+    if not args.quiet:
+        for offset, count in dropped:
+            print('Skipped %d bytes at offset %d (around record %d)' % (
+                count, offset, offset // BciLogData.RECORD_LEN))
+    print('%d records recovered, %d bytes in %d spans skipped' % (
+        os.path.getsize(args.output) // BciLogData.RECORD_LEN,
+        sum(count for _, count in dropped), len(dropped)))
+
+
+if __name__ == '__main__':
+    main()
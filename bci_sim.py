@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# Copyright 2019-2020 Brad Martin.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Local stand-in for an OpenBCI wifi shield, for testing and benchmarks.
+
+This serves the parts of the shield's HTTP API that bci_logger.py uses, and
+streams valid Cyton+Daisy packet pairs over UDP once started, at a
+configurable rate.  Datagrams can be made to go missing, arrive out of
+order, or contain junk, to exercise the logger's handling of them.  Run
+this, then point bci_logger.py at the address it prints, e.g.:
+
+  bci_sim.py -p 8080 &
+  bci_logger.py -i 127.0.0.1:8080 -o test.bci
+"""
+
+import argparse
+import http.server
+import json
+import socket
+import threading
+import time
+
+import numpy
+
+from bci_data import BciData
+from bci_logger import OpenBCIWifi, SAMPLE_RATES as _RATE_COMMANDS
+
+# Sample rates selected by the '~N' commands, as with the Cyton.
+SAMPLE_RATES = {cmd: float(hz) for hz, cmd in _RATE_COMMANDS.items()}
+
+
+def make_pairs(n, first_sample=0, rate_hz=2000., start_ms=0, seed=0):
+    """Returns an (n, PAIR_LEN) uint8 array of synthetic, valid pairs."""
+    rng = numpy.random.default_rng(seed)
+    pkts = numpy.zeros((n, 2, BciData.PKT_LEN), dtype='B')
+    pkts[:, :, 0] = BciData.START_BYTE
+    pkts[:, :, 1] = ((first_sample + numpy.arange(n)) & 0xFF)[:, None]
+    pkts[:, :, 2:26] = rng.integers(0, 256, size=(n, 2, 24))
+    hw_ms = (start_ms + numpy.arange(n) * 1e3 / rate_hz).astype('>u4')
+    pkts[:, :, 28:32] = hw_ms.view('B').reshape((n, 1, 4))
+    pkts[:, :, BciData.PKT_LEN - 1] = BciData.STOP_BYTES[0]
+    return pkts.reshape((n, BciData.PAIR_LEN))
+
+
+class ShieldSimulator:
+    """A simulated wifi shield, served from background threads.
+
+    `rate_hz` fixes the sample rate; if None, it follows '~N' commands, as
+    a real board does.  `pairs_per_datagram` fixes how many pairs are sent
+    at once; if None, each datagram holds whatever accumulated over the
+    latency requested through the `udp` endpoint.  `loss` and `reorder` are
+    the probabilities of a datagram being dropped, or held back to follow
+    the next one.  `junk` is the probability of random bytes, which may
+    include start bytes, being inserted into a datagram.  If burst mode is
+    requested through the `udp` endpoint, each datagram is sent
+    `OpenBCIWifi.BURST_COPIES` times, each copy being dropped independently.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, rate_hz=None,
+                 pairs_per_datagram=None, loss=0., reorder=0., junk=0.,
+                 seed=0):
+        self._fixed_rate_hz = rate_hz
+        self.rate_hz = rate_hz if rate_hz is not None else 250.
+        self._pairs_per_datagram = pairs_per_datagram
+        self._loss = loss
+        self._reorder = reorder
+        self._junk = junk
+        self._rng = numpy.random.default_rng(seed)
+        self._target = None
+        self._latency_us = 10000
+        self._burst = False
+        self._sample = 0
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self.commands = []
+        self._stats = {
+            'samples_sent': 0,
+            'samples_lost': 0,
+            'datagrams_sent': 0,
+            'datagrams_lost': 0,
+            'datagrams_reordered': 0,
+            'junk_bytes': 0,
+            # How late the last datagram was sent, if the simulator can't
+            # keep up.
+            'behind_ms': 0,
+        }
+        self._socket = socket.socket(type=socket.SOCK_DGRAM)
+        self._server = http.server.ThreadingHTTPServer(
+            (host, port), self._make_handler())
+        self._server_thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True)
+
+    @property
+    def address(self):
+        """The host:port the simulator's HTTP API is served on."""
+        host, port = self._server.server_address[:2]
+        return '%s:%d' % (host, port)
+
+    def start(self):
+        self._server_thread.start()
+
+    def close(self):
+        self.stop_stream()
+        self._server.shutdown()
+        self._server.server_close()
+        self._socket.close()
+
+    def stats(self):
+        """Returns counts of what has been streamed so far, over all
+        streams."""
+        with self._lock:
+            return dict(self._stats)
+
+    def command(self, cmd):
+        self.commands.append(cmd)
+        if cmd in SAMPLE_RATES and self._fixed_rate_hz is None:
+            self.rate_hz = SAMPLE_RATES[cmd]
+
+    def start_stream(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._stream, daemon=True)
+        self._thread.start()
+
+    def stop_stream(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _make_handler(self):
+        sim = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/board':
+                    self._reply(json.dumps({
+                        'board_connected': True,
+                        'board_type': 'daisy',
+                        'num_channels': 16,
+                    }))
+                elif self.path == '/stream/start':
+                    sim.start_stream()
+                    self._reply('Stream started')
+                elif self.path == '/stream/stop':
+                    sim.stop_stream()
+                    self._reply('Stream stopped')
+                elif self.path == '/stats':
+                    self._reply(json.dumps(sim.stats()))
+                else:
+                    self.send_error(404)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length) or b'{}')
+                if self.path == '/command':
+                    sim.command(body['command'])
+                    self._reply('')
+                elif self.path == '/udp':
+                    sim._target = (body['ip'], body['port'])
+                    sim._latency_us = body.get('latency', 10000)
+                    sim._burst = bool(body.get('burst', False))
+                    self._reply(json.dumps(body))
+                else:
+                    self.send_error(404)
+
+            def _reply(self, text):
+                data = text.encode()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def _stream(self):
+        """Sends pairs in real time until stopped."""
+        rate_hz = self.rate_hz
+        if self._pairs_per_datagram is not None:
+            per_datagram = self._pairs_per_datagram
+        else:
+            per_datagram = max(
+                int(round(rate_hz * self._latency_us * 1e-6)), 1)
+        # The largest payload a UDP datagram can carry.
+        per_datagram = min(per_datagram, 65507 // 66)
+        # A restarted stream carries on from where the last one stopped.
+        sample = self._sample
+        start = time.monotonic() - sample / rate_hz
+        held = None
+        while not self._stop.is_set():
+            send_time = start + (sample + per_datagram) / rate_hz
+            delay = send_time - time.monotonic()
+            if delay > 0:
+                self._stop.wait(delay)
+            data = make_pairs(per_datagram, first_sample=sample,
+                              rate_hz=rate_hz,
+                              start_ms=sample * 1e3 / rate_hz,
+                              seed=sample).tobytes()
+            sample += per_datagram
+            self._sample = sample
+
+            stats = {'samples_sent': per_datagram}
+            if self._rng.random() < self._junk:
+                junk = self._rng.integers(
+                    0, 256, size=self._rng.integers(1, 67), dtype='B')
+                # Often a false start, so the logger has to resync after
+                # rejecting what looked like the start of a pair.
+                if self._rng.random() < 0.5:
+                    junk[0] = BciData.START_BYTE
+                pos = 66 * int(self._rng.integers(0, per_datagram + 1))
+                data = data[:pos] + junk.tobytes() + data[pos:]
+                stats['junk_bytes'] = junk.shape[0]
+            copies = OpenBCIWifi.BURST_COPIES if self._burst else 1
+            lost = self._rng.random(copies) < self._loss
+            stats['datagrams_lost'] = int(numpy.sum(lost))
+            if numpy.all(lost):
+                stats['samples_lost'] = per_datagram
+            elif held is None and self._rng.random() < self._reorder:
+                held = [data] * int(numpy.sum(~lost))
+                stats['datagrams_reordered'] = 1
+            else:
+                for _ in range(int(numpy.sum(~lost))):
+                    self._socket.sendto(data, self._target)
+                stats['datagrams_sent'] = int(numpy.sum(~lost))
+                if held is not None:
+                    for d in held:
+                        self._socket.sendto(d, self._target)
+                    stats['datagrams_sent'] += len(held)
+                    held = None
+            stats['behind_ms'] = max(-1e3 * delay, 0.)
+            with self._lock:
+                for k, v in stats.items():
+                    if k == 'behind_ms':
+                        self._stats[k] = v
+                    else:
+                        self._stats[k] += v
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Address to serve the HTTP API on')
+    parser.add_argument('-p', '--port', type=int, default=8080,
+                        help='Port to serve the HTTP API on')
+    parser.add_argument('-r', '--rate', type=float,
+                        help='Sample rate in Hz (default as set by the '
+                        'logger, 2000 for bci_logger.py)')
+    parser.add_argument('--pairs-per-datagram', type=int,
+                        help='Pairs per datagram (default as many as '
+                        'accumulate over the requested latency)')
+    parser.add_argument('--loss', type=float, default=0.,
+                        help='Probability of dropping each datagram')
+    parser.add_argument('--reorder', type=float, default=0.,
+                        help='Probability of delaying each datagram until '
+                        'after the next')
+    parser.add_argument('--junk', type=float, default=0.,
+                        help='Probability of inserting junk into each '
+                        'datagram')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed for loss, reordering and junk')
+    args = parser.parse_args()
+
+    sim = ShieldSimulator(args.host, args.port, rate_hz=args.rate,
+                          pairs_per_datagram=args.pairs_per_datagram,
+                          loss=args.loss, reorder=args.reorder,
+                          junk=args.junk, seed=args.seed)
+    sim.start()
+    print('Simulated shield at %s' % sim.address)
+    try:
+        while True:
+            time.sleep(1.)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(sim.stats()))
+        sim.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -19,26 +19,62 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import argparse
+"""Converts a .bci log file to csv, or another export format."""
 
-import numpy
+import argparse
+import math
+import os
 
-from bci_data import BciLogData
+import bci_export
+from bci_data import BciLogData, BciLogMap
 
 
 def main():
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('-i', '--input', required=True,
                         help='.bci log file to read')
     parser.add_argument('-o', '--output', required=True,
-                        help='.csv file to write')
+                        help='File to write; the format is taken from its '
+                        'extension unless --format is given')
+    parser.add_argument('-f', '--format', choices=bci_export.FORMATS,
+                        help='Output format (default from output name, else '
+                        'csv)')
+    parser.add_argument('-s', '--start', type=float,
+                        help='Seconds from start of log to begin export')
+    parser.add_argument('-e', '--end', type=float,
+                        help='Seconds from start of log to end export')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='Worker processes for csv formatting')
+    parser.add_argument('--sample-rate', type=float,
+                        help='Sample rate for edf/bdf output (default '
+                        'estimated from the data)')
+    parser.add_argument('--gain', type=int, default=bci_export.DEFAULT_GAIN,
+                        help='Channel gain, for scaling edf/bdf output')
     args = parser.parse_args()
 
-    with open(args.input, 'rb') as f:
-        d = f.read()
-    np_d = BciLogData.to_numpy(d)
-    numpy.savetxt(args.output, np_d, delimiter=',',
-                  fmt=(['%.6f'] + ['%d'] * (np_d.shape[1] - 1)))
+    log = BciLogMap(args.input)
+    kwargs = {
+        'fmt': args.format,
+        'jobs': args.jobs,
+        'start_time': bci_export.log_start_time(args.input,
+                                                log.records(0, 1)),
+        'sample_rate': args.sample_rate,
+        'gain': args.gain,
+    }
+
+    if args.start is None and args.end is None:
+        with open(args.input, 'rb') as f:
+            bci_export.export(BciLogData.iter_numpy(f), len(log),
+                              args.output, **kwargs)
+        return
+
+    t0 = log.start_time()
+    np_d = log.read_time(
+        t0 + (args.start if args.start is not None else -1.),
+        t0 + (args.end if args.end is not None else math.inf))
+    blocks = (np_d[i:i + BciLogData.CHUNK_RECORDS]
+              for i in range(0, np_d.shape[0], BciLogData.CHUNK_RECORDS))
+    bci_export.export(blocks, np_d.shape[0], args.output, **kwargs)
 
 
 if __name__ == '__main__':
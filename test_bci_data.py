@@ -0,0 +1,242 @@
+# Copyright 2019-2020 Brad Martin.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""Tests for bci_data."""
+
+import os
+import tempfile
+import unittest
+import warnings
+
+import numpy
+
+from bci_bench import make_log
+from bci_data import (BciLogData, BciLogManifest, BciLogMap, BciLogV2Writer,
+                      BciTimeCache)
+
+N_RECORDS = 20000
+
+
+def write_log(filename, data, v2=False):
+    with open(filename, 'wb') as f:
+        if v2:
+            writer = BciLogV2Writer(f, block_records=4096)
+            writer.write(data)
+            writer.close()
+        else:
+            f.write(data)
+
+
+class LogTestCase(unittest.TestCase):
+    """Provides the same synthetic log in the v1 and v2 formats."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.data = make_log(N_RECORDS)
+        self.full = BciLogData.to_numpy(self.data)
+        self.v1 = os.path.join(self.tmp, 'v1.bci')
+        write_log(self.v1, self.data)
+        self.v2 = os.path.join(self.tmp, 'v2.bci')
+        write_log(self.v2, self.data, v2=True)
+
+
+class FormatTest(LogTestCase):
+
+    def test_v1_v2_equal(self):
+        with open(self.v2, 'rb') as f:
+            v2_data = f.read()
+        self.assertNotEqual(v2_data, self.data)
+        numpy.testing.assert_array_equal(BciLogData.to_numpy(v2_data),
+                                         self.full)
+        numpy.testing.assert_array_equal(
+            BciLogData.load(self.v2, use_cache=False), self.full)
+        numpy.testing.assert_array_equal(BciLogMap(self.v2).records(),
+                                         BciLogMap(self.v1).records())
+
+    def test_iter_numpy(self):
+        for filename in [self.v1, self.v2]:
+            with open(filename, 'rb') as f:
+                chunks = list(BciLogData.iter_numpy(f, chunk_records=3000))
+            self.assertGreater(len(chunks), 1)
+            result = numpy.concatenate(chunks)
+            numpy.testing.assert_array_equal(result[:, 1:],
+                                             self.full[:, 1:])
+            numpy.testing.assert_allclose(
+                result[:, 0], self.full[:, 0], rtol=0,
+                atol=BciLogData.ITER_TOLERANCE_S)
+
+    def test_recover(self):
+        # Junk between records, and a partial record at the end.
+        junk = bytes(13)
+        pos = 5000 * BciLogData.RECORD_LEN
+        damaged = self.data[:pos] + junk + self.data[pos:] + self.data[:30]
+        result, dropped = BciLogData.recover(damaged)
+        numpy.testing.assert_array_equal(result, self.full)
+        self.assertEqual(dropped[0], (pos, len(junk)))
+
+    def test_load_segments(self):
+        log = os.path.join(self.tmp, 'seg.bci')
+        manifest = BciLogManifest()
+        bounds = [0, 7000, 15000, N_RECORDS]
+        for i, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])):
+            filename = BciLogManifest.segment_filename(log, i)
+            records = self.data[start * BciLogData.RECORD_LEN:
+                                stop * BciLogData.RECORD_LEN]
+            write_log(filename, records, v2=i % 2 == 1)
+            first = numpy.frombuffer(records[:BciLogData.RECORD_LEN],
+                                     dtype=BciLogData.DTYPE)[0]
+            manifest.segments.append({
+                'file': os.path.basename(filename),
+                'records': stop - start,
+                'first_sample': int(first['packet'][0]['sample_number']),
+                'first_sys_ms': int(first['sys_timestamp_ms'])})
+        manifest.write(log)
+        numpy.testing.assert_array_equal(BciLogData.load_segments(log),
+                                         self.full)
+
+
+class BciTimeCacheTest(LogTestCase):
+
+    def test_cache_matches(self):
+        numpy.testing.assert_array_equal(BciLogData.load(self.v1), self.full)
+        self.assertTrue(os.path.exists(self.v1 + BciTimeCache.SUFFIX))
+        self.assertIsNotNone(BciLogMap(self.v1)._times)
+        numpy.testing.assert_array_equal(BciLogData.load(self.v1), self.full)
+
+    def test_invalidated_by_mtime(self):
+        BciLogData.load(self.v1)
+        # Different records, but the same size.
+        other = make_log(N_RECORDS, seed=1)
+        write_log(self.v1, other)
+        st = os.stat(self.v1)
+        os.utime(self.v1, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        self.assertIsNone(BciLogMap(self.v1)._times)
+        numpy.testing.assert_array_equal(BciLogData.load(self.v1),
+                                         BciLogData.to_numpy(other))
+
+    def test_invalidated_by_size(self):
+        BciLogData.load(self.v1)
+        other = make_log(N_RECORDS + 1000, seed=1)
+        write_log(self.v1, other)
+        self.assertIsNone(BciLogMap(self.v1)._times)
+        numpy.testing.assert_array_equal(BciLogData.load(self.v1),
+                                         BciLogData.to_numpy(other))
+        # Shrinking the log invalidates it too.
+        write_log(self.v1, self.data)
+        self.assertIsNone(BciLogMap(self.v1)._times)
+        numpy.testing.assert_array_equal(BciLogData.load(self.v1), self.full)
+
+    def test_extended_when_grown(self):
+        longer = make_log(N_RECORDS + 5000)
+        write_log(self.v1, longer[:len(self.data)])
+        BciLogData.load(self.v1)
+        write_log(self.v1, longer)
+        result = BciLogData.load(self.v1)
+        expected = BciLogData.to_numpy(longer)
+        numpy.testing.assert_array_equal(result[:, 1:], expected[:, 1:])
+        numpy.testing.assert_allclose(
+            result[:, 0], expected[:, 0], rtol=0,
+            atol=BciTimeCache.TOLERANCE_MS * 1e-3)
+        self.assertIsNotNone(BciLogMap(self.v1)._times)
+
+
+class EpochsTest(LogTestCase):
+
+    PRE_S = 0.1
+    POST_S = 0.1
+
+    def test_epochs(self):
+        t = self.full[:, 0]
+        # Starting just before a sample, so the epoch starts on it.
+        inside = t[5000] + self.PRE_S - 2e-4
+        off_start = t[0] + 2e-4
+        off_end = t[-1]
+        for epochs, complete in [
+                BciLogData.epochs(self.data, [inside, off_start, off_end],
+                                  self.PRE_S, self.POST_S),
+                BciLogMap(self.v2).epochs([inside, off_start, off_end],
+                                          self.PRE_S, self.POST_S)]:
+            n = epochs.shape[1]
+            self.assertAlmostEqual(n, (self.PRE_S + self.POST_S) * 2000,
+                                   delta=1)
+            self.assertEqual(list(complete), [True, False, False])
+            numpy.testing.assert_array_equal(epochs[0],
+                                             self.full[5000:5000 + n, 1:])
+            # Samples before the start of the log are NaN.
+            missing = numpy.isnan(epochs[1]).all(axis=1)
+            k = int(missing.sum())
+            self.assertGreater(k, 0)
+            self.assertTrue(missing[:k].all())
+            numpy.testing.assert_array_equal(epochs[1, k:],
+                                             self.full[:n - k, 1:])
+            # As are those after the end.
+            missing = numpy.isnan(epochs[2]).all(axis=1)
+            k = int(missing.sum())
+            self.assertGreater(k, 0)
+            self.assertTrue(missing[n - k:].all())
+            numpy.testing.assert_array_equal(epochs[2, :n - k],
+                                             self.full[-(n - k):, 1:])
+
+    def test_epoch_spanning_gap(self):
+        # Drop 100 records, so the epoch around them has a gap.
+        lost = slice(8000 * BciLogData.RECORD_LEN,
+                     8100 * BciLogData.RECORD_LEN)
+        data = self.data[:lost.start] + self.data[lost.stop:]
+        t = self.full[:, 0]
+        event = t[7900] + self.PRE_S - 2e-4
+        epochs, complete = BciLogData.epochs(data, [event], self.PRE_S,
+                                             self.POST_S)
+        self.assertFalse(complete[0])
+        missing = numpy.isnan(epochs[0]).all(axis=1)
+        self.assertEqual(list(numpy.flatnonzero(missing)),
+                         list(range(100, 200)))
+        n = epochs.shape[1]
+        numpy.testing.assert_array_equal(epochs[0, :100],
+                                         self.full[7900:8000, 1:])
+        numpy.testing.assert_array_equal(epochs[0, 200:],
+                                         self.full[8100:7900 + n, 1:])
+
+
+class BciLogMapTest(LogTestCase):
+
+    def test_read_small_windows_uncached(self):
+        # Windows too short to reconstruct timestamps from on their own.
+        for filename in [self.v1, self.v2]:
+            log = BciLogMap(filename)
+            for n in [1, 10, 200]:
+                for start in list(range(0, len(log) - n, 2503)) + [
+                        len(log) - n]:
+                    with warnings.catch_warnings():
+                        warnings.simplefilter('error', RuntimeWarning)
+                        window = log.read(start, start + n)
+                    expected = self.full[start:start + n]
+                    numpy.testing.assert_array_equal(window[:, 1:],
+                                                     expected[:, 1:])
+                    numpy.testing.assert_allclose(window[:, 0],
+                                                  expected[:, 0], atol=1e-2)
+
+    def test_read_empty_window_uncached(self):
+        log = BciLogMap(self.v1)
+        self.assertEqual(log.read(5, 5).shape, (0, 17))
+
+
+if __name__ == '__main__':
+    unittest.main()
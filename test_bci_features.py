@@ -0,0 +1,50 @@
+# Copyright 2019-2020 Brad Martin.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Tests for bci_features."""
+
+import os
+import tempfile
+import unittest
+
+import numpy
+
+from bci_bench import make_log
+from bci_features import STEP_S, band_powers
+
+
+class BandPowersTest(unittest.TestCase):
+
+    def test_estimated_sample_rate(self):
+        # The rate estimated from a synthetic log isn't exactly 2kHz, so the
+        # window and step aren't whole numbers of half segments in samples.
+        with tempfile.TemporaryDirectory() as tmp:
+            log = os.path.join(tmp, 'c.bci')
+            with open(log, 'wb') as f:
+                f.write(make_log(40000))
+            features = band_powers(log, use_cache=False)
+        self.assertGreater(features.shape[0], 0)
+        self.assertTrue(features['contiguous'].all())
+        numpy.testing.assert_allclose(
+            numpy.diff(features['time']), STEP_S, rtol=1e-3)
+
+
+if __name__ == '__main__':
+    unittest.main()